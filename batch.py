@@ -0,0 +1,151 @@
+import argparse
+from functools import partial
+from pathlib import Path
+from typing import Optional
+
+from src.cli import add_pipeline_args
+from src.llm import llm_completion_config_map, routing_from_args
+
+
+def main(
+    output_dir: str,
+    input_dir: Optional[str] = None,
+    manifest: Optional[str] = None,
+    checkpoint_path: Optional[str] = None,
+    processes: int = 4,
+    requests_per_minute: Optional[int] = None,
+    tokens_per_minute: Optional[int] = None,
+    use_fake_backends: bool = False,
+    fake_llm_latency: float = 0.0,
+    fake_ocr_latency: float = 0.0,
+    **kwargs,
+):
+    """
+    Parse every PDF of a directory, or listed in a manifest, into a JSON file of
+    `output_dir`, and print a report of the batch. Keyword arguments are passed on to
+    BatchOptions.
+    """
+    from src.batch import BatchOptions, list_pdfs, output_path, read_manifest, run_batch
+
+    if input_dir is not None:
+        pdfs = list_pdfs(input_dir)
+    else:
+        pdfs = read_manifest(manifest)
+    jobs = [(pdf, output_path(pdf, output_dir, input_dir)) for pdf in pdfs]
+    options = BatchOptions(**kwargs)
+    backends = None
+    if use_fake_backends:
+        # offline stand-ins for DocumentAI and the LLM, created in each worker process
+        from src.fakes import fake_backends
+
+        options.cache = False
+        backends = partial(fake_backends, fake_llm_latency, fake_ocr_latency)
+    report = run_batch(
+        jobs,
+        checkpoint_path or Path(output_dir) / "checkpoint.jsonl",
+        processes=processes,
+        requests_per_minute=requests_per_minute,
+        tokens_per_minute=tokens_per_minute,
+        options=options,
+        backends=backends,
+    )
+    print(report.summary())
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    inputs = parser.add_mutually_exclusive_group(required=True)
+    inputs.add_argument(
+        "--input-dir",
+        metavar="path",
+        type=str,
+        help="Parse every PDF in this directory and its subdirectories",
+    )
+    inputs.add_argument(
+        "--manifest",
+        metavar="path",
+        type=str,
+        help="Parse the PDFs listed in this file, one path per line",
+    )
+    parser.add_argument(
+        "--output-dir",
+        metavar="path",
+        type=str,
+        required=True,
+        help="Directory to write a JSON record for each PDF to",
+    )
+    parser.add_argument(
+        "--checkpoint",
+        metavar="path",
+        type=str,
+        default=None,
+        help="File recording finished records, to resume from (default: checkpoint.jsonl in the output directory)",
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=4,
+        help="Number of records to parse at once, each in its own process",
+    )
+    parser.add_argument(
+        "--api-type",
+        type=str,
+        default="openai",
+        choices=sorted(llm_completion_config_map),
+        help="LLM backend to use. openai_batch sends prompts in jobs of OpenAI's Batch API, at a lower price, for records that can wait hours; use it with --fused, and more --processes and --max-workers to keep more records in flight",
+    )
+    parser.add_argument(
+        "--max-workers",
+        type=int,
+        default=4,
+        help="Number of encounters of each record to parse at once",
+    )
+    add_pipeline_args(parser, "processes")
+    parser.add_argument(
+        "--price",
+        metavar=("model", "prompt", "completion"),
+        nargs=3,
+        action="append",
+        default=[],
+        help="US dollars per million prompt and completion tokens of a model, for the cost report",
+    )
+    parser.add_argument(
+        "--ocr-price",
+        type=float,
+        default=None,
+        help="US dollars per page OCR'd, for the cost report",
+    )
+    parser.add_argument(
+        "--fake-backends",
+        action="store_true",
+        help="Use offline fakes of DocumentAI and the LLM, for testing",
+    )
+    parser.add_argument("--fake-llm-latency", type=float, default=0.0)
+    parser.add_argument("--fake-ocr-latency", type=float, default=0.0)
+    args = parser.parse_args()
+    routing = routing_from_args(parser, args)
+
+    from src import batch
+
+    for model, prompt_price, completion_price in args.price:
+        batch.MODEL_PRICES[model] = (float(prompt_price), float(completion_price))
+    if args.ocr_price is not None:
+        batch.OCR_PRICE_PER_PAGE = args.ocr_price
+    main(
+        args.output_dir,
+        input_dir=args.input_dir,
+        manifest=args.manifest,
+        checkpoint_path=args.checkpoint,
+        processes=args.processes,
+        requests_per_minute=args.requests_per_minute,
+        tokens_per_minute=args.tokens_per_minute,
+        use_fake_backends=args.fake_backends,
+        fake_llm_latency=args.fake_llm_latency,
+        fake_ocr_latency=args.fake_ocr_latency,
+        api_type=args.api_type,
+        max_workers=args.max_workers,
+        fused=args.fused,
+        routing=routing,
+        cache=not args.no_cache,
+    )
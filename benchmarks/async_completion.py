@@ -0,0 +1,199 @@
+"""
+Benchmark concurrent chat completions against a local fake OpenAI and Ollama server.
+
+Sends the same number of requests through the async path of LLMApi, with all of them
+in flight at once, and through the sync path on a thread pool, and reports throughput
+and how many TCP connections the pooled clients opened:
+
+    python -m benchmarks.async_completion --requests 500 --latency 0.2
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Tuple
+
+from src.llm import LLMApi
+
+COMPLETION = "fake completion"
+
+
+class FakeServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, latency: float, num_connections: Any) -> None:
+        super().__init__(("127.0.0.1", 0), FakeHandler)
+        self.latency = latency
+        # shared with the benchmark process
+        self.num_connections = num_connections
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    """
+    Answers OpenAI chat completions, as a single response or as server-sent events, and
+    Ollama chat, as a single response or as lines of JSON, over keep-alive connections.
+    """
+
+    protocol_version = "HTTP/1.1"
+    server: FakeServer
+
+    def setup(self) -> None:
+        super().setup()
+        with self.server.num_connections.get_lock():
+            self.server.num_connections.value += 1
+
+    def log_message(self, *args) -> None:
+        pass
+
+    def do_POST(self) -> None:
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        time.sleep(self.server.latency)
+        if self.path.endswith("/chat/completions"):
+            body, content_type = self.openai_body(request)
+        else:
+            body, content_type = self.ollama_body(request)
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def openai_body(self, request: dict) -> Tuple[bytes, str]:
+        completion = {
+            "id": "fake",
+            "created": 0,
+            "model": request["model"],
+            "object": "chat.completion",
+            "choices": [
+                {
+                    "index": 0,
+                    "finish_reason": "stop",
+                    "message": {"role": "assistant", "content": COMPLETION},
+                }
+            ],
+        }
+        if not request.get("stream"):
+            return json.dumps(completion).encode(), "application/json"
+        events = []
+        for i, word in enumerate(COMPLETION.split(" ")):
+            delta = {"content": word if i == 0 else f" {word}"}
+            if i == 0:
+                delta["role"] = "assistant"
+            chunk = {
+                **completion,
+                "object": "chat.completion.chunk",
+                "choices": [{"index": 0, "finish_reason": None, "delta": delta}],
+            }
+            events.append(f"data: {json.dumps(chunk)}\n\n")
+        events.append("data: [DONE]\n\n")
+        return "".join(events).encode(), "text/event-stream"
+
+    def ollama_body(self, request: dict) -> Tuple[bytes, str]:
+        message = {"role": "assistant", "content": COMPLETION}
+        if not request.get("stream"):
+            return json.dumps({"message": message, "done": True}).encode(), (
+                "application/json"
+            )
+        lines = [
+            json.dumps({"message": {"role": "assistant", "content": word}})
+            for word in COMPLETION.split(" ")
+        ]
+        lines.append(json.dumps({"done": True}))
+        return "\n".join(lines).encode(), "application/x-ndjson"
+
+
+def serve(latency: float, num_connections: Any, port: Any) -> None:
+    server = FakeServer(latency, num_connections)
+    port.value = server.server_address[1]
+    server.serve_forever()
+
+
+def run_async(llm: LLMApi, num_requests: int, stream: bool) -> float:
+    async def run() -> float:
+        started = time.perf_counter()
+        msgs = await asyncio.gather(
+            *(
+                llm.achat_completion(
+                    messages=[{"role": "user", "content": f"request {i}"}],
+                    stream=stream,
+                )
+                for i in range(num_requests)
+            )
+        )
+        elapsed = time.perf_counter() - started
+        assert all(msg["content"] for msg in msgs)
+        await llm.aclose()
+        return elapsed
+
+    return asyncio.run(run())
+
+
+def run_threads(
+    llm: LLMApi, num_requests: int, stream: bool, num_threads: int
+) -> float:
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        list(
+            executor.map(
+                lambda i: llm.chat_completion(
+                    messages=[{"role": "user", "content": f"request {i}"}],
+                    stream=stream,
+                ),
+                range(num_requests),
+            )
+        )
+    return time.perf_counter() - started
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--max-connections", type=int, default=500)
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument("--no-stream", action="store_true")
+    args = parser.parse_args()
+
+    # the server runs in its own process, so it does not compete with the clients
+    num_connections = multiprocessing.Value("i", 0)
+    port = multiprocessing.Value("i", 0)
+    server = multiprocessing.Process(
+        target=serve, args=(args.latency, num_connections, port), daemon=True
+    )
+    server.start()
+    while port.value == 0:
+        time.sleep(0.01)
+    api_base = f"http://127.0.0.1:{port.value}"
+    stream = not args.no_stream
+
+    print(
+        f"{'backend':<8} {'mode':<12} {'requests':>8} {'seconds':>8} {'req/s':>8} {'conns':>6}"
+    )
+    for api_type, config in [
+        ("openai", {"api_base": f"{api_base}/v1"}),
+        ("ollama", {"api_base": api_base, "model": "fake"}),
+    ]:
+        for mode in ["async", "threads"]:
+            llm = LLMApi(
+                api_type,
+                max_connections=args.max_connections,
+                max_keepalive_connections=args.max_connections,
+                **config,
+            )
+            connections_before = num_connections.value
+            if mode == "async":
+                elapsed = run_async(llm, args.requests, stream)
+            else:
+                elapsed = run_threads(llm, args.requests, stream, args.threads)
+                mode = f"threads={args.threads}"
+            llm.close()
+            print(
+                f"{api_type:<8} {mode:<12} {args.requests:>8} {elapsed:>8.2f} "
+                f"{args.requests / elapsed:>8.1f} {num_connections.value - connections_before:>6}"
+            )
+    server.terminate()
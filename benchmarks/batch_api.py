@@ -0,0 +1,359 @@
+"""
+Run the batch pipeline offline against a local stand-in for OpenAI's Batch API.
+
+The stand-in takes JSONL batch files through the files and batches endpoints, and
+finishes each batch `--batch-latency` seconds after it was created, answering its
+requests with the rule-based answers of `src.fakes.fake_answer`. With
+`--error-rate`, that share of requests fail with a server error the first time they
+are sent, to exercise requeueing. Its files and batches are kept in `--work-dir`, as
+are the records, outputs, checkpoint and batch store, so an interrupted run resumes
+when started again with the same directory:
+
+    python -m benchmarks.batch_api --records 8 --pages 60 --fused
+    python -m benchmarks.batch_api --records 8 --pages 60 --work-dir .cache/batch-api
+"""
+
+import argparse
+import email.parser
+import email.policy
+import hashlib
+import json
+import multiprocessing
+import tempfile
+import threading
+import time
+import uuid
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+from benchmarks.fakes import load_page_texts
+from benchmarks.synthetic import synthetic_record, write_record_pdf
+from src.fakes import FakeDocumentAI, fake_answer
+from src.llm.openai_batch import OpenAIBatchService
+from src.llm.util import estimate_messages_tokens, estimate_tokens
+
+
+class FakeBatchServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, state_dir: Path, latency: float, error_rate: float) -> None:
+        super().__init__(("127.0.0.1", 0), FakeBatchHandler)
+        self.state_dir = state_dir
+        self.latency = latency
+        self.error_rate = error_rate
+        self.lock = threading.Lock()
+        (state_dir / "files").mkdir(parents=True, exist_ok=True)
+        (state_dir / "batches").mkdir(parents=True, exist_ok=True)
+
+    def file_path(self, file_id: str) -> Path:
+        return self.state_dir / "files" / file_id
+
+    def batch_path(self, batch_id: str) -> Path:
+        return self.state_dir / "batches" / f"{batch_id}.json"
+
+    def create_file(
+        self, filename: str, purpose: str, content: bytes
+    ) -> Dict[str, Any]:
+        file = {
+            "id": f"file-{uuid.uuid4().hex}",
+            "object": "file",
+            "bytes": len(content),
+            "created_at": int(time.time()),
+            "filename": filename,
+            "purpose": purpose,
+            "status": "processed",
+        }
+        self.file_path(file["id"]).write_bytes(content)
+        return file
+
+    def create_batch(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        batch = {
+            "id": f"batch_{uuid.uuid4().hex}",
+            "object": "batch",
+            "endpoint": request["endpoint"],
+            "input_file_id": request["input_file_id"],
+            "completion_window": request["completion_window"],
+            "metadata": request.get("metadata"),
+            "status": "in_progress",
+            "created_at": int(time.time()),
+            "output_file_id": None,
+            "error_file_id": None,
+        }
+        with self.lock:
+            self.batch_path(batch["id"]).write_text(json.dumps(batch))
+        return batch
+
+    def fails_once(self, custom_id: str) -> bool:
+        """Whether a request is one of the `error_rate` that fail when first sent."""
+        digest = hashlib.sha256(custom_id.encode("utf-8")).digest()
+        if int.from_bytes(digest[:4], "big") / 2**32 >= self.error_rate:
+            return False
+        failed = self.state_dir / "failed" / custom_id
+        if failed.exists():
+            return False
+        failed.parent.mkdir(exist_ok=True)
+        failed.touch()
+        return True
+
+    def answer(self, line: str) -> Tuple[bool, str]:
+        request = json.loads(line)
+        custom_id = request["custom_id"]
+        if self.fails_once(custom_id):
+            response = {"status_code": 500, "body": {"error": {"message": "fake"}}}
+            return False, json.dumps(
+                {"custom_id": custom_id, "response": response, "error": None}
+            )
+        body = request["body"]
+        content = fake_answer(body["messages"], body.get("response_format"))
+        completion = {
+            "object": "chat.completion",
+            "model": body["model"],
+            "choices": [
+                {
+                    "index": 0,
+                    "finish_reason": "stop",
+                    "message": {"role": "assistant", "content": content},
+                }
+            ],
+            "usage": {
+                "prompt_tokens": estimate_messages_tokens(body["messages"]),
+                "completion_tokens": estimate_tokens(content),
+            },
+        }
+        response = {"status_code": 200, "body": completion}
+        return True, json.dumps(
+            {"custom_id": custom_id, "response": response, "error": None}
+        )
+
+    def get_batch(self, batch_id: str) -> Optional[Dict[str, Any]]:
+        """Return a batch, finishing it first if its latency has passed."""
+        with self.lock:
+            path = self.batch_path(batch_id)
+            if not path.exists():
+                return None
+            batch = json.loads(path.read_text())
+            if (
+                batch["status"] == "in_progress"
+                and time.time() >= batch["created_at"] + self.latency
+            ):
+                lines = self.file_path(batch["input_file_id"]).read_text().splitlines()
+                outputs: List[str] = []
+                errors: List[str] = []
+                for line in lines:
+                    if line.strip():
+                        ok, output = self.answer(line)
+                        (outputs if ok else errors).append(output)
+                for key, results in [
+                    ("output_file_id", outputs),
+                    ("error_file_id", errors),
+                ]:
+                    if results:
+                        content = "".join(f"{result}\n" for result in results)
+                        batch[key] = self.create_file(
+                            f"{batch_id}_{key}.jsonl", "batch_output", content.encode()
+                        )["id"]
+                batch["status"] = "completed"
+                batch["completed_at"] = int(time.time())
+                batch["request_counts"] = {
+                    "total": len(outputs) + len(errors),
+                    "completed": len(outputs),
+                    "failed": len(errors),
+                }
+                path.write_text(json.dumps(batch))
+            return batch
+
+    def list_batches(
+        self, after: Optional[str], limit: int
+    ) -> Tuple[List[Dict[str, Any]], bool]:
+        """Return a page of batches, newest first, and whether there are more."""
+        with self.lock:
+            batches = [
+                json.loads(path.read_text())
+                for path in (self.state_dir / "batches").glob("*.json")
+            ]
+        batches.sort(key=lambda batch: (-batch["created_at"], batch["id"]))
+        ids = [batch["id"] for batch in batches]
+        start = ids.index(after) + 1 if after in ids else 0
+        return batches[start : start + limit], start + limit < len(batches)
+
+
+class FakeBatchHandler(BaseHTTPRequestHandler):
+    """Answers the files and batches endpoints of OpenAI's API that batches use."""
+
+    protocol_version = "HTTP/1.1"
+    server: FakeBatchServer
+
+    def log_message(self, *args) -> None:
+        pass
+
+    def send_json(self, data: Any, status: int = 200) -> None:
+        self.send_body(json.dumps(data).encode(), "application/json", status)
+
+    def send_body(self, body: bytes, content_type: str, status: int = 200) -> None:
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def not_found(self) -> None:
+        self.send_json({"error": {"message": f"not found: {self.path}"}}, 404)
+
+    def do_POST(self) -> None:
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        path = urlparse(self.path).path
+        if path == "/v1/files":
+            form = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+                f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode() + body
+            )
+            fields = {
+                part.get_param("name", header="content-disposition"): part
+                for part in form.iter_parts()
+            }
+            self.send_json(
+                self.server.create_file(
+                    fields["file"].get_filename(),
+                    fields["purpose"].get_content().strip(),
+                    fields["file"].get_payload(decode=True),
+                )
+            )
+        elif path == "/v1/batches":
+            self.send_json(self.server.create_batch(json.loads(body)))
+        else:
+            self.not_found()
+
+    def do_GET(self) -> None:
+        url = urlparse(self.path)
+        parts = url.path.strip("/").split("/")
+        if parts == ["v1", "batches"]:
+            query = parse_qs(url.query)
+            batches, has_more = self.server.list_batches(
+                query.get("after", [None])[0], int(query.get("limit", ["20"])[0])
+            )
+            self.send_json({"object": "list", "data": batches, "has_more": has_more})
+        elif len(parts) == 3 and parts[:2] == ["v1", "batches"]:
+            batch = self.server.get_batch(parts[2])
+            self.send_json(batch) if batch is not None else self.not_found()
+        elif len(parts) == 4 and parts[:2] == ["v1", "files"] and parts[3] == "content":
+            path = self.server.file_path(parts[2])
+            if path.exists():
+                self.send_body(path.read_bytes(), "application/octet-stream")
+            else:
+                self.not_found()
+        else:
+            self.not_found()
+
+
+def serve(state_dir: Path, latency: float, error_rate: float, port: Any) -> None:
+    server = FakeBatchServer(state_dir, latency, error_rate)
+    port.value = server.server_address[1]
+    server.serve_forever()
+
+
+def batch_backends(
+    page_texts: Path, api_base: str, store_path: Path, **config: Any
+) -> Tuple[FakeDocumentAI, OpenAIBatchService]:
+    """Fake DocumentAI and the batch service of the stand-in, in each worker process."""
+    return FakeDocumentAI(load_page_texts(page_texts)), OpenAIBatchService(
+        "fake", api_base=api_base, store_path=str(store_path), **config
+    )
+
+
+def write_records(
+    records_dir: Path, num_records: int, num_pages: int, seed: int
+) -> Path:
+    """
+    Write synthetic records to `records_dir`, unless they are there already, and the
+    text of all their pages to one JSONL file. Returns the path of the JSONL file.
+    """
+    page_texts = records_dir / "pages.jsonl"
+    if page_texts.exists():
+        return page_texts
+    records_dir.mkdir(parents=True, exist_ok=True)
+    with open(page_texts, "w", encoding="utf-8") as fh:
+        for i in range(num_records):
+            record_texts = write_record_pdf(
+                records_dir / f"record-{i}.pdf",
+                synthetic_record(num_pages, seed + i),
+                seed=seed + i,
+            )
+            fh.write(record_texts.read_text(encoding="utf-8"))
+            record_texts.unlink()
+    return page_texts
+
+
+def run(args: argparse.Namespace, work_dir: Path) -> None:
+    from src.batch import BatchOptions, list_pdfs, output_path, run_batch
+
+    records_dir = work_dir / "records"
+    page_texts = write_records(records_dir, args.records, args.pages, args.seed)
+    port = multiprocessing.Value("i", 0)
+    server = multiprocessing.Process(
+        target=serve,
+        args=(work_dir / "server", args.batch_latency, args.error_rate, port),
+        daemon=True,
+    )
+    server.start()
+    while port.value == 0:
+        time.sleep(0.01)
+
+    jobs = [
+        (pdf, output_path(pdf, work_dir / "outputs", records_dir))
+        for pdf in list_pdfs(records_dir)
+    ]
+    try:
+        report = run_batch(
+            jobs,
+            work_dir / "outputs" / "checkpoint.jsonl",
+            processes=args.processes,
+            options=BatchOptions(
+                api_type="openai_batch",
+                max_workers=args.max_workers,
+                fused=args.fused,
+                cache=False,
+            ),
+            backends=partial(
+                batch_backends,
+                page_texts,
+                f"http://127.0.0.1:{port.value}/v1",
+                work_dir / "batches.sqlite3",
+                flush_seconds=args.flush_seconds,
+                poll_seconds=args.poll_seconds,
+                wait_seconds=0.1,
+            ),
+        )
+    finally:
+        server.terminate()
+    num_batches = len(list((work_dir / "server" / "batches").glob("*.json")))
+    print(report.summary())
+    print(f"batches: {num_batches} submitted to the stand-in")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--records", type=int, default=8)
+    parser.add_argument("--pages", type=int, default=60)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--processes", type=int, default=8)
+    parser.add_argument("--max-workers", type=int, default=64)
+    parser.add_argument("--fused", action="store_true")
+    parser.add_argument("--batch-latency", type=float, default=2.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--flush-seconds", type=float, default=1.0)
+    parser.add_argument("--poll-seconds", type=float, default=1.0)
+    parser.add_argument(
+        "--work-dir",
+        type=str,
+        default=None,
+        help="directory of the records, outputs and batch state, to resume from",
+    )
+    args = parser.parse_args()
+
+    if args.work_dir is not None:
+        run(args, Path(args.work_dir))
+    else:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            run(args, Path(tmp_dir))
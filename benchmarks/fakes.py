@@ -0,0 +1,105 @@
+"""
+Recorders of the real DocumentAI and LLM responses, for replaying them offline.
+
+`RecordingDocumentAI` and `RecordingCompletionService` wrap the real backends and save
+their responses, which `load_page_texts` and `load_responses` read back for the
+`FakeDocumentAI` and `FakeCompletionService` of `src.fakes`.
+"""
+
+import json
+import threading
+from io import BytesIO
+from pathlib import Path
+from typing import Any, Dict, Generator, List, Optional
+
+from google.cloud.documentai_v1 import Document
+from pypdf import PdfReader
+
+from src.fakes import request_key
+from src.llm import CompletionService
+from src.llm.util import ChatMessageType, format_chat_message
+from src.pdf import OCRClient, document_page_texts, page_fingerprint
+
+
+def load_page_texts(path: str | Path) -> Dict[str, str]:
+    """Read page texts by page hash, as written by `RecordingDocumentAI`."""
+    texts = {}
+    with open(path, encoding="utf-8") as fh:
+        for line in fh:
+            entry = json.loads(line)
+            texts[entry["hash"]] = entry["text"]
+    return texts
+
+
+class RecordingDocumentAI:
+    """
+    OCR client that calls `document_ai` and appends the text of each page it returns, by
+    page hash, to a JSONL file at `path`.
+    """
+
+    def __init__(self, document_ai: OCRClient, path: str | Path) -> None:
+        self.document_ai = document_ai
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+
+    def __call__(
+        self, content: bytes, mime_type: str | None = "application/pdf"
+    ) -> Document:
+        document = self.document_ai(content, mime_type=mime_type)
+        texts = document_page_texts(document)
+        page_hashes = [
+            page_fingerprint(page)[0] for page in PdfReader(BytesIO(content)).pages
+        ]
+        if texts is not None and len(texts) == len(page_hashes):
+            with self._lock, open(self.path, "a", encoding="utf-8") as fh:
+                for page_hash, text in zip(page_hashes, texts):
+                    fh.write(json.dumps({"hash": page_hash, "text": text}) + "\n")
+        return document
+
+
+def load_responses(path: str | Path) -> Dict[str, ChatMessageType]:
+    """Read responses by request key, as written by `RecordingCompletionService`."""
+    responses = {}
+    with open(path, encoding="utf-8") as fh:
+        for line in fh:
+            entry = json.loads(line)
+            responses[entry["key"]] = entry["message"]
+    return responses
+
+
+class RecordingCompletionService(CompletionService):
+    """
+    Completion service that calls `completion_service` and appends each response, by
+    request key, to a JSONL file at `path`.
+    """
+
+    def __init__(self, completion_service: CompletionService, path: str | Path) -> None:
+        self.completion_service = completion_service
+        self.config = completion_service.config
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+
+    def chat_completion(
+        self,
+        messages: List[ChatMessageType],
+        stream: bool = True,
+        temperature: Optional[float] = None,
+        max_tokens: Optional[int] = None,
+        top_p: Optional[float] = None,
+        stop: Optional[List[str]] = None,
+        **kwargs: Any,
+    ) -> Generator[ChatMessageType, None, None]:
+        msg = format_chat_message("assistant", "")
+        for chunk in self.completion_service.chat_completion(
+            messages, stream, temperature, max_tokens, top_p, stop, **kwargs
+        ):
+            msg["content"] += chunk["content"]
+            yield chunk
+        key = request_key(messages, temperature, max_tokens, top_p, stop, kwargs)
+        with self._lock, open(self.path, "a", encoding="utf-8") as fh:
+            fh.write(json.dumps({"key": key, "message": msg}) + "\n")
+
+    def close(self) -> None:
+        self.completion_service.close()
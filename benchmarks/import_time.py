@@ -0,0 +1,91 @@
+"""
+Benchmark the cold start of the CLI and of the package's entry points.
+
+Each module is imported in a fresh interpreter, `--repeat` times, and the median wall
+time of the process, the import time reported by `python -X importtime`, and which of
+the heavy optional dependencies it loaded are reported:
+
+    python -m benchmarks.import_time
+    python -m benchmarks.import_time --modules submission --top 15
+"""
+
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+from typing import Dict, List, Tuple
+
+# dependencies that should only be imported by the runs that use them
+HEAVY_MODULES = [
+    "dateparser",
+    "google.cloud.documentai",
+    "grpc",
+    "openai",
+    "requests",
+    "httpx",
+]
+
+DEFAULT_MODULES = [
+    "submission",
+    "src.record",
+    "src.incremental",
+    "src.llm",
+    "src.llm.openai",
+    "src.llm.ollama",
+    "src.pdf",
+]
+
+
+def import_once(module: str) -> Tuple[float, Dict[str, int], List[str]]:
+    """
+    Import `module` in a new interpreter, and return the wall time of the process, the
+    cumulative import time of each module in microseconds, and the heavy modules loaded.
+    """
+    code = (
+        f"import sys; import {module}; "
+        f"print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+    )
+    started = time.perf_counter()
+    out = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    seconds = time.perf_counter() - started
+    cumulative = {}
+    for line in out.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative_us, name = line[len("import time:") :].split("|")
+        if cumulative_us.strip().isdigit():
+            cumulative[name.strip()] = int(cumulative_us)
+    heavy = [m for m in out.stdout.strip().split(",") if m]
+    return seconds, cumulative, heavy
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--modules", type=str, nargs="+", default=DEFAULT_MODULES)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--top", type=int, default=0, help="list the slowest imports")
+    args = parser.parse_args()
+
+    baseline = statistics.median(import_once("sys")[0] for _ in range(args.repeat))
+    print(f"interpreter startup: {baseline * 1000:.0f} ms")
+    print(f"{'module':<18} {'wall_ms':>8} {'import_ms':>10}  heavy dependencies loaded")
+    for module in args.modules:
+        runs = [import_once(module) for _ in range(args.repeat)]
+        wall_ms = statistics.median(seconds for seconds, _, _ in runs) * 1000
+        import_ms = statistics.median(c.get(module, 0) for _, c, _ in runs) / 1000
+        heavy = runs[-1][2]
+        print(
+            f"{module:<18} {wall_ms:>8.0f} {import_ms:>10.0f}  {', '.join(heavy) or '-'}"
+        )
+        if args.top:
+            cumulative = runs[-1][1]
+            for name in sorted(cumulative, key=cumulative.get, reverse=True)[
+                1 : args.top + 1
+            ]:
+                print(f"    {name:<50} {cumulative[name] / 1000:>8.1f} ms")
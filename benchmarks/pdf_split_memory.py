@@ -0,0 +1,141 @@
+"""
+Benchmark peak memory of pdf_pages against the number of pages in an image-heavy PDF.
+
+Each page count runs in a fresh subprocess, so its peak RSS is measured on its own:
+
+    python -m benchmarks.pdf_split_memory --pages 100 500 1000 2000
+"""
+
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from io import BytesIO
+from pathlib import Path
+
+from google.cloud.documentai_v1 import Document
+from pypdf import PdfReader, PdfWriter
+from pypdf.generic import DecodedStreamObject, DictionaryObject, NameObject, NumberObject
+
+from src.pdf import pdf_pages
+
+
+def write_image_pdf(path: Path, num_pages: int, image_side: int) -> None:
+    """Write a PDF whose pages each hold one uncompressed greyscale noise image."""
+    writer = PdfWriter()
+    for _ in range(num_pages):
+        image = DecodedStreamObject()
+        image.set_data(os.urandom(image_side * image_side))
+        image.update(
+            {
+                NameObject("/Type"): NameObject("/XObject"),
+                NameObject("/Subtype"): NameObject("/Image"),
+                NameObject("/Width"): NumberObject(image_side),
+                NameObject("/Height"): NumberObject(image_side),
+                NameObject("/ColorSpace"): NameObject("/DeviceGray"),
+                NameObject("/BitsPerComponent"): NumberObject(8),
+            }
+        )
+        content = DecodedStreamObject()
+        content.set_data(b"q 612 0 0 792 0 0 cm /Im0 Do Q")
+        page = writer.add_blank_page(612, 792)
+        page[NameObject("/Resources")] = DictionaryObject(
+            {
+                NameObject("/XObject"): DictionaryObject(
+                    {NameObject("/Im0"): writer._add_object(image)}
+                )
+            }
+        )
+        page[NameObject("/Contents")] = writer._add_object(content)
+    writer.write(path)
+
+
+def fake_document_ai(content: bytes, mime_type: str | None = None) -> Document:
+    """Return one line of text per page, with page anchors, without any OCR."""
+    num_pages = len(PdfReader(BytesIO(content)).pages)
+    text = ""
+    pages = []
+    for i in range(num_pages):
+        line = f"page {i}\n"
+        segment = Document.TextAnchor.TextSegment(
+            start_index=len(text), end_index=len(text) + len(line)
+        )
+        pages.append(
+            Document.Page(
+                layout=Document.Page.Layout(
+                    text_anchor=Document.TextAnchor(text_segments=[segment])
+                )
+            )
+        )
+        text += line
+    return Document(text=text, pages=pages)
+
+
+def peak_rss_mb() -> float:
+    """
+    Peak resident memory of this process. VmHWM is preferred to ru_maxrss, which is
+    kept across exec and so would include the parent that generated the PDF.
+    """
+    with open("/proc/self/status") as fh:
+        for line in fh:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) / 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_child(path: Path, chunk_size: int, chunk_max_bytes: int) -> None:
+    started = time.perf_counter()
+    result = pdf_pages(
+        path,
+        fake_document_ai,
+        chunk_size=chunk_size,
+        chunk_max_bytes=chunk_max_bytes,
+    )
+    seconds = time.perf_counter() - started
+    print(f"{len(result.texts)}\t{seconds:.2f}\t{peak_rss_mb():.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pages", type=int, nargs="+", default=[100, 500, 1000])
+    parser.add_argument("--image-side", type=int, default=320)
+    parser.add_argument("--chunk-size", type=int, default=10)
+    parser.add_argument("--chunk-max-bytes", type=int, default=20 * 1024 * 1024)
+    parser.add_argument("--child", type=str, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(Path(args.child), args.chunk_size, args.chunk_max_bytes)
+        sys.exit(0)
+
+    from loguru import logger
+
+    logger.remove()
+    print("pages\tfile_mb\tseconds\tpeak_rss_mb")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for num_pages in args.pages:
+            path = Path(tmp_dir) / f"{num_pages}.pdf"
+            write_image_pdf(path, num_pages, args.image_side)
+            file_mb = path.stat().st_size / 1024 / 1024
+            out = subprocess.run(
+                [
+                    sys.executable,
+                    "-m",
+                    "benchmarks.pdf_split_memory",
+                    "--child",
+                    str(path),
+                    "--chunk-size",
+                    str(args.chunk_size),
+                    "--chunk-max-bytes",
+                    str(args.chunk_max_bytes),
+                ],
+                capture_output=True,
+                text=True,
+                check=True,
+            ).stdout.strip()
+            _, seconds, peak_mb = out.splitlines()[-1].split("\t")
+            print(f"{num_pages}\t{file_mb:.1f}\t{seconds}\t{peak_mb}")
+            path.unlink()
@@ -0,0 +1,266 @@
+"""
+Benchmark the whole pipeline offline, on synthetic records of increasing length, with
+fake DocumentAI and LLM backends of configurable latency.
+
+Each record runs in a fresh subprocess, so its peak RSS is measured on its own, and the
+wall time, OCR and LLM calls and peak memory are reported per number of pages:
+
+    python -m benchmarks.pipeline --pages 60 600 2000 10000
+    python -m benchmarks.pipeline --pages 600 --llm-latency 0.5 --tokens-per-second 50
+    python -m benchmarks.pipeline --pages 600 --llm-latency 0.5 --tokens-per-second 50 --no-prefetch
+    python -m benchmarks.pipeline --pages 600 --prefill-tokens-per-second 2000 --prefix-cache
+
+Real responses can be recorded once, and then replayed without network access:
+
+    python -m benchmarks.pipeline --pdf data/sample.pdf --record .cache/recording
+    python -m benchmarks.pipeline --pdf data/sample.pdf --replay .cache/recording
+"""
+
+import argparse
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Generator, List, Optional, Tuple
+
+from benchmarks.fakes import (
+    RecordingCompletionService,
+    RecordingDocumentAI,
+    load_page_texts,
+    load_responses,
+)
+from benchmarks.pdf_split_memory import peak_rss_mb
+from benchmarks.synthetic import synthetic_record, write_record_pdf
+from src.fakes import FakeCompletionService, FakeDocumentAI
+from src.llm import CompletionService, LLMApi
+from src.models import MedicalEncounter
+from src.pdf import OCRClient
+from src.record import (
+    EncounterPrefetcher,
+    RecordSplit,
+    iter_parsed_encounters,
+    split_record,
+)
+
+
+def run_pipeline(
+    pdf_path: Path,
+    document_ai: OCRClient,
+    completion_service: CompletionService,
+    max_workers: int = 8,
+    fused: bool = False,
+    dedup: bool = True,
+    presegment: bool = True,
+    prefetch: bool = True,
+) -> Tuple[RecordSplit, List[MedicalEncounter]]:
+    """
+    Split and parse a PDF with the given backends, without caches, so that every run
+    does the same work.
+    """
+    llm = LLMApi(api_type="fake", completion_service=completion_service)
+    prefetcher = EncounterPrefetcher(llm, max_workers, fused) if prefetch else None
+    split = split_record(
+        llm,
+        str(pdf_path),
+        max_workers=max_workers,
+        dedup=dedup,
+        presegment=presegment,
+        document_ai=document_ai,
+        prefetcher=prefetcher,
+    )
+    encounters = list(
+        iter_parsed_encounters(
+            llm,
+            split.encounters_lines,
+            split.encounter_duplicates,
+            max_workers,
+            fused,
+            prefetcher=prefetcher,
+        )
+    )
+    return split, encounters
+
+
+def run_child(args: argparse.Namespace) -> None:
+    document_ai = FakeDocumentAI(
+        load_page_texts(args.page_texts),
+        latency_seconds=args.ocr_latency,
+        seconds_per_page=args.ocr_seconds_per_page,
+    )
+    responses: Optional[dict] = None
+    if args.responses:
+        responses = load_responses(args.responses)
+    completion_service = FakeCompletionService(
+        responses,
+        strict=responses is not None,
+        latency_seconds=args.llm_latency,
+        tokens_per_second=args.tokens_per_second,
+        prefill_tokens_per_second=args.prefill_tokens_per_second,
+        prefix_cache=args.prefix_cache,
+    )
+    started = time.perf_counter()
+    split, encounters = run_pipeline(
+        Path(args.pdf),
+        document_ai,
+        completion_service,
+        max_workers=args.max_workers,
+        fused=args.fused,
+        dedup=not args.no_dedup,
+        presegment=not args.no_presegment,
+        prefetch=not args.no_prefetch,
+    )
+    seconds = time.perf_counter() - started
+    print(
+        f"{len(split.page_lengths)}\t{seconds:.2f}\t{document_ai.calls}\t{completion_service.calls}"
+        f"\t{completion_service.prompt_tokens}\t{completion_service.cached_prompt_tokens}"
+        f"\t{len(encounters)}\t{peak_rss_mb():.1f}"
+    )
+
+
+def child_command(args: argparse.Namespace, pdf: Path, page_texts: Path) -> List[str]:
+    command = [
+        sys.executable,
+        "-m",
+        "benchmarks.pipeline",
+        "--child",
+        "--pdf",
+        str(pdf),
+        "--page-texts",
+        str(page_texts),
+        "--ocr-latency",
+        str(args.ocr_latency),
+        "--ocr-seconds-per-page",
+        str(args.ocr_seconds_per_page),
+        "--llm-latency",
+        str(args.llm_latency),
+        "--max-workers",
+        str(args.max_workers),
+    ]
+    if args.tokens_per_second:
+        command += ["--tokens-per-second", str(args.tokens_per_second)]
+    if args.prefill_tokens_per_second:
+        command += [
+            "--prefill-tokens-per-second",
+            str(args.prefill_tokens_per_second),
+        ]
+    if args.replay:
+        command += ["--responses", str(Path(args.replay) / "responses.jsonl")]
+    for flag in ["fused", "no_dedup", "no_presegment", "no_prefetch", "prefix_cache"]:
+        if getattr(args, flag):
+            command.append(f"--{flag.replace('_', '-')}")
+    return command
+
+
+def record(args: argparse.Namespace) -> None:
+    """Parse a PDF with the real backends, saving their responses for replay."""
+    from src.pdf import DocumentAI
+
+    recording = Path(args.record)
+    started = time.perf_counter()
+    split, encounters = run_pipeline(
+        Path(args.pdf),
+        RecordingDocumentAI(DocumentAI(), recording / "pages.jsonl"),
+        RecordingCompletionService(
+            LLMApi(args.api_type).completion_service, recording / "responses.jsonl"
+        ),
+        max_workers=args.max_workers,
+        fused=args.fused,
+        dedup=not args.no_dedup,
+        presegment=not args.no_presegment,
+    )
+    print(
+        f"recorded {len(split.page_lengths)} pages and {len(encounters)} encounters "
+        f"in {time.perf_counter() - started:.2f}s to {recording}"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pages", type=int, nargs="+", default=[60, 600, 2000])
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--native-fraction", type=float, default=0.2)
+    parser.add_argument("--resent-fraction", type=float, default=0.02)
+    parser.add_argument("--image-side", type=int, default=64)
+    parser.add_argument("--ocr-latency", type=float, default=0.0)
+    parser.add_argument("--ocr-seconds-per-page", type=float, default=0.0)
+    parser.add_argument("--llm-latency", type=float, default=0.0)
+    parser.add_argument("--tokens-per-second", type=float)
+    parser.add_argument("--prefill-tokens-per-second", type=float)
+    parser.add_argument(
+        "--prefix-cache",
+        action="store_true",
+        help="simulate a provider prompt cache, reusing system messages sent before",
+    )
+    parser.add_argument("--max-workers", type=int, default=8)
+    parser.add_argument("--fused", action="store_true")
+    parser.add_argument("--no-dedup", action="store_true")
+    parser.add_argument("--no-presegment", action="store_true")
+    parser.add_argument("--no-prefetch", action="store_true")
+    parser.add_argument("--pdf", type=str, help="benchmark a real PDF, recorded or replayed")
+    parser.add_argument("--record", type=str, help="directory to record responses to")
+    parser.add_argument("--replay", type=str, help="directory to replay responses from")
+    parser.add_argument("--api-type", type=str, default="openai")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--page-texts", type=str, help=argparse.SUPPRESS)
+    parser.add_argument("--responses", type=str, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if not args.child and bool(args.pdf) != bool(args.record or args.replay):
+        parser.error("--pdf needs one of --record or --replay, and they need --pdf")
+
+    from loguru import logger
+
+    logger.remove()
+
+    if args.child:
+        run_child(args)
+        sys.exit(0)
+    if args.record:
+        record(args)
+        sys.exit(0)
+
+    print(
+        "pages\tfile_mb\tseconds\tms_per_page\tocr_calls\tllm_calls\tprompt_ktokens\tcached_ktokens\tencounters\tpeak_rss_mb"
+    )
+    with tempfile.TemporaryDirectory() as tmp_dir:
+
+        def inputs() -> Generator[Tuple[Path, Path], None, None]:
+            if args.pdf:
+                yield Path(args.pdf), Path(args.replay) / "pages.jsonl"
+                return
+            for num_pages in args.pages:
+                path = Path(tmp_dir) / f"{num_pages}.pdf"
+                page_texts = write_record_pdf(
+                    path,
+                    synthetic_record(num_pages, args.seed, args.resent_fraction),
+                    native_fraction=args.native_fraction,
+                    image_side=args.image_side,
+                    seed=args.seed,
+                )
+                yield path, page_texts
+                path.unlink()
+                page_texts.unlink()
+
+        for path, page_texts in inputs():
+            file_mb = path.stat().st_size / 1024 / 1024
+            out = subprocess.run(
+                child_command(args, path, page_texts),
+                stdout=subprocess.PIPE,
+                text=True,
+                check=True,
+            ).stdout.strip()
+            (
+                num_pages,
+                seconds,
+                ocr_calls,
+                llm_calls,
+                prompt_tokens,
+                cached_tokens,
+                encounters,
+                rss,
+            ) = out.splitlines()[-1].split("\t")
+            print(
+                f"{num_pages}\t{file_mb:.1f}\t{seconds}\t{float(seconds) * 1000 / int(num_pages):.1f}"
+                f"\t{ocr_calls}\t{llm_calls}\t{int(prompt_tokens) / 1000:.0f}"
+                f"\t{int(cached_tokens) / 1000:.0f}\t{encounters}\t{rss}"
+            )
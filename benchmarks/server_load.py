@@ -0,0 +1,137 @@
+"""
+Load test the extraction server offline, with fake backends and synthetic records.
+
+Clients submit records over HTTP, wait out 429 responses as told by Retry-After, and
+stream each record's encounters. Reports throughput, job latency and refused submissions:
+
+    python -m benchmarks.server_load --records 40 --pages 60 --clients 8 --workers 4
+"""
+
+import argparse
+import http.client
+import json
+import statistics
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Tuple
+
+from benchmarks.fakes import load_page_texts
+from benchmarks.synthetic import synthetic_record, write_record_pdf
+from src.fakes import FakeCompletionService, FakeDocumentAI
+from src.llm import LLMApi
+from src.server import ExtractionHTTPServer, ExtractionService
+
+
+def run_client(
+    port: int, pdf: bytes, retry_scale: float, refused: list
+) -> Tuple[float, int]:
+    """
+    Submit a record and stream its encounters. Returns the seconds taken and the number
+    of encounters, and appends to `refused` each time the submission is refused.
+    """
+    started = time.perf_counter()
+    conn = http.client.HTTPConnection("127.0.0.1", port)
+    while True:
+        conn.request(
+            "POST", "/jobs", body=pdf, headers={"Content-Type": "application/pdf"}
+        )
+        res = conn.getresponse()
+        body = json.loads(res.read())
+        if res.status != 429:
+            break
+        refused.append(1)
+        time.sleep(float(res.getheader("Retry-After", "1")) / retry_scale)
+    assert res.status == 202, body
+
+    conn.request("GET", f"/jobs/{body['id']}/encounters")
+    res = conn.getresponse()
+    num_encounters = sum(1 for line in res.read().splitlines() if line)
+    conn.request("GET", f"/jobs/{body['id']}")
+    res = conn.getresponse()
+    info = json.loads(res.read())
+    assert info["status"] == "done", info
+    conn.close()
+    return time.perf_counter() - started, num_encounters
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--records", type=int, default=40)
+    parser.add_argument("--pages", type=int, default=60)
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--queue-size", type=int, default=2)
+    parser.add_argument("--max-workers", type=int, default=8)
+    parser.add_argument("--llm-latency", type=float, default=0.0)
+    parser.add_argument("--ocr-latency", type=float, default=0.0)
+    # Retry-After is in whole seconds, so clients can be told to wait less in a short test
+    parser.add_argument("--retry-scale", type=float, default=10.0)
+    args = parser.parse_args()
+
+    from loguru import logger
+
+    logger.remove()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # distinct records, so the fake LLM does the full work for each
+        pdfs = []
+        page_texts = {}
+        for seed in range(args.records):
+            path = Path(tmp_dir) / f"{seed}.pdf"
+            texts_path = write_record_pdf(
+                path, synthetic_record(args.pages, seed), native_fraction=0.2, seed=seed
+            )
+            page_texts.update(load_page_texts(texts_path))
+            pdfs.append(path.read_bytes())
+
+        started = time.perf_counter()
+        service = ExtractionService(
+            LLMApi(
+                api_type="fake",
+                completion_service=FakeCompletionService(
+                    latency_seconds=args.llm_latency
+                ),
+            ),
+            document_ai=FakeDocumentAI(page_texts, latency_seconds=args.ocr_latency),
+            num_workers=args.workers,
+            queue_size=args.queue_size,
+            max_workers=args.max_workers,
+            upload_dir=Path(tmp_dir) / "uploads",
+        )
+        service.start()
+        warm_up_seconds = time.perf_counter() - started
+        server = ExtractionHTTPServer(("127.0.0.1", 0), service)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        port = server.server_address[1]
+
+        refused: list = []
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.clients) as executor:
+            results = list(
+                executor.map(
+                    lambda pdf: run_client(port, pdf, args.retry_scale, refused), pdfs
+                )
+            )
+        elapsed = time.perf_counter() - started
+        server.shutdown()
+        stats = service.stats()
+        service.stop()
+
+    latencies = sorted(seconds for seconds, _ in results)
+    print(f"warm up: {warm_up_seconds:.2f}s")
+    print(
+        f"{args.records} records of {args.pages} pages in {elapsed:.2f}s "
+        f"[records_per_minute={args.records / elapsed * 60:.1f}]"
+        f"[encounters={sum(n for _, n in results)}]"
+    )
+    print(
+        f"job latency [p50={statistics.median(latencies):.2f}s]"
+        f"[p95={latencies[int(0.95 * (len(latencies) - 1))]:.2f}s]"
+        f"[max={latencies[-1]:.2f}s]"
+    )
+    print(
+        f"refused submissions: {len(refused)} [done_jobs={stats.done_jobs}][failed_jobs={stats.failed_jobs}]"
+    )
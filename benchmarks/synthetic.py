@@ -0,0 +1,237 @@
+"""
+Generate synthetic medical records of any length from the pages of data/pdf-text.txt.
+
+The first copy of the sample record is kept as is. Each later copy shifts its dates and
+swaps the words of its free text for other words of the sample, so that its pages have
+the same layout, fax headers and encounter titles as the sample but are not duplicates
+of it. A fraction of pages are resent copies of earlier pages, as in real faxed records.
+
+The PDF is written with scanned-looking image pages, and optionally some pages with a
+text layer, together with a JSONL file of the text of each page by page hash, which
+`src.fakes.FakeDocumentAI` returns as its OCR text.
+"""
+
+import json
+import os
+import random
+import re
+from datetime import date, timedelta
+from pathlib import Path
+from typing import Dict, List
+
+from pydantic import BaseModel
+from pypdf import PdfReader, PdfWriter
+from pypdf.generic import DecodedStreamObject, DictionaryObject, NameObject, NumberObject
+
+from src.dedup import FAX_HEADER_RE
+from src.fakes import sample_pages
+from src.pdf import page_fingerprint, release_page_data
+from src.segment import PAGE_HEADER_RE, score_lines
+
+FAX_PAGE_NUMBER_RE = re.compile(r"PAGE(\s+)\d+/\d+")
+DATE_RE = re.compile(r"\b(\d{1,2})/(\d{1,2})/(\d{4}|\d{2})\b")
+WORD_RE = re.compile(r"[A-Za-z]{4,}")
+
+# days the dates of each copy of the sample are moved on from the copy before
+DAYS_PER_COPY = 97
+
+
+class SyntheticRecord(BaseModel):
+    texts: List[str]
+    # page index -> index of the earlier page it is a resent copy of
+    resent_pages: Dict[int, int] = {}
+
+
+def is_structural(line: str, score: float) -> bool:
+    """Whether a line is a header or title whose words must be kept."""
+    return bool(
+        score > 0
+        or (line.strip() and FAX_HEADER_RE.match(line))
+        or PAGE_HEADER_RE.match(line)
+    )
+
+
+def shift_dates(line: str, days: int) -> str:
+    def shift(m: re.Match) -> str:
+        month, day, year = m.groups()
+        full_year = int(year) if len(year) == 4 else 2000 + int(year)
+        try:
+            shifted = date(full_year, int(month), int(day)) + timedelta(days=days)
+        except ValueError:
+            return m.group()
+        new_year = str(shifted.year) if len(year) == 4 else f"{shifted.year % 100:02}"
+        new_month = f"{shifted.month:0{len(month)}}"
+        new_day = f"{shifted.day:0{len(day)}}"
+        return f"{new_month}/{new_day}/{new_year}"
+
+    return DATE_RE.sub(shift, line)
+
+
+def swap_words(line: str, words: Dict[str, str]) -> str:
+    def swap(m: re.Match) -> str:
+        word = m.group()
+        new_word = words.get(word.lower(), word)
+        if word.isupper():
+            return new_word.upper()
+        if word[0].isupper():
+            return new_word.capitalize()
+        return new_word
+
+    return WORD_RE.sub(swap, line)
+
+
+def copy_pages(pages: List[str], copy: int, seed: int) -> List[str]:
+    """
+    Return the `copy`th variation of the sample pages, with moved dates and swapped words.
+    """
+    if copy == 0:
+        return pages
+    lines_scores = [
+        (lines, score_lines(lines)) for lines in (page.splitlines() for page in pages)
+    ]
+    vocabulary = sorted(
+        {
+            word.lower()
+            for lines, scores in lines_scores
+            for line, score in zip(lines, scores)
+            if not is_structural(line, score)
+            for word in WORD_RE.findall(line)
+        }
+    )
+    shuffled = list(vocabulary)
+    random.Random(seed * 1_000_003 + copy).shuffle(shuffled)
+    words = dict(zip(vocabulary, shuffled))
+
+    new_pages = []
+    for lines, scores in lines_scores:
+        new_lines = []
+        for line, score in zip(lines, scores):
+            if not is_structural(line, score):
+                line = swap_words(line, words)
+            new_lines.append(shift_dates(line, copy * DAYS_PER_COPY))
+        new_pages.append("\n".join(new_lines) + "\n")
+    return new_pages
+
+
+def synthetic_record(
+    num_pages: int, seed: int = 0, resent_fraction: float = 0.02
+) -> SyntheticRecord:
+    """
+    Return a record of `num_pages` pages made of variations of the sample record, in
+    which about `resent_fraction` of the pages are resent copies of an earlier page.
+    """
+    pages = sample_pages()
+    rng = random.Random(seed)
+    copies: Dict[int, List[str]] = {}
+    texts: List[str] = []
+    resent_pages: Dict[int, int] = {}
+    for i in range(num_pages):
+        if i > 0 and rng.random() < resent_fraction:
+            first = rng.randrange(i)
+            first = resent_pages.get(first, first)
+            resent_pages[i] = first
+            texts.append(texts[first])
+            continue
+        copy, index = divmod(i - len(resent_pages), len(pages))
+        if copy not in copies:
+            copies = {copy: copy_pages(pages, copy, seed)}
+        text = copies[copy][index]
+        texts.append(
+            FAX_PAGE_NUMBER_RE.sub(
+                lambda m: f"PAGE{m.group(1)}{i + 1}/{num_pages:03}", text, count=1
+            )
+        )
+    return SyntheticRecord(texts=texts, resent_pages=resent_pages)
+
+
+def text_content(text: str) -> bytes:
+    """A page content stream drawing the lines of `text` in Helvetica."""
+    lines = text.splitlines()
+    leading = min(10.0, 756 / max(len(lines), 1))
+    ops = [f"BT /F1 {leading * 0.8:.2f} Tf {leading:.2f} TL 36 770 Td"]
+    for line in lines:
+        encoded = line.encode("cp1252", errors="replace").decode("latin-1")
+        escaped = encoded.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+        ops.append(f"({escaped}) Tj T*")
+    ops.append("ET")
+    return "\n".join(ops).encode("latin-1")
+
+
+def write_record_pdf(
+    path: Path,
+    record: SyntheticRecord,
+    native_fraction: float = 0.0,
+    image_side: int = 64,
+    seed: int = 0,
+) -> Path:
+    """
+    Write the record as a PDF of image pages, with about `native_fraction` of its pages
+    holding a text layer instead, and the text of each page by page hash to a JSONL file
+    next to it, for the pages OCR'd. Returns the path of the JSONL file.
+    """
+    rng = random.Random(seed)
+    writer = PdfWriter()
+    font = writer._add_object(
+        DictionaryObject(
+            {
+                NameObject("/Type"): NameObject("/Font"),
+                NameObject("/Subtype"): NameObject("/Type1"),
+                NameObject("/BaseFont"): NameObject("/Helvetica"),
+                NameObject("/Encoding"): NameObject("/WinAnsiEncoding"),
+            }
+        )
+    )
+    image_content = DecodedStreamObject()
+    image_content.set_data(b"q 612 0 0 792 0 0 cm /Im0 Do Q")
+    image_content_ref = writer._add_object(image_content)
+
+    page_resources: List[DictionaryObject] = []
+    page_contents: List = []
+    for i, text in enumerate(record.texts):
+        page = writer.add_blank_page(612, 792)
+        first = record.resent_pages.get(i)
+        if first is not None:
+            resources, content = page_resources[first], page_contents[first]
+        elif rng.random() < native_fraction:
+            stream = DecodedStreamObject()
+            stream.set_data(text_content(text))
+            resources = DictionaryObject(
+                {NameObject("/Font"): DictionaryObject({NameObject("/F1"): font})}
+            )
+            content = writer._add_object(stream)
+        else:
+            # noise, so that every scanned page has its own hash
+            image = DecodedStreamObject()
+            image.set_data(os.urandom(image_side * image_side))
+            image.update(
+                {
+                    NameObject("/Type"): NameObject("/XObject"),
+                    NameObject("/Subtype"): NameObject("/Image"),
+                    NameObject("/Width"): NumberObject(image_side),
+                    NameObject("/Height"): NumberObject(image_side),
+                    NameObject("/ColorSpace"): NameObject("/DeviceGray"),
+                    NameObject("/BitsPerComponent"): NumberObject(8),
+                }
+            )
+            resources = DictionaryObject(
+                {
+                    NameObject("/XObject"): DictionaryObject(
+                        {NameObject("/Im0"): writer._add_object(image)}
+                    )
+                }
+            )
+            content = image_content_ref
+        page[NameObject("/Resources")] = resources
+        page[NameObject("/Contents")] = content
+        page_resources.append(resources)
+        page_contents.append(content)
+    writer.write(path)
+
+    pages_path = path.with_suffix(".pages.jsonl")
+    with open(path, "rb") as fh, open(pages_path, "w", encoding="utf-8") as out:
+        reader = PdfReader(fh)
+        for page, text in zip(reader.pages, record.texts):
+            page_hash, _ = page_fingerprint(page)
+            out.write(json.dumps({"hash": page_hash, "text": text}) + "\n")
+            release_page_data(reader)
+    return pages_path
@@ -0,0 +1,138 @@
+import argparse
+import signal
+
+from loguru import logger
+
+from src.cli import add_pipeline_args
+from src.llm import RoutingConfig, llm_completion_config_map, routing_from_args
+
+
+def main(
+    host: str = "127.0.0.1",
+    port: int = 8000,
+    socket_path: str | None = None,
+    api_type: str = "openai",
+    requests_per_minute: int | None = None,
+    tokens_per_minute: int | None = None,
+    cache: bool = True,
+    fake_backends: bool = False,
+    fake_llm_latency: float = 0.0,
+    fake_ocr_latency: float = 0.0,
+    routing: RoutingConfig | None = None,
+    **kwargs,
+):
+    """
+    Serve the extraction API over HTTP, or over a Unix socket if `socket_path` is given,
+    until interrupted. Keyword arguments are passed on to ExtractionService.
+    """
+    from src.llm import LLMApi, RateLimiter, ResponseCache
+    from src.ocr_cache import OCRCache
+    from src.server import ExtractionHTTPServer, ExtractionService, ExtractionUnixServer
+
+    document_ai = None
+    completion_service = None
+    if fake_backends:
+        # offline stand-ins, so the server can be run and load tested without credentials
+        from src.fakes import fake_backends as make_fake_backends
+
+        document_ai, completion_service = make_fake_backends(
+            fake_llm_latency, fake_ocr_latency
+        )
+
+    service = ExtractionService(
+        LLMApi(
+            api_type=api_type,
+            rate_limiter=RateLimiter(requests_per_minute, tokens_per_minute),
+            cache=ResponseCache() if cache and not fake_backends else None,
+            completion_service=completion_service,
+            routing=routing,
+        ),
+        document_ai=document_ai,
+        ocr_cache=OCRCache() if cache and not fake_backends else None,
+        **kwargs,
+    )
+    service.start()
+    if socket_path is not None:
+        server = ExtractionUnixServer(socket_path, service)
+        logger.info(f"serving on unix socket {socket_path}")
+    else:
+        server = ExtractionHTTPServer((host, port), service)
+        logger.info(f"serving on http://{host}:{server.server_address[1]}")
+
+    def interrupt(signum, frame):
+        raise KeyboardInterrupt
+
+    # stop as on Ctrl-C when asked to by a process manager
+    signal.signal(signal.SIGTERM, interrupt)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument(
+        "--socket",
+        metavar="path",
+        type=str,
+        default=None,
+        help="Serve on a Unix socket at this path instead of over TCP",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=2,
+        help="Number of records to parse at once",
+    )
+    parser.add_argument(
+        "--queue-size",
+        type=int,
+        default=8,
+        help="Number of records that may wait for a worker before submissions are refused",
+    )
+    parser.add_argument(
+        "--api-type",
+        type=str,
+        default="openai",
+        choices=sorted(llm_completion_config_map),
+        help="LLM backend to use",
+    )
+    parser.add_argument(
+        "--max-workers",
+        type=int,
+        default=8,
+        help="Number of encounters of each record to parse at once",
+    )
+    add_pipeline_args(parser, "workers")
+    parser.add_argument(
+        "--fake-backends",
+        action="store_true",
+        help="Use offline fakes of DocumentAI and the LLM, for testing",
+    )
+    parser.add_argument("--fake-llm-latency", type=float, default=0.0)
+    parser.add_argument("--fake-ocr-latency", type=float, default=0.0)
+    args = parser.parse_args()
+    routing = routing_from_args(parser, args)
+    main(
+        host=args.host,
+        port=args.port,
+        socket_path=args.socket,
+        api_type=args.api_type,
+        requests_per_minute=args.requests_per_minute,
+        routing=routing,
+        tokens_per_minute=args.tokens_per_minute,
+        cache=not args.no_cache,
+        fake_backends=args.fake_backends,
+        fake_llm_latency=args.fake_llm_latency,
+        fake_ocr_latency=args.fake_ocr_latency,
+        num_workers=args.workers,
+        queue_size=args.queue_size,
+        max_workers=args.max_workers,
+        fused=args.fused,
+    )
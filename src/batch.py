@@ -0,0 +1,376 @@
+import hashlib
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from typing import Callable, Dict, List, Literal, Optional, Tuple
+
+from loguru import logger
+from pydantic import BaseModel
+
+from .llm import (
+    FAST_TIER_SPAN,
+    CompletionService,
+    LLMApi,
+    ResponseCache,
+    RoutingConfig,
+    SharedRateLimiter,
+)
+from .models import MedicalRecord
+from .ocr_cache import OCRCache
+from .pdf import OCRClient, ResilientOCRClient
+from .record import EncounterPrefetcher, iter_parsed_encounters, split_record
+from .telemetry import telemetry
+
+# US dollars per million prompt and completion tokens, by model
+MODEL_PRICES: Dict[str, Tuple[float, float]] = {
+    "gpt-4-turbo": (10.0, 30.0),
+    "gpt-4o": (5.0, 15.0),
+    "gpt-4o-mini": (0.15, 0.6),
+}
+
+# US dollars per page read by DocumentAI's OCR processor
+OCR_PRICE_PER_PAGE = 1.5 / 1000
+
+# share of the model price paid for tokens sent through a batch API
+BATCH_API_PRICE_FACTOR = 0.5
+
+# returns the OCR client and completion service to use in place of the real ones
+BackendsFactory = Callable[[], Tuple[Optional[OCRClient], Optional[CompletionService]]]
+
+
+class BatchOptions(BaseModel):
+    api_type: str = "openai"
+    max_workers: int = 4
+    fused: bool = False
+    cache: bool = True
+    dedup: bool = True
+    presegment: bool = True
+    prefetch: bool = True
+    routing: Optional[RoutingConfig] = None
+
+
+class RecordResult(BaseModel):
+    path: str
+    output: str
+    status: Literal["done", "failed"]
+    seconds: float
+    model: Optional[str] = None
+    # whether the LLM was called through a deferred batch API, at a discount
+    batch_api: bool = False
+    num_pages: int = 0
+    num_encounters: int = 0
+    ocr_pages: int = 0
+    llm_calls: int = 0
+    prompt_tokens: int = 0
+    # prompt tokens read from the provider's prompt cache, if it reports them
+    cached_prompt_tokens: int = 0
+    completion_tokens: int = 0
+    # model of the fast tier, if routing is on, and the part of the usage above that
+    # went to it, which is priced at its own model's rate
+    fast_model: Optional[str] = None
+    fast_prompt_tokens: int = 0
+    fast_completion_tokens: int = 0
+    cost_usd: float = 0.0
+    error: Optional[str] = None
+
+
+class BatchReport(BaseModel):
+    done: int = 0
+    failed: int = 0
+    skipped: int = 0
+    seconds: float = 0.0
+    records_per_hour: float = 0.0
+    pages_per_hour: float = 0.0
+    num_pages: int = 0
+    ocr_pages: int = 0
+    llm_calls: int = 0
+    prompt_tokens: int = 0
+    cached_prompt_tokens: int = 0
+    completion_tokens: int = 0
+    cost_usd: float = 0.0
+
+    def summary(self) -> str:
+        cost_per_record = self.cost_usd / self.done if self.done else 0.0
+        return "\n".join(
+            [
+                f"records: {self.done} done, {self.failed} failed, {self.skipped} skipped from checkpoint",
+                f"time: {self.seconds:.1f}s [records_per_hour={self.records_per_hour:.1f}][pages_per_hour={self.pages_per_hour:.0f}]",
+                f"usage: {self.llm_calls} llm calls [prompt_tokens={self.prompt_tokens}][cached_prompt_tokens={self.cached_prompt_tokens}][completion_tokens={self.completion_tokens}][ocr_pages={self.ocr_pages}]",
+                f"cost: ${self.cost_usd:.2f} [per_record=${cost_per_record:.4f}]",
+            ]
+        )
+
+
+def list_pdfs(input_dir: str | Path) -> List[Path]:
+    return sorted(
+        path for path in Path(input_dir).rglob("*") if path.suffix.lower() == ".pdf"
+    )
+
+
+def read_manifest(manifest: str | Path) -> List[Path]:
+    """
+    Read PDF paths from a manifest, one per line, relative to the manifest's directory
+    unless absolute. Blank lines and lines starting with # are skipped.
+    """
+    manifest = Path(manifest)
+    paths = []
+    for line in manifest.read_text(encoding="utf-8").splitlines():
+        line = line.strip()
+        if line and not line.startswith("#"):
+            paths.append(manifest.parent / line)
+    return paths
+
+
+def output_path(
+    pdf: Path, output_dir: str | Path, input_dir: Optional[str | Path] = None
+) -> Path:
+    """
+    Where the result for a PDF is written: at the same relative path as in `input_dir`,
+    or else by file name, with a hash of the full path to tell same-named files apart.
+    """
+    if input_dir is not None:
+        return Path(output_dir) / pdf.relative_to(input_dir).with_suffix(".json")
+    digest = hashlib.sha1(str(pdf.resolve()).encode("utf-8")).hexdigest()[:8]
+    return Path(output_dir) / f"{pdf.stem}-{digest}.json"
+
+
+def load_checkpoint(path: str | Path) -> Dict[str, RecordResult]:
+    """Return the latest result of each PDF in a checkpoint file, by PDF path."""
+    results: Dict[str, RecordResult] = {}
+    if not Path(path).exists():
+        return results
+    with open(path, encoding="utf-8") as fh:
+        for line in fh:
+            if line.strip():
+                result = RecordResult.model_validate_json(line)
+                results[result.path] = result
+    return results
+
+
+def token_cost(
+    model: Optional[str], prompt_tokens: int, completion_tokens: int
+) -> float:
+    prompt_price, completion_price = MODEL_PRICES.get(model or "", (0.0, 0.0))
+    return (
+        prompt_tokens * prompt_price / 1e6 + completion_tokens * completion_price / 1e6
+    )
+
+
+def record_cost(result: RecordResult) -> float:
+    """
+    The cost of a record: the tokens of each tier at the price of its model, with the
+    batch API discount for the strong tier if it went through one, and the OCR'd pages.
+    """
+    strong_cost = token_cost(
+        result.model,
+        result.prompt_tokens - result.fast_prompt_tokens,
+        result.completion_tokens - result.fast_completion_tokens,
+    )
+    if result.batch_api:
+        strong_cost *= BATCH_API_PRICE_FACTOR
+    fast_cost = token_cost(
+        result.fast_model, result.fast_prompt_tokens, result.fast_completion_tokens
+    )
+    return strong_cost + fast_cost + result.ocr_pages * OCR_PRICE_PER_PAGE
+
+
+# state of a worker process, set up once by `init_worker`
+_worker_llm: Optional[LLMApi] = None
+_worker_document_ai: Optional[OCRClient] = None
+_worker_ocr_cache: Optional[OCRCache] = None
+_worker_options = BatchOptions()
+
+
+def init_worker(
+    rate_limiter: SharedRateLimiter,
+    options: BatchOptions,
+    backends: Optional[BackendsFactory] = None,
+) -> None:
+    """
+    Set up a worker process with the clients and caches it keeps for all its records.
+    """
+    global _worker_llm, _worker_document_ai, _worker_ocr_cache, _worker_options
+    document_ai, completion_service = (
+        backends() if backends is not None else (None, None)
+    )
+    if document_ai is None:
+        from .pdf import DocumentAI
+
+        document_ai = DocumentAI()
+    document_ai = ResilientOCRClient(document_ai)
+    _worker_llm = LLMApi(
+        api_type=options.api_type,
+        rate_limiter=rate_limiter,
+        cache=ResponseCache() if options.cache else None,
+        completion_service=completion_service,
+        routing=options.routing,
+    )
+    _worker_document_ai = document_ai
+    _worker_ocr_cache = OCRCache() if options.cache else None
+    _worker_options = options
+
+
+def process_record(pdf: str, output: str) -> RecordResult:
+    """
+    Parse one PDF in a worker process and write its MedicalRecord to `output`.
+    """
+    assert _worker_llm is not None, "init_worker was not called"
+    options = _worker_options
+    model = getattr(_worker_llm.completion_service.config, "model", None)
+    fast_model = None
+    if _worker_llm.fast_tier is not None:
+        fast_model = getattr(
+            _worker_llm.fast_tier.completion_service.config, "model", None
+        )
+    telemetry.reset()
+    started = time.perf_counter()
+    prefetcher = (
+        EncounterPrefetcher(_worker_llm, options.max_workers, options.fused)
+        if options.prefetch
+        else None
+    )
+    try:
+        split = split_record(
+            _worker_llm,
+            pdf,
+            ocr_cache=_worker_ocr_cache,
+            max_workers=options.max_workers,
+            dedup=options.dedup,
+            presegment=options.presegment,
+            document_ai=_worker_document_ai,
+            prefetcher=prefetcher,
+        )
+        record = MedicalRecord(
+            content=split.content,
+            encounters=list(
+                iter_parsed_encounters(
+                    _worker_llm,
+                    split.encounters_lines,
+                    split.encounter_duplicates,
+                    options.max_workers,
+                    options.fused,
+                    prefetcher=prefetcher,
+                )
+            ),
+            duplicate_pages=split.duplicate_pages,
+        )
+        output_path = Path(output)
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = output_path.with_suffix(f"{output_path.suffix}.tmp")
+        tmp_path.write_text(record.model_dump_json(), encoding="utf-8")
+        os.replace(tmp_path, output_path)
+        status, error = "done", None
+        num_pages, num_encounters = len(split.page_lengths), len(record.encounters)
+    except Exception as e:
+        logger.exception(f"failed to parse {pdf}")
+        status, error = "failed", f"{type(e).__name__}: {e}"
+        num_pages = num_encounters = 0
+    finally:
+        if prefetcher is not None:
+            prefetcher.close()
+
+    counters: Dict[str, float] = {}
+    stage_stats = telemetry.stats()
+    for stats in stage_stats.values():
+        for counter, value in stats.counters.items():
+            counters[counter] = counters.get(counter, 0) + value
+    fast_stats = stage_stats.get(FAST_TIER_SPAN)
+    fast_counters = fast_stats.counters if fast_stats is not None else {}
+    prompt_tokens = int(counters.get("prompt_tokens", 0))
+    completion_tokens = int(counters.get("completion_tokens", 0))
+    ocr_pages = int(counters.get("ocr_pages", 0))
+    return RecordResult(
+        path=pdf,
+        output=output,
+        status=status,
+        seconds=time.perf_counter() - started,
+        model=model,
+        batch_api=_worker_llm.completion_service.deferred,
+        num_pages=num_pages,
+        num_encounters=num_encounters,
+        ocr_pages=ocr_pages,
+        llm_calls=int(counters.get("llm_calls", 0)),
+        prompt_tokens=prompt_tokens,
+        cached_prompt_tokens=int(counters.get("cached_prompt_tokens", 0)),
+        completion_tokens=completion_tokens,
+        fast_model=fast_model,
+        fast_prompt_tokens=int(fast_counters.get("prompt_tokens", 0)),
+        fast_completion_tokens=int(fast_counters.get("completion_tokens", 0)),
+        error=error,
+    )
+
+
+def run_batch(
+    jobs: List[Tuple[Path, Path]],
+    checkpoint_path: str | Path,
+    processes: int = 4,
+    requests_per_minute: Optional[int] = None,
+    tokens_per_minute: Optional[int] = None,
+    options: Optional[BatchOptions] = None,
+    backends: Optional[BackendsFactory] = None,
+) -> BatchReport:
+    """
+    Parse each (pdf, output) job on a pool of `processes` worker processes, which share
+    one requests and tokens per minute budget.
+
+    The result of each record is appended to the checkpoint file as soon as it is done,
+    and records already done in it are skipped, so an interrupted batch can be resumed
+    by running it again. Failed records are retried.
+
+    With a deferred LLM backend such as "openai_batch", the prompts of every worker are
+    sent in shared batch jobs, and a record waits for a batch round trip per round of
+    prompts, so more `processes` and `options.max_workers` keep more records in flight,
+    and `options.fused` saves rounds.
+    """
+    options = options or BatchOptions()
+    checkpoint_path = Path(checkpoint_path)
+    checkpoint_path.parent.mkdir(parents=True, exist_ok=True)
+    done_before = {
+        path
+        for path, result in load_checkpoint(checkpoint_path).items()
+        if result.status == "done" and Path(result.output).exists()
+    }
+    todo = [(pdf, output) for pdf, output in jobs if str(pdf) not in done_before]
+    report = BatchReport(skipped=len(jobs) - len(todo))
+    logger.info(
+        f"starting batch [num_records={len(todo)}][skipped={report.skipped}][processes={processes}]"
+    )
+
+    started = time.perf_counter()
+    rate_limiter = SharedRateLimiter(requests_per_minute, tokens_per_minute)
+    with ProcessPoolExecutor(
+        max_workers=processes,
+        initializer=init_worker,
+        initargs=(rate_limiter, options, backends),
+    ) as executor, open(checkpoint_path, "a", encoding="utf-8") as checkpoint:
+        futures = [
+            executor.submit(process_record, str(pdf), str(output))
+            for pdf, output in todo
+        ]
+        for future in as_completed(futures):
+            result = future.result()
+            # priced here rather than in the worker, so the prices can be set at runtime
+            result.cost_usd = record_cost(result)
+            checkpoint.write(f"{result.model_dump_json()}\n")
+            checkpoint.flush()
+            if result.status == "done":
+                report.done += 1
+            else:
+                report.failed += 1
+            report.num_pages += result.num_pages
+            report.ocr_pages += result.ocr_pages
+            report.llm_calls += result.llm_calls
+            report.prompt_tokens += result.prompt_tokens
+            report.cached_prompt_tokens += result.cached_prompt_tokens
+            report.completion_tokens += result.completion_tokens
+            report.cost_usd += result.cost_usd
+            logger.info(
+                f"finished {result.path} [status={result.status}][seconds={result.seconds:.1f}][progress={report.done + report.failed}/{len(todo)}]"
+            )
+
+    report.seconds = time.perf_counter() - started
+    if report.seconds > 0:
+        report.records_per_hour = report.done * 3600 / report.seconds
+        report.pages_per_hour = report.num_pages * 3600 / report.seconds
+    return report
@@ -0,0 +1,83 @@
+from typing import List, Tuple
+
+from .llm import estimate_tokens
+
+# a window of lines, as (start, end) indexes with `end` exclusive
+Window = Tuple[int, int]
+
+
+def token_windows(
+    lines: List[str],
+    max_tokens: int,
+    overlap_tokens: int = 0,
+    max_lines: int = 1000,
+) -> List[Window]:
+    """
+    Split lines into windows that each fill up to `max_tokens` tokens and `max_lines`
+    lines. Each window repeats the last `overlap_tokens` tokens worth of lines of the
+    window before it, so a boundary near the edge of one window is seen in full by the next.
+    """
+    line_tokens = [estimate_tokens(line) for line in lines]
+    windows: List[Window] = []
+    start = 0
+    while start < len(lines):
+        end = start
+        tokens = 0
+        while (
+            end < len(lines)
+            and end - start < max_lines
+            and (end == start or tokens + line_tokens[end] <= max_tokens)
+        ):
+            tokens += line_tokens[end]
+            end += 1
+        windows.append((start, end))
+        if end == len(lines):
+            break
+
+        # step back over the overlap, always moving forward by at least one line
+        next_start = end
+        overlap = 0
+        while (
+            next_start - 1 > start
+            and overlap + line_tokens[next_start - 1] <= overlap_tokens
+        ):
+            next_start -= 1
+            overlap += line_tokens[next_start]
+        start = next_start
+    return windows
+
+
+def reconcile_boundaries(
+    window_boundaries: List[Tuple[Window, List[int]]],
+    num_lines: int,
+    tolerance: int = 2,
+) -> List[int]:
+    """
+    Merge the boundary line indexes found in each window into one sorted list.
+
+    Indexes outside of their window are dropped. Where overlapping windows report the
+    same boundary, or boundaries within `tolerance` lines of each other, the index from
+    the window that saw it furthest from its edges, and so with most context, is kept.
+    """
+    candidates = []
+    for window_id, ((start, end), indexes) in enumerate(window_boundaries):
+        for i in set(indexes):
+            if start <= i < end and i < num_lines:
+                edge_distance = min(i - start, end - 1 - i)
+                candidates.append((i, edge_distance, window_id))
+    candidates.sort()
+
+    boundaries: List[int] = []
+    cluster: List[Tuple[int, int, int]] = []
+    for candidate in candidates:
+        # boundaries reported by the same window are distinct, however close
+        if cluster and (
+            candidate[0] - cluster[-1][0] > tolerance
+            or candidate[2] in {c[2] for c in cluster}
+        ):
+            boundaries.append(max(cluster, key=lambda c: c[1])[0])
+            cluster = []
+        cluster.append(candidate)
+    if cluster:
+        boundaries.append(max(cluster, key=lambda c: c[1])[0])
+    return boundaries
@@ -0,0 +1,38 @@
+import argparse
+from typing import Optional
+
+from .llm import add_routing_args
+
+
+def add_pipeline_args(
+    parser: argparse.ArgumentParser, budget_shared_by: Optional[str] = None
+) -> None:
+    """
+    Add the command line arguments shared by the entry points: the LLM's rate limit
+    budget, shared by all `budget_shared_by` if given, model routing, fused parsing and
+    caching.
+    """
+    shared = f", shared by all {budget_shared_by}" if budget_shared_by else ""
+    add_routing_args(parser)
+    parser.add_argument(
+        "--requests-per-minute",
+        type=int,
+        default=None,
+        help=f"LLM requests per minute budget{shared}",
+    )
+    parser.add_argument(
+        "--tokens-per-minute",
+        type=int,
+        default=None,
+        help=f"LLM tokens per minute budget{shared}",
+    )
+    parser.add_argument(
+        "--fused",
+        action="store_true",
+        help="Extract each encounter's fields with a single LLM call",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Do not reuse OCR text or LLM responses from previous runs",
+    )
@@ -0,0 +1,110 @@
+from bisect import bisect_right
+from typing import Dict, Generator, Iterable, List, Tuple
+
+from .chunking import Window
+from .models import (
+    CompactMedicalEncounter,
+    CompactMedicalRecord,
+    MedicalEncounter,
+    MedicalRecord,
+    TextSpan,
+)
+
+
+def page_offsets(page_lengths: List[int]) -> List[int]:
+    offsets = []
+    offset = 0
+    for length in page_lengths:
+        offsets.append(offset)
+        offset += length
+    return offsets
+
+
+def encounter_text_spans(
+    content: str,
+    page_lengths: List[int],
+    duplicate_pages: Dict[int, int],
+    encounter_spans: List[Window],
+) -> List[Tuple[List[TextSpan], List[int]]]:
+    """
+    Map the line span of each encounter, in the text of the record's distinct pages,
+    to the spans of the record content it covers and the pages it comes from.
+    """
+    offsets = page_offsets(page_lengths)
+    distinct = [i for i in range(len(page_lengths)) if i not in duplicate_pages]
+    # start of each distinct page in the text of the distinct pages
+    distinct_offsets = page_offsets([page_lengths[i] for i in distinct])
+    distinct_text = "".join(
+        content[offsets[i] : offsets[i] + page_lengths[i]] for i in distinct
+    )
+    line_offsets = [0]
+    for line in distinct_text.splitlines(keepends=True):
+        line_offsets.append(line_offsets[-1] + len(line))
+
+    results = []
+    for start_line, end_line in encounter_spans:
+        start, end = line_offsets[start_line], line_offsets[end_line]
+        spans: List[TextSpan] = []
+        pages: List[int] = []
+        k = max(bisect_right(distinct_offsets, start) - 1, 0)
+        while k < len(distinct) and distinct_offsets[k] < end:
+            page = distinct[k]
+            page_start = distinct_offsets[k]
+            page_end = page_start + page_lengths[page]
+            span_start = offsets[page] + max(start, page_start) - page_start
+            span_end = offsets[page] + min(end, page_end) - page_start
+            if span_start < span_end:
+                if spans and spans[-1][1] == span_start:
+                    spans[-1] = (spans[-1][0], span_end)
+                else:
+                    spans.append((span_start, span_end))
+                pages.append(page)
+            k += 1
+        results.append((spans, pages))
+    return results
+
+
+def compact_encounters(
+    content: str,
+    page_lengths: List[int],
+    duplicate_pages: Dict[int, int],
+    encounter_spans: List[Window],
+    encounters: Iterable[MedicalEncounter],
+) -> Generator[CompactMedicalEncounter, None, None]:
+    """
+    Replace the text of each encounter, as it is produced, with its spans of the record
+    content.
+    """
+    text_spans = encounter_text_spans(
+        content, page_lengths, duplicate_pages, encounter_spans
+    )
+    for (spans, pages), encounter in zip(text_spans, encounters):
+        yield CompactMedicalEncounter(
+            spans=spans,
+            pages=pages,
+            **encounter.model_dump(exclude={"content"}),
+        )
+
+
+def compact_record(
+    record: MedicalRecord, page_lengths: List[int], encounter_spans: List[Window]
+) -> CompactMedicalRecord:
+    """
+    Return the compact form of a record, from the text length of each of its pages
+    and the line span of each encounter in the text of its distinct pages.
+    """
+    return CompactMedicalRecord(
+        id=record.id,
+        content=record.content,
+        page_offsets=page_offsets(page_lengths),
+        encounters=list(
+            compact_encounters(
+                record.content,
+                page_lengths,
+                record.duplicate_pages,
+                encounter_spans,
+                record.encounters,
+            )
+        ),
+        duplicate_pages=record.duplicate_pages,
+    )
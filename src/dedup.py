@@ -0,0 +1,49 @@
+import hashlib
+import re
+from typing import Dict, List, Optional
+
+from pydantic import BaseModel
+
+# fax server stamps, e.g. "4/2/2024 1:22:35 PM EDT PAGE 2/060 Fax Server", which OCR
+# sometimes splits over two lines
+FAX_HEADER_RE = re.compile(
+    r"^\s*(\d{1,2}/\d{1,2}/\d{2,4} \d{1,2}:\d{2}(:\d{2})? [AP]M( [A-Z]{2,4})? PAGE)?"
+    r"\s*(\d+/\d+ Fax Server)?\s*$",
+    re.IGNORECASE,
+)
+
+
+class DedupReport(BaseModel):
+    duplicate_pages: Dict[int, int] = {}
+    duplicate_encounters: Dict[int, int] = {}
+
+
+def normalize_text(text: str) -> str:
+    """
+    Strip fax header lines and differences in case and whitespace from a text.
+    """
+    lines = [line for line in text.splitlines() if not FAX_HEADER_RE.match(line)]
+    return " ".join(" ".join(lines).lower().split())
+
+
+def find_duplicates(texts: List[str]) -> List[Optional[int]]:
+    """
+    For each text, return the index of the first earlier text it is a duplicate of, or
+    None. Empty texts are never duplicates.
+
+    Only texts that are the same after `normalize_text` are duplicates. Texts that are
+    merely similar, e.g. two visits of the same template on different dates, are kept
+    apart, since a duplicate is given a copy of its first text's parse.
+    """
+    canonical: List[Optional[int]] = [None] * len(texts)
+    first_by_hash: Dict[str, int] = {}
+    for i, text in enumerate(texts):
+        normalized = normalize_text(text)
+        if not normalized:
+            continue
+        digest = hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+        if digest in first_by_hash:
+            canonical[i] = first_by_hash[digest]
+        else:
+            first_by_hash[digest] = i
+    return canonical
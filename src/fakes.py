@@ -0,0 +1,287 @@
+"""
+Deterministic stand-ins for DocumentAI and the LLM completion services, for running the
+pipeline offline, as `serve.py` and `batch.py` do with `--fake-backends`.
+
+`FakeDocumentAI` returns known page texts, by page hash, and `FakeCompletionService`
+answers each prompt from rules, or with a recorded response, after a simulated latency.
+"""
+
+import json
+import re
+import threading
+import time
+from io import BytesIO
+from pathlib import Path
+from typing import Any, Dict, Generator, List, Optional, Set, Tuple
+
+from google.cloud.documentai_v1 import Document
+from pydantic import BaseModel
+from pypdf import PdfReader
+
+from .llm import CompletionService, ResponseCache
+from .llm.util import (
+    ChatMessageType,
+    estimate_messages_tokens,
+    estimate_tokens,
+    format_chat_message,
+    record_usage,
+)
+from .pdf import page_fingerprint
+from .segment import DATE, score_lines
+
+SAMPLE_TEXT_PATH = Path("./data/pdf-text.txt")
+
+# the fax header that starts every page of the sample record
+PAGE_START_RE = re.compile(r"(?=\d+/\d+/\d{4} [\d:]+ [AP]M EDT PAGE)")
+# the document in a prompt, between its heading and the next one
+PROMPT_DOC_RE = re.compile(r"## Medical (?:history|report)\n(.*?)\n\n## ", re.DOTALL)
+NUMBERED_LINE_RE = re.compile(r"^(\d{3}) (.*)$")
+DOB_DATE_RE = re.compile(rf"DOB:?\s*{DATE}", re.IGNORECASE)
+PRESCRIPTION_RE = re.compile(r"\b(mg|mcg|tablet|capsule|daily|twice)\b", re.IGNORECASE)
+
+
+def sample_pages(path: Path = SAMPLE_TEXT_PATH) -> List[str]:
+    """
+    Split the sample record into its pages, at each fax header.
+    """
+    pages = PAGE_START_RE.split(path.read_text(encoding="utf-8"))
+    # the fax cover title is cut off before the first header
+    if len(pages) > 1 and not PAGE_START_RE.match(pages[0]):
+        pages = [pages[0] + pages[1]] + pages[2:]
+    return [page if page.endswith("\n") else page + "\n" for page in pages]
+
+
+def page_document(texts: List[str]) -> Document:
+    """A Document of the page texts, with the page anchors `document_page_texts` splits on."""
+    text = ""
+    pages = []
+    for page_text in texts:
+        segment = Document.TextAnchor.TextSegment(
+            start_index=len(text), end_index=len(text) + len(page_text)
+        )
+        pages.append(
+            Document.Page(
+                layout=Document.Page.Layout(
+                    text_anchor=Document.TextAnchor(text_segments=[segment])
+                )
+            )
+        )
+        text += page_text
+    return Document(text=text, pages=pages)
+
+
+class FakeDocumentAI:
+    """
+    OCR client returning the known text of each page of a chunk, by page hash, after
+    `latency_seconds` per request and `seconds_per_page` per page. Unknown pages are an
+    error, or get one of `fallback_texts`, picked by page hash, if given.
+    """
+
+    def __init__(
+        self,
+        page_texts: Dict[str, str],
+        latency_seconds: float = 0.0,
+        seconds_per_page: float = 0.0,
+        fallback_texts: Optional[List[str]] = None,
+    ) -> None:
+        self.page_texts = page_texts
+        self.fallback_texts = fallback_texts
+        self.latency_seconds = latency_seconds
+        self.seconds_per_page = seconds_per_page
+        self.calls = 0
+        self.pages = 0
+        self._lock = threading.Lock()
+
+    def __call__(
+        self, content: bytes, mime_type: str | None = "application/pdf"
+    ) -> Document:
+        reader = PdfReader(BytesIO(content))
+        texts = []
+        for page in reader.pages:
+            page_hash, _ = page_fingerprint(page)
+            if page_hash in self.page_texts:
+                texts.append(self.page_texts[page_hash])
+            elif self.fallback_texts:
+                texts.append(
+                    self.fallback_texts[int(page_hash, 16) % len(self.fallback_texts)]
+                )
+            else:
+                raise KeyError(f"no text for page [hash={page_hash}]")
+        with self._lock:
+            self.calls += 1
+            self.pages += len(texts)
+        time.sleep(self.latency_seconds + self.seconds_per_page * len(texts))
+        return page_document(texts)
+
+
+def request_key(
+    messages: List[ChatMessageType],
+    temperature: Optional[float],
+    max_tokens: Optional[int],
+    top_p: Optional[float],
+    stop: Optional[List[str]],
+    kwargs: Dict[str, Any],
+) -> str:
+    """Key of a recorded response, from the request sent to the completion service."""
+    return ResponseCache.key(
+        messages=messages,
+        temperature=temperature,
+        max_tokens=max_tokens,
+        top_p=top_p,
+        stop=stop,
+        kwargs=kwargs,
+    )
+
+
+def fake_answer(messages: List[ChatMessageType], response_format: Any) -> str:
+    """
+    Answer a pipeline prompt from rules: encounter boundaries from the pre-segmentation
+    rules, the first date as the timestamp, and findings and prescriptions from the
+    first lines that look like them.
+    """
+    prompt = "\n\n".join(message["content"] for message in messages)
+    m = PROMPT_DOC_RE.search(prompt)
+    doc = m.group(1) if m else ""
+
+    if "new medical encounter" in prompt:
+        numbers, lines = [], []
+        for line in doc.splitlines():
+            numbered = NUMBERED_LINE_RE.match(line)
+            numbers.append(numbered.group(1) if numbered else "")
+            lines.append(numbered.group(2) if numbered else line)
+        return "\n".join(
+            number
+            for number, score in zip(numbers, score_lines(lines))
+            if number and score >= 0.5
+        )
+
+    lines = [line.strip() for line in doc.splitlines() if line.strip()]
+    dates = re.findall(DATE, DOB_DATE_RE.sub("", doc))
+    findings = [line for line in lines if len(line.split()) >= 6][:5]
+    prescriptions = [line for line in lines if PRESCRIPTION_RE.search(line)][:3]
+    if isinstance(response_format, dict):
+        month, day, year = dates[0].split("/") if dates else (None, None, None)
+        if year is not None and len(year) == 2:
+            year = f"20{year}"
+        return json.dumps(
+            {
+                "timestamp": f"{year}-{int(month):02}-{int(day):02}T00:00:00"
+                if year
+                else None,
+                "findings": findings,
+                "prescriptions": prescriptions,
+            }
+        )
+    if "datetime" in prompt:
+        return dates[0] if dates else "unknown"
+    if "prescription" in prompt:
+        return "\n".join(prescriptions)
+    return "\n".join(findings)
+
+
+class FakeServiceConfig(BaseModel):
+    model: str = "fake"
+    # time to the first token, and generation speed after it
+    latency_seconds: float = 0.0
+    tokens_per_second: Optional[float] = None
+    # speed of reading the prompt before the first token, if it takes any time
+    prefill_tokens_per_second: Optional[float] = None
+    # whether a system message seen before is read from a prompt cache, for free
+    prefix_cache: bool = False
+
+
+class FakeCompletionService(CompletionService):
+    """
+    Completion service answering each prompt with its recorded response in `responses`,
+    if any, or else from rules, after the simulated latency of `config`. With `strict`,
+    a prompt without a recorded response is an error.
+
+    With `prefix_cache`, a system message that was sent before counts as cached prompt
+    tokens, which take no prefill time, as with a provider's prompt caching.
+    """
+
+    def __init__(
+        self,
+        responses: Optional[Dict[str, ChatMessageType]] = None,
+        strict: bool = False,
+        **config: Any,
+    ) -> None:
+        self.config = FakeServiceConfig(**config)
+        self.responses = responses or {}
+        self.strict = strict
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.cached_prompt_tokens = 0
+        self.completion_tokens = 0
+        self._cached_prefixes: Set[str] = set()
+        self._lock = threading.Lock()
+
+    def _cached_tokens(self, messages: List[ChatMessageType]) -> Optional[int]:
+        if not self.config.prefix_cache:
+            return None
+        if not messages or messages[0]["role"] != "system":
+            return 0
+        prefix = messages[0]["content"]
+        with self._lock:
+            if prefix not in self._cached_prefixes:
+                self._cached_prefixes.add(prefix)
+                return 0
+        return estimate_tokens(prefix)
+
+    def chat_completion(
+        self,
+        messages: List[ChatMessageType],
+        stream: bool = True,
+        temperature: Optional[float] = None,
+        max_tokens: Optional[int] = None,
+        top_p: Optional[float] = None,
+        stop: Optional[List[str]] = None,
+        **kwargs: Any,
+    ) -> Generator[ChatMessageType, None, None]:
+        key = request_key(messages, temperature, max_tokens, top_p, stop, kwargs)
+        msg = self.responses.get(key)
+        if msg is None:
+            if self.strict:
+                raise KeyError(f"no recorded response for request [key={key}]")
+            msg = format_chat_message(
+                "assistant", fake_answer(messages, kwargs.get("response_format"))
+            )
+
+        prompt_tokens = estimate_messages_tokens(messages)
+        cached_tokens = self._cached_tokens(messages)
+        completion_tokens = estimate_tokens(msg["content"])
+        with self._lock:
+            self.calls += 1
+            self.prompt_tokens += prompt_tokens
+            self.cached_prompt_tokens += cached_tokens or 0
+            self.completion_tokens += completion_tokens
+        seconds = self.config.latency_seconds
+        if self.config.prefill_tokens_per_second:
+            seconds += (prompt_tokens - (cached_tokens or 0)) / (
+                self.config.prefill_tokens_per_second
+            )
+        time.sleep(seconds)
+        if not (stream and self.config.tokens_per_second):
+            if self.config.tokens_per_second:
+                time.sleep(completion_tokens / self.config.tokens_per_second)
+            record_usage(prompt_tokens, completion_tokens, cached_tokens)
+            yield msg
+            return
+        # streamed a line at a time, each once it has been generated
+        for line in msg["content"].splitlines(keepends=True):
+            time.sleep(estimate_tokens(line) / self.config.tokens_per_second)
+            yield format_chat_message(msg["role"], line)
+        record_usage(prompt_tokens, completion_tokens, cached_tokens)
+
+
+def fake_backends(
+    llm_latency: float = 0.0, ocr_latency: float = 0.0
+) -> Tuple[FakeDocumentAI, FakeCompletionService]:
+    """
+    Offline stand-ins for DocumentAI and the LLM, with the sample record's pages as the
+    OCR text of any page.
+    """
+    return (
+        FakeDocumentAI({}, latency_seconds=ocr_latency, fallback_texts=sample_pages()),
+        FakeCompletionService(latency_seconds=llm_latency),
+    )
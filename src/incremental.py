@@ -0,0 +1,350 @@
+import hashlib
+import os
+from bisect import bisect_left, bisect_right
+from difflib import SequenceMatcher
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+from uuid import UUID, uuid4
+
+from loguru import logger
+from pydantic import BaseModel
+
+from .chunking import Window
+from .compact import compact_record
+from .dedup import find_duplicates, normalize_text
+from .llm import LLMApi, RateLimiter, ResponseCache, RoutingConfig
+from .models import CompactMedicalRecord, MedicalEncounter, MedicalRecord
+from .ocr_cache import OCRCache
+from .pdf import pdf_pages
+from .record import find_encounter_boundaries, iter_parsed_encounters, split_lines
+
+
+class RecordState(BaseModel):
+    """
+    A parsed record, with the fingerprints of its pages and encounters needed to update
+    it incrementally when its PDF changes.
+    """
+
+    record: MedicalRecord
+    # hash and text length of each page of the PDF
+    page_hashes: List[str]
+    page_lengths: List[int]
+    # line span of each encounter in the text of the record's distinct pages
+    encounter_spans: List[Window]
+    encounter_hashes: List[str]
+
+
+class KnownPageTexts:
+    """
+    Page texts from a previous version of a record, by page hash, used by `pdf_pages`
+    in place of an OCRCache. Pages not found are read from and written to `fallback`.
+    """
+
+    def __init__(
+        self, texts: Dict[str, str], fallback: Optional[OCRCache] = None
+    ) -> None:
+        self.texts = texts
+        self.fallback = fallback
+
+    def get(self, key: str) -> Optional[str]:
+        text = self.texts.get(key)
+        if text is None and self.fallback is not None:
+            text = self.fallback.get(key)
+        return text
+
+    def put(self, key: str, text: str) -> None:
+        if self.fallback is not None:
+            self.fallback.put(key, text)
+
+
+def encounter_hash(lines: List[str]) -> str:
+    text = normalize_text("\n".join(lines))
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def page_lines(texts: List[str]) -> Tuple[List[str], List[Window]]:
+    """
+    Return the lines of the joined page texts, and the span of lines each page covers.
+    A line that runs over the end of a page is in the spans of both pages.
+    """
+    text = "".join(texts)
+    line_starts = []
+    offset = 0
+    for line in text.splitlines(keepends=True):
+        line_starts.append(offset)
+        offset += len(line)
+
+    spans: List[Window] = []
+    offset = 0
+    for page_text in texts:
+        if page_text:
+            start = bisect_right(line_starts, offset) - 1
+            end = bisect_right(line_starts, offset + len(page_text) - 1)
+        else:
+            start = end = bisect_left(line_starts, offset)
+        spans.append((start, end))
+        offset += len(page_text)
+    return text.splitlines(), spans
+
+
+def map_lines(
+    old_lines: List[str],
+    old_page_hashes: List[str],
+    old_page_spans: List[Window],
+    new_lines: List[str],
+    new_page_hashes: List[str],
+    new_page_spans: List[Window],
+) -> List[int]:
+    """
+    For each old line, return the index of the same line in the new text, or -1 if it
+    is on a page that was changed or removed.
+    """
+    new_indexes = [-1] * len(old_lines)
+    matcher = SequenceMatcher(None, old_page_hashes, new_page_hashes, autojunk=False)
+    for old_page, new_page, num_pages in matcher.get_matching_blocks():
+        for k in range(num_pages):
+            old_start, old_end = old_page_spans[old_page + k]
+            new_start, new_end = new_page_spans[new_page + k]
+            if old_end - old_start != new_end - new_start:
+                continue
+            for x in range(old_end - old_start):
+                # lines shared with a changed neighbouring page may differ
+                if old_lines[old_start + x] == new_lines[new_start + x]:
+                    new_indexes[old_start + x] = new_start + x
+    return new_indexes
+
+
+def split_text(text: str, lengths: List[int]) -> List[str]:
+    texts = []
+    offset = 0
+    for length in lengths:
+        texts.append(text[offset : offset + length])
+        offset += length
+    return texts
+
+
+def update_record(
+    llm: LLMApi,
+    filepath: str,
+    state: Optional[RecordState] = None,
+    ocr_cache: Optional[OCRCache] = None,
+    max_workers: int = 8,
+    fused: bool = False,
+    dedup: bool = True,
+    presegment: bool = True,
+) -> RecordState:
+    """
+    Parse a PDF, reusing the work saved in the `state` of a previous version of it.
+
+    Pages with the same hash as before are not OCR'd again. An old encounter is kept,
+    and its boundary not detected again, if its lines and the line after it are on
+    unchanged pages. Boundaries are detected only in the lines not covered by kept
+    encounters, and encounters whose text is unchanged are not parsed again. Changed
+    encounters keep the id of the old encounter that started on the same line.
+    """
+    old_lines: List[str] = []
+    old_page_hashes: List[str] = []
+    old_page_spans: List[Window] = []
+    known_texts: Dict[str, str] = {}
+    if state is not None:
+        old_texts = split_text(state.record.content, state.page_lengths)
+        known_texts = dict(zip(state.page_hashes, old_texts))
+        old_distinct = [
+            i for i in range(len(old_texts)) if i not in state.record.duplicate_pages
+        ]
+        old_lines, old_page_spans = page_lines([old_texts[i] for i in old_distinct])
+        old_page_hashes = [state.page_hashes[i] for i in old_distinct]
+
+    pages = pdf_pages(
+        Path(filepath), ocr_cache=KnownPageTexts(known_texts, ocr_cache), hybrid=True
+    )
+    page_duplicates = (
+        find_duplicates(pages.texts) if dedup else [None] * len(pages.texts)
+    )
+    distinct = [i for i, first in enumerate(page_duplicates) if first is None]
+    doc_lines, page_spans = page_lines([pages.texts[i] for i in distinct])
+    page_hashes = [pages.hashes[i] for i in distinct]
+
+    # keep the old segments, whether encounters or the lines before the first one,
+    # whose lines are unchanged and whose end is still a boundary
+    covered = [False] * len(doc_lines)
+    kept_starts: List[int] = []
+    new_indexes: List[int] = []
+    if state is not None:
+        new_indexes = map_lines(
+            old_lines,
+            old_page_hashes,
+            old_page_spans,
+            doc_lines,
+            page_hashes,
+            page_spans,
+        )
+        segments = list(state.encounter_spans)
+        first_start = segments[0][0] if segments else len(old_lines)
+        preamble = [(0, first_start)] if first_start > 0 else []
+        for start, end in preamble + segments:
+            new_start = new_indexes[start]
+            if new_start < 0:
+                continue
+            new_end = new_start + end - start
+            if any(new_indexes[x] != new_start + x - start for x in range(start, end)):
+                continue
+            if end < len(old_lines):
+                end_is_boundary = new_indexes[end] == new_end
+            else:
+                end_is_boundary = new_end == len(doc_lines)
+            if end_is_boundary:
+                covered[new_start:new_end] = [True] * (new_end - new_start)
+                if (start, end) not in preamble:
+                    kept_starts.append(new_start)
+
+    dirty_spans: List[Window] = []
+    for i, is_covered in enumerate(covered):
+        if is_covered:
+            continue
+        if dirty_spans and dirty_spans[-1][1] == i:
+            dirty_spans[-1] = (dirty_spans[-1][0], i + 1)
+        else:
+            dirty_spans.append((i, i + 1))
+
+    boundaries = set(kept_starts)
+    if dirty_spans:
+        boundaries |= set(
+            find_encounter_boundaries(
+                llm,
+                doc_lines,
+                spans=dirty_spans,
+                max_workers=max_workers,
+                presegment=presegment,
+            )
+        )
+        # a changed span after a kept encounter starts where the old next one started
+        boundaries |= {start for start, _ in dirty_spans if start > 0}
+    encounter_boundaries = sorted(boundaries)
+    encounters_lines = split_lines(doc_lines, encounter_boundaries)
+    encounter_ends = encounter_boundaries[1:] + [len(doc_lines)]
+    encounter_hashes = [encounter_hash(lines) for lines in encounters_lines]
+    encounter_duplicates = (
+        find_duplicates(["\n".join(lines) for lines in encounters_lines])
+        if dedup
+        else [None] * len(encounters_lines)
+    )
+
+    # reuse old parses of unchanged encounters
+    old_by_hash: Dict[str, MedicalEncounter] = {}
+    old_ids_by_hash: Dict[str, List[UUID]] = {}
+    old_ids_by_start: Dict[int, UUID] = {}
+    if state is not None:
+        for h, (start, _), encounter in zip(
+            state.encounter_hashes, state.encounter_spans, state.record.encounters
+        ):
+            old_by_hash.setdefault(h, encounter)
+            old_ids_by_hash.setdefault(h, []).append(encounter.id)
+            if new_indexes[start] >= 0:
+                old_ids_by_start[new_indexes[start]] = encounter.id
+    parsed = {
+        i: old_by_hash[h].model_copy(
+            update={"content": "\n".join(encounters_lines[i]), "duplicate_of": None}
+        )
+        for i, (h, first) in enumerate(zip(encounter_hashes, encounter_duplicates))
+        if first is None and h in old_by_hash
+    }
+    encounters = list(
+        iter_parsed_encounters(
+            llm,
+            encounters_lines,
+            encounter_duplicates,
+            max_workers,
+            fused,
+            parsed=parsed,
+        )
+    )
+
+    # give each encounter the id of the old encounter with the same text, or else of
+    # the old encounter that started on the same line
+    used_ids = set()
+    for i, encounter in enumerate(encounters):
+        candidates = old_ids_by_hash.get(encounter_hashes[i], []) + [
+            old_ids_by_start.get(encounter_boundaries[i])
+        ]
+        for old_id in candidates:
+            if old_id is not None and old_id not in used_ids:
+                encounters[i] = encounter.model_copy(update={"id": old_id})
+                break
+        used_ids.add(encounters[i].id)
+
+    logger.info(
+        f"updated record [new_pages={len(set(page_hashes) - set(old_page_hashes))}][kept_encounters={len(kept_starts)}][redetected_lines={sum(end - start for start, end in dirty_spans)}][reused_encounters={len(parsed)}][num_encounters={len(encounters)}]"
+    )
+    return RecordState(
+        record=MedicalRecord(
+            id=state.record.id if state is not None else uuid4(),
+            content="".join(pages.texts),
+            encounters=encounters,
+            duplicate_pages={
+                i: first
+                for i, first in enumerate(page_duplicates)
+                if first is not None
+            },
+        ),
+        page_hashes=pages.hashes,
+        page_lengths=[len(text) for text in pages.texts],
+        encounter_spans=list(zip(encounter_boundaries, encounter_ends)),
+        encounter_hashes=encounter_hashes,
+    )
+
+
+def load_record_state(path: str | Path) -> Optional[RecordState]:
+    path = Path(path)
+    if not path.exists():
+        return None
+    return RecordState.model_validate_json(path.read_text(encoding="utf-8"))
+
+
+def save_record_state(state: RecordState, path: str | Path) -> None:
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(f"{path.suffix}.tmp")
+    tmp_path.write_text(state.model_dump_json(), encoding="utf-8")
+    os.replace(tmp_path, path)
+
+
+def update_from_pdf(
+    filepath: str,
+    state_path: str | Path,
+    api_type: str = "openai",
+    max_workers: int = 8,
+    requests_per_minute: Optional[int] = None,
+    tokens_per_minute: Optional[int] = None,
+    fused: bool = False,
+    cache: bool = True,
+    dedup: bool = True,
+    presegment: bool = True,
+    compact: bool = False,
+    routing: Optional[RoutingConfig] = None,
+) -> MedicalRecord | CompactMedicalRecord:
+    """
+    Entry point for records that are checked again after every update. Parses a PDF
+    incrementally against the state saved at `state_path` by the previous run, if any,
+    and saves the new state there. Takes the same keyword arguments as `extract_from_pdf`.
+    """
+    llm_api = LLMApi(
+        api_type=api_type,
+        rate_limiter=RateLimiter(requests_per_minute, tokens_per_minute),
+        cache=ResponseCache() if cache else None,
+        routing=routing,
+    )
+    state = update_record(
+        llm_api,
+        filepath,
+        load_record_state(state_path),
+        ocr_cache=OCRCache() if cache else None,
+        max_workers=max_workers,
+        fused=fused,
+        dedup=dedup,
+        presegment=presegment,
+    )
+    save_record_state(state, state_path)
+    if compact:
+        return compact_record(state.record, state.page_lengths, state.encounter_spans)
+    return state.record
@@ -1,37 +1,164 @@
+import importlib
 import types
 import os
-from typing import Any, List, Optional
+from typing import Any, Callable, Dict, Generator, List, Optional, Tuple, Type
 
+from loguru import logger
+
+from ..resilience import ResiliencePolicy
+from ..telemetry import telemetry
 from .base import (
     CompletionService,
 )
-from .ollama import OllamaService
-from .openai import OpenAIService
-from .util import ChatMessageType, format_chat_message
+from .cache import ResponseCache
+from .ratelimit import RateLimiter, SharedRateLimiter
+from .resilient import ResilientCompletionService
+from .routing import (
+    FAST_TIER_SPAN,
+    RoutingConfig,
+    RoutingStats,
+    Tier,
+    TierStats,
+    add_routing_args,
+    routing_from_args,
+)
+from .util import (
+    CONNECTION_CONFIG_FIELDS,
+    ChatMessageType,
+    estimate_messages_tokens,
+    estimate_tokens,
+    format_chat_message,
+)
 
-llm_completion_config_map = {
-    "openai": OpenAIService,
-    "ollama": OllamaService,
+# api type -> module and class of its completion service. Backends are imported when
+# first used, so a run only pays for the client library of the backend it uses.
+llm_completion_config_map: Dict[str, Tuple[str, str]] = {
+    "openai": (".openai", "OpenAIService"),
+    "ollama": (".ollama", "OllamaService"),
+    "openai_batch": (".openai_batch", "OpenAIBatchService"),
 }
 
 
+def completion_service_class(api_type: str) -> Type[CompletionService]:
+    if api_type not in llm_completion_config_map:
+        raise ValueError(f"API type {api_type} is not supported")
+    module_name, class_name = llm_completion_config_map[api_type]
+    return getattr(importlib.import_module(module_name, __name__), class_name)
+
+
 class LLMApi(object):
     completion_service: CompletionService
     api_type: str
+    rate_limiter: Optional[RateLimiter]
+    cache: Optional[ResponseCache]
 
     def __init__(
         self,
         api_type: str = "openai",
+        rate_limiter: Optional[RateLimiter] = None,
+        cache: Optional[ResponseCache] = None,
+        completion_service: Optional[CompletionService] = None,
+        resilience: Optional[ResiliencePolicy] = None,
+        resilient: bool = True,
+        routing: Optional[RoutingConfig] = None,
+        fast_tier: Optional["LLMApi"] = None,
+        **config: Any,
     ):
+        """
+        Keyword arguments in `config` override the completion service's config, e.g.
+        the size of its connection pool and its timeouts. A `completion_service`, e.g.
+        a local fake, is used instead of the service for `api_type`.
+
+        Requests are sent with the deadline, retries, hedging and circuit breaker of
+        `resilience`, or of the default ResiliencePolicy if it is None, unless
+        `resilient` is False or the service is deferred.
+
+        With `routing`, prompts are first sent to a fast tier, the model it names or
+        else `fast_tier`, and this API's own model is the strong tier they escalate to.
+        """
         self.api_type = api_type
+        self.rate_limiter = rate_limiter
+        self.cache = cache
+        self.routing = routing or (RoutingConfig() if fast_tier is not None else None)
+        self.routing_stats = RoutingStats()
+        if resilience is None:
+            resilience = ResiliencePolicy()
+        if fast_tier is None and routing is not None:
+            fast_tier = LLMApi(
+                api_type=routing.fast_api_type,
+                rate_limiter=rate_limiter,
+                cache=cache,
+                resilience=resilience,
+                resilient=resilient,
+                **({"model": routing.fast_model} if routing.fast_model else {}),
+            )
+        self.fast_tier = fast_tier
+
+        if completion_service is None:
+            if api_type in ("openai", "openai_batch"):
+                config = {"api_key": os.getenv("OPENAI_API_KEY"), **config}
+            completion_service = completion_service_class(api_type)(**config)
+        if resilient and not completion_service.deferred:
+            completion_service = ResilientCompletionService(
+                completion_service, resilience
+            )
+        self.completion_service = completion_service
+
+    def _cache_key(
+        self,
+        messages: List[ChatMessageType],
+        temperature: Optional[float],
+        max_tokens: Optional[int],
+        top_p: Optional[float],
+        stop: Optional[List[str]],
+        prompt_version: Optional[str],
+        kwargs: Any,
+    ) -> str:
+        return ResponseCache.key(
+            api_type=self.api_type,
+            config=self.completion_service.config.model_dump(
+                exclude={"api_key"} | CONNECTION_CONFIG_FIELDS
+            ),
+            messages=messages,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            top_p=top_p,
+            stop=stop,
+            prompt_version=prompt_version,
+            kwargs=kwargs,
+        )
+
+    @staticmethod
+    def _add_chunk(msg: ChatMessageType, msg_chunk: ChatMessageType) -> None:
+        msg["role"] = msg_chunk["role"]
+        msg["content"] += msg_chunk["content"]
+        if "name" in msg_chunk:
+            msg["name"] = msg_chunk["name"]
 
-        if api_type == "openai":
-            api_key = os.getenv("OPENAI_API_KEY")
-            self.completion_service = OpenAIService(api_key=api_key)
-        elif api_type == "ollama":
-            self.completion_service = OllamaService()
-        else:
-            raise ValueError(f"API type {api_type} is not supported")
+    def _fast_tier_for(self, prompt_name: Optional[str]) -> Optional["LLMApi"]:
+        """The fast tier to try first for a prompt, if any, counting strong routes."""
+        if self.fast_tier is None or self.routing is None:
+            return None
+        if self.routing.tier(prompt_name) == "fast":
+            return self.fast_tier
+        self._count_route(prompt_name, "strong")
+        return None
+
+    def _count_route(self, prompt_name: Optional[str], outcome: str) -> None:
+        self.routing_stats.add(prompt_name, outcome)
+        telemetry.add(f"routed_{outcome}")
+
+    def _accept_fast(
+        self,
+        prompt_name: Optional[str],
+        msg: Optional[ChatMessageType],
+        validate: Optional[Callable[[ChatMessageType], bool]],
+    ) -> bool:
+        if msg is not None and (validate is None or validate(msg)):
+            self._count_route(prompt_name, "fast")
+            return True
+        self._count_route(prompt_name, "escalated")
+        return False
 
     def chat_completion(
         self,
@@ -41,11 +168,132 @@ class LLMApi(object):
         max_tokens: Optional[int] = None,
         top_p: Optional[float] = None,
         stop: Optional[List[str]] = None,
+        prompt_version: Optional[str] = None,
+        prompt_name: Optional[str] = None,
+        validate: Optional[Callable[[ChatMessageType], bool]] = None,
         **kwargs: Any,
     ) -> ChatMessageType:
+        """
+        Return the response to a prompt. With a fast tier, a prompt routed to it by its
+        `prompt_name` is answered there first, and escalated to this API's model if the
+        fast tier fails or `validate` rejects its response.
+        """
+        args = (messages, stream, temperature, max_tokens, top_p, stop, prompt_version)
+        fast_tier = self._fast_tier_for(prompt_name)
+        if fast_tier is not None:
+            msg = None
+            try:
+                with telemetry.span(FAST_TIER_SPAN, prompt=prompt_name):
+                    msg = fast_tier.chat_completion(*args, **kwargs)
+            except Exception as e:
+                logger.warning(f"fast tier failed [prompt={prompt_name}]: {e}")
+            if self._accept_fast(prompt_name, msg, validate):
+                return msg
+        return self._complete(*args, **kwargs)
+
+    def stream_lines(
+        self,
+        messages: List[ChatMessageType],
+        temperature: Optional[float] = None,
+        max_tokens: Optional[int] = None,
+        top_p: Optional[float] = None,
+        stop: Optional[List[str]] = None,
+        prompt_version: Optional[str] = None,
+        prompt_name: Optional[str] = None,
+        validate: Optional[Callable[[ChatMessageType], bool]] = None,
+        **kwargs: Any,
+    ) -> Generator[str, None, None]:
+        """
+        Yield each line of the response to a prompt as soon as it is complete, so the
+        caller can act on the first lines while the rest are generated. The lines are
+        those of `chat_completion(...)["content"].split("\n")`.
+
+        A prompt routed to the fast tier is yielded only once its whole response has
+        passed `validate`, since it may still be escalated.
+        """
+        args = (messages, True, temperature, max_tokens, top_p, stop, prompt_version)
+        fast_tier = self._fast_tier_for(prompt_name)
+        if fast_tier is not None:
+            msg = self.chat_completion(
+                *args, prompt_name=prompt_name, validate=validate, **kwargs
+            )
+            for line in msg["content"].split("\n"):
+                yield line.removesuffix("\r")
+            return
+        buffer = ""
+        for msg_chunk in self._chunks(*args, incremental=True, **kwargs):
+            buffer += msg_chunk["content"]
+            *lines, buffer = buffer.split("\n")
+            for line in lines:
+                yield line.removesuffix("\r")
+        yield buffer.removesuffix("\r")
+
+    def _complete(
+        self,
+        messages: List[ChatMessageType],
+        stream: bool = True,
+        temperature: Optional[float] = None,
+        max_tokens: Optional[int] = None,
+        top_p: Optional[float] = None,
+        stop: Optional[List[str]] = None,
+        prompt_version: Optional[str] = None,
+        **kwargs: Any,
+    ) -> ChatMessageType:
+        msg: ChatMessageType = format_chat_message("assistant", "")
+        for msg_chunk in self._chunks(
+            messages,
+            stream,
+            temperature,
+            max_tokens,
+            top_p,
+            stop,
+            prompt_version,
+            **kwargs,
+        ):
+            self._add_chunk(msg, msg_chunk)
+        return msg
+
+    def _chunks(
+        self,
+        messages: List[ChatMessageType],
+        stream: bool = True,
+        temperature: Optional[float] = None,
+        max_tokens: Optional[int] = None,
+        top_p: Optional[float] = None,
+        stop: Optional[List[str]] = None,
+        prompt_version: Optional[str] = None,
+        incremental: bool = False,
+        **kwargs: Any,
+    ) -> Generator[ChatMessageType, None, None]:
+        """
+        Yield the chunks of the response to a prompt, or the cached response as a single
+        chunk, and cache the response once it is complete. With `incremental`, chunks
+        are yielded as they arrive even through a resilient completion service, which
+        otherwise holds them until the response is complete.
+        """
+        cache_key = None
+        if self.cache is not None:
+            cache_key = self._cache_key(
+                messages, temperature, max_tokens, top_p, stop, prompt_version, kwargs
+            )
+            cached_msg = self.cache.get(cache_key)
+            if cached_msg is not None:
+                telemetry.add("cache_hits")
+                yield cached_msg
+                return
+            telemetry.add("cache_misses")
+
+        if self.rate_limiter is not None:
+            waited = self.rate_limiter.acquire(estimate_messages_tokens(messages))
+            telemetry.add("rate_limit_wait_seconds", waited)
+        telemetry.add("llm_calls")
+
         msg: ChatMessageType = format_chat_message("assistant", "")
         completion_service = self.completion_service
-        for msg_chunk in completion_service.chat_completion(
+        chat_completion = completion_service.chat_completion
+        if incremental and isinstance(completion_service, ResilientCompletionService):
+            chat_completion = completion_service.chat_completion_stream
+        for msg_chunk in chat_completion(
             messages,
             stream,
             temperature,
@@ -54,8 +302,95 @@ class LLMApi(object):
             stop,
             **kwargs,
         ):
-            msg["role"] = msg_chunk["role"]
-            msg["content"] += msg_chunk["content"]
-            if "name" in msg_chunk:
-                msg["name"] = msg_chunk["name"]
+            self._add_chunk(msg, msg_chunk)
+            yield msg_chunk
+
+        if self.rate_limiter is not None:
+            self.rate_limiter.consume(estimate_tokens(msg["content"]))
+        if cache_key is not None:
+            self.cache.put(cache_key, msg)
+
+    async def achat_completion(
+        self,
+        messages: List[ChatMessageType],
+        stream: bool = True,
+        temperature: Optional[float] = None,
+        max_tokens: Optional[int] = None,
+        top_p: Optional[float] = None,
+        stop: Optional[List[str]] = None,
+        prompt_version: Optional[str] = None,
+        prompt_name: Optional[str] = None,
+        validate: Optional[Callable[[ChatMessageType], bool]] = None,
+        **kwargs: Any,
+    ) -> ChatMessageType:
+        """
+        Like `chat_completion`, but sends the request on the completion service's async
+        client, so many requests can be in flight without a thread for each.
+        """
+        args = (messages, stream, temperature, max_tokens, top_p, stop, prompt_version)
+        fast_tier = self._fast_tier_for(prompt_name)
+        if fast_tier is not None:
+            msg = None
+            try:
+                with telemetry.span(FAST_TIER_SPAN, prompt=prompt_name):
+                    msg = await fast_tier.achat_completion(*args, **kwargs)
+            except Exception as e:
+                logger.warning(f"fast tier failed [prompt={prompt_name}]: {e}")
+            if self._accept_fast(prompt_name, msg, validate):
+                return msg
+        return await self._acomplete(*args, **kwargs)
+
+    async def _acomplete(
+        self,
+        messages: List[ChatMessageType],
+        stream: bool = True,
+        temperature: Optional[float] = None,
+        max_tokens: Optional[int] = None,
+        top_p: Optional[float] = None,
+        stop: Optional[List[str]] = None,
+        prompt_version: Optional[str] = None,
+        **kwargs: Any,
+    ) -> ChatMessageType:
+        cache_key = None
+        if self.cache is not None:
+            cache_key = self._cache_key(
+                messages, temperature, max_tokens, top_p, stop, prompt_version, kwargs
+            )
+            cached_msg = self.cache.get(cache_key)
+            if cached_msg is not None:
+                telemetry.add("cache_hits")
+                return cached_msg
+            telemetry.add("cache_misses")
+
+        if self.rate_limiter is not None:
+            waited = await self.rate_limiter.aacquire(estimate_messages_tokens(messages))
+            telemetry.add("rate_limit_wait_seconds", waited)
+        telemetry.add("llm_calls")
+
+        msg: ChatMessageType = format_chat_message("assistant", "")
+        async for msg_chunk in self.completion_service.achat_completion(
+            messages,
+            stream,
+            temperature,
+            max_tokens,
+            top_p,
+            stop,
+            **kwargs,
+        ):
+            self._add_chunk(msg, msg_chunk)
+
+        if self.rate_limiter is not None:
+            self.rate_limiter.consume(estimate_tokens(msg["content"]))
+        if cache_key is not None:
+            self.cache.put(cache_key, msg)
         return msg
+
+    def close(self) -> None:
+        self.completion_service.close()
+        if self.fast_tier is not None:
+            self.fast_tier.close()
+
+    async def aclose(self) -> None:
+        await self.completion_service.aclose()
+        if self.fast_tier is not None:
+            await self.fast_tier.aclose()
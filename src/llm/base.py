@@ -1,10 +1,15 @@
 import abc
-from typing import Any, Generator, List, Optional
+import asyncio
+from typing import Any, AsyncGenerator, Generator, List, Optional
 
 from .util import ChatMessageType
 
 
 class CompletionService(abc.ABC):
+    # whether responses may take hours, as from a batch API, so that calls must not be
+    # given deadlines or be retried by the caller
+    deferred: bool = False
+
     @abc.abstractmethod
     def chat_completion(
         self,
@@ -29,3 +34,46 @@ class CompletionService(abc.ABC):
         """
 
         raise NotImplementedError
+
+    async def achat_completion(
+        self,
+        messages: List[ChatMessageType],
+        stream: bool = True,
+        temperature: Optional[float] = None,
+        max_tokens: Optional[int] = None,
+        top_p: Optional[float] = None,
+        stop: Optional[List[str]] = None,
+        **kwargs: Any,
+    ) -> AsyncGenerator[ChatMessageType, None]:
+        """
+        Async chat completion API, with the same parameters as `chat_completion`.
+
+        Services without a native async client run `chat_completion` in a worker thread.
+
+        :return: async generator of messages
+        """
+        chunks = await asyncio.to_thread(
+            lambda: list(
+                self.chat_completion(
+                    messages,
+                    stream,
+                    temperature,
+                    max_tokens,
+                    top_p,
+                    stop,
+                    **kwargs,
+                )
+            )
+        )
+        for chunk in chunks:
+            yield chunk
+
+    def close(self) -> None:
+        """
+        Close the service's pooled connections.
+        """
+
+    async def aclose(self) -> None:
+        """
+        Close the service's pooled async connections.
+        """
@@ -0,0 +1,161 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+from loguru import logger
+from pydantic import BaseModel
+
+from .util import ChatMessageType
+
+DEFAULT_RESPONSE_CACHE_PATH = ".cache/llm.sqlite3"
+
+# hits whose access times are kept in memory before they are written in one transaction
+ACCESS_FLUSH_EVERY = 256
+
+
+class ResponseCacheStats(BaseModel):
+    hits: int = 0
+    misses: int = 0
+    num_entries: int = 0
+
+
+class ResponseCache:
+    """
+    SQLite-backed cache of chat completions.
+
+    Entries expire `ttl_seconds` after they were written, and the least recently used
+    entries are evicted once there are more than `max_entries`. The cache can be shared
+    by threads.
+
+    Hits only read the database: their access times are written together every
+    `ACCESS_FLUSH_EVERY` hits and with the next put. The number of entries is counted
+    once and then kept up to date by puts, and only counted again when it seems to be
+    over `max_entries`, since other processes may share the file.
+    """
+
+    def __init__(
+        self,
+        path: str | Path = DEFAULT_RESPONSE_CACHE_PATH,
+        ttl_seconds: Optional[float] = 30 * 24 * 60 * 60,
+        max_entries: int = 100_000,
+    ) -> None:
+        self.path = Path(path)
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                message TEXT NOT NULL,
+                created REAL NOT NULL,
+                accessed REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)"
+        )
+        self._conn.commit()
+        self._num_entries = self._count()
+        # access times of hits not yet written, by key
+        self._accessed: Dict[str, float] = {}
+
+    def _count(self) -> int:
+        return self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def _flush_accessed(self) -> None:
+        """Write the access times of recent hits. Call with the lock held."""
+        if self._accessed:
+            self._conn.executemany(
+                "UPDATE responses SET accessed = ? WHERE key = ?",
+                [(accessed, key) for key, accessed in self._accessed.items()],
+            )
+            self._accessed.clear()
+
+    @staticmethod
+    def key(**params: Any) -> str:
+        """
+        Return a cache key for a request, from everything that can change its response:
+        backend, model, messages, sampling parameters and prompt version.
+        """
+        encoded = json.dumps(params, sort_keys=True, default=str)
+        return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[ChatMessageType]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT message, created FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and self.ttl_seconds is not None:
+                if now - row[1] > self.ttl_seconds:
+                    if self._conn.execute(
+                        "DELETE FROM responses WHERE key = ?", (key,)
+                    ).rowcount:
+                        self._num_entries -= 1
+                    self._accessed.pop(key, None)
+                    self._conn.commit()
+                    row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._accessed[key] = now
+            if len(self._accessed) >= ACCESS_FLUSH_EVERY:
+                self._flush_accessed()
+                self._conn.commit()
+        return json.loads(row[0])
+
+    def put(self, key: str, message: ChatMessageType) -> None:
+        now = time.time()
+        with self._lock:
+            self._flush_accessed()
+            replaced = self._conn.execute(
+                "UPDATE responses SET message = ?, created = ?, accessed = ? WHERE key = ?",
+                (json.dumps(message), now, now, key),
+            ).rowcount
+            if not replaced:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO responses (key, message, created, accessed) VALUES (?, ?, ?, ?)",
+                    (key, json.dumps(message), now, now),
+                )
+                self._num_entries += 1
+            if self._num_entries > self.max_entries:
+                # counted again, as other processes may have added or evicted entries
+                self._num_entries = self._count()
+                num_evicted = self._num_entries - self.max_entries
+                if num_evicted > 0:
+                    self._conn.execute(
+                        "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY accessed LIMIT ?)",
+                        (num_evicted,),
+                    )
+                    logger.info(
+                        f"evicted llm cache entries [num_evicted={num_evicted}]"
+                    )
+                    self._num_entries = self.max_entries
+            self._conn.commit()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM responses")
+            self._conn.commit()
+            self._accessed.clear()
+            self._num_entries = 0
+
+    def stats(self) -> ResponseCacheStats:
+        with self._lock:
+            self._flush_accessed()
+            self._conn.commit()
+            num_entries = self._num_entries = self._count()
+        return ResponseCacheStats(
+            hits=self.hits, misses=self.misses, num_entries=num_entries
+        )
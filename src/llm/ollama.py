@@ -1,12 +1,16 @@
 import json
-from contextlib import contextmanager
-from typing import Any, Generator, List, Optional
+from typing import Any, AsyncGenerator, Callable, Dict, Generator, List, Optional
 
+import httpx
 import requests
 from pydantic import BaseModel
+from requests.adapters import HTTPAdapter
 
+from ..resilience import RetryableError, is_retryable_status, parse_retry_after
+from ..telemetry import telemetry
 from .base import CompletionService
-from .util import ChatMessageType, format_chat_message
+from .pool import AsyncClientPool
+from .util import ChatMessageType, format_chat_message, record_usage
 
 
 class OllamaServiceConfig(BaseModel):
@@ -14,11 +18,43 @@ class OllamaServiceConfig(BaseModel):
     api_base: str = "http://localhost:11434"
     model: str = "llama3:70b"
     response_format: str = "json"
+    # how long the server keeps the model loaded after a request, e.g. "30m", or -1 to
+    # keep it loaded. A loaded model keeps the KV cache of its recent prompts, so the
+    # next prompt about the same document only evaluates its question.
+    keep_alive: Optional[str | int] = "30m"
+    # context window in tokens, or None for the model's default. Prompts longer than
+    # the window are truncated from the start, which loses their cached prefix.
+    num_ctx: Optional[int] = None
+    # connection pool of the HTTP clients, shared by every request
+    max_connections: int = 100
+    max_keepalive_connections: int = 20
+    timeout: float = 600
+    connect_timeout: float = 5
 
 
 class OllamaService(CompletionService):
-    def __init__(self):
-        self.config = OllamaServiceConfig()
+    def __init__(self, **config: Any):
+        self.config = OllamaServiceConfig(**config)
+        self.session = requests.Session()
+        self.session.mount(
+            self.config.api_base,
+            HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=self.config.max_connections,
+            ),
+        )
+        self.async_clients: AsyncClientPool[httpx.AsyncClient] = AsyncClientPool(
+            lambda limits: httpx.AsyncClient(
+                base_url=self.config.api_base,
+                limits=limits,
+                timeout=httpx.Timeout(
+                    self.config.timeout, connect=self.config.connect_timeout
+                ),
+            ),
+            lambda client: client.aclose(),
+            self.config.max_connections,
+            self.config.max_keepalive_connections,
+        )
 
     def chat_completion(
         self,
@@ -30,29 +66,10 @@ class OllamaService(CompletionService):
         stop: Optional[List[str]] = None,
         **kwargs: Any,
     ) -> Generator[ChatMessageType, None, None]:
-        print(messages)
-        try:
-            return self._chat_completion(
-                messages=messages,
-                stream=stream,
-                temperature=temperature,
-                max_tokens=max_tokens,
-                top_p=top_p,
-                stop=stop,
-                **kwargs,
-            )
-        except Exception:
-            return self._completion(
-                messages=messages,
-                stream=stream,
-                temperature=temperature,
-                max_tokens=max_tokens,
-                top_p=top_p,
-                stop=stop,
-                **kwargs,
-            )
+        payload = self._chat_payload(messages, stream, kwargs)
+        yield from self._request_api("/api/chat", payload, self._chat_content)
 
-    def _chat_completion(
+    async def achat_completion(
         self,
         messages: List[ChatMessageType],
         stream: bool = True,
@@ -61,89 +78,128 @@ class OllamaService(CompletionService):
         top_p: Optional[float] = None,
         stop: Optional[List[str]] = None,
         **kwargs: Any,
-    ) -> Generator[ChatMessageType, None, None]:
-        api_endpoint = "/api/chat"
-        payload = {
+    ) -> AsyncGenerator[ChatMessageType, None]:
+        payload = self._chat_payload(messages, stream, kwargs)
+        async for msg in self._arequest_api("/api/chat", payload, self._chat_content):
+            yield msg
+
+    def _chat_payload(
+        self, messages: List[ChatMessageType], stream: bool, kwargs: Any
+    ) -> Dict[str, Any]:
+        payload: Dict[str, Any] = {
             "model": self.config.model,
             "messages": messages,
             "stream": stream,
         }
-
-        if self.config.response_format == "json":
+        if self._json_format(kwargs):
             payload["format"] = "json"
+        if self.config.keep_alive is not None:
+            payload["keep_alive"] = self.config.keep_alive
+        if self.config.num_ctx is not None:
+            payload["options"] = {"num_ctx": self.config.num_ctx}
+        return payload
+
+    @staticmethod
+    def _chat_content(chunk_obj: Any) -> Optional[str]:
+        if "message" in chunk_obj:
+            return chunk_obj["message"]["content"]
+        return None
+
+    def _json_format(self, kwargs: Any) -> bool:
+        """
+        Whether to constrain the response to JSON. A `response_format` passed by the
+        caller, as for OpenAIService, takes precedence over the configured default.
+        """
+        if "response_format" in kwargs:
+            return kwargs["response_format"] is not None
+        return self.config.response_format == "json"
+
+    @staticmethod
+    def _status_error(status_code: int, text: str, headers: Any) -> Exception:
+        message = f"Failed to get completion with error code {status_code}: {text}"
+        if is_retryable_status(status_code):
+            return RetryableError(
+                message, retry_after=parse_retry_after(headers.get("Retry-After"))
+            )
+        return Exception(message)
+
+    @staticmethod
+    def _record_usage(chunk_obj: Any) -> None:
+        """
+        Record the usage of the last chunk of a response. Ollama does not count cached
+        prompt tokens, but their reuse shows as a shorter prompt evaluation.
+        """
+        record_usage(chunk_obj.get("prompt_eval_count"), chunk_obj.get("eval_count"))
+        prompt_eval_ns = chunk_obj.get("prompt_eval_duration")
+        if prompt_eval_ns is not None:
+            telemetry.add("prompt_eval_seconds", prompt_eval_ns / 1e9)
+
+    @staticmethod
+    def _check_chunk(chunk_obj: Any) -> None:
+        if "error" in chunk_obj:
+            raise Exception(
+                f"Failed to get completion with error: {chunk_obj['error']}",
+            )
 
-        if stream is False:
-            with self._request_api(api_endpoint, payload) as resp:
-                if resp.status_code != 200:
-                    raise Exception(
-                        f"Failed to get completion with error code {resp.status_code}: {resp.text}",
-                    )
-                response: str = resp.json()["response"]
-            yield format_chat_message("assistant", response)
-
-        with self._request_api(api_endpoint, payload, stream=True) as resp:
-            if resp.status_code != 200:
-                raise Exception(
-                    f"Failed to get completion with error code {resp.status_code}: {resp.text}",
-                )
-            for chunk_obj in self._stream_process(resp):
-                if "error" in chunk_obj:
-                    raise Exception(
-                        f"Failed to get completion with error: {chunk_obj['error']}",
-                    )
-                if "message" in chunk_obj:
-                    message = chunk_obj["message"]
-                    yield format_chat_message("assistant", message["content"])
-
-    def _completion(
+    def _request_api(
         self,
-        messages: List[ChatMessageType],
-        stream: bool = True,
-        temperature: Optional[float] = None,
-        max_tokens: Optional[int] = None,
-        top_p: Optional[float] = None,
-        stop: Optional[List[str]] = None,
-        **kwargs: Any,
+        api_path: str,
+        payload: Dict[str, Any],
+        content_of: Callable[[Any], Optional[str]],
     ) -> Generator[ChatMessageType, None, None]:
-        api_endpoint = "/api/generate"
-        payload = {
-            "model": self.config.model,
-            "prompt": "",
-            "stream": stream,
-        }
-
-        if self.config.response_format == "json":
-            payload["format"] = "json"
-
-        for message in messages:
-            content: str = message["content"]
-            if message["role"] == "system":
-                payload["system"] = content
-            else:
-                payload["prompt"] = f"{payload['prompt']}\n{content}"
-
-        if stream is False:
-            with self._request_api(api_endpoint, payload) as resp:
+        """
+        Send a request through the pooled session, and yield the content of the single
+        response, or of each line of a streamed response.
+        """
+        url = f"{self.config.api_base}{api_path}"
+        try:
+            with self.session.post(
+                url,
+                json=payload,
+                stream=payload["stream"],
+                timeout=(self.config.connect_timeout, self.config.timeout),
+            ) as resp:
                 if resp.status_code != 200:
-                    raise Exception(
-                        f"Failed to get completion with error code {resp.status_code}: {resp.text}",
+                    raise self._status_error(
+                        resp.status_code, resp.text, resp.headers
                     )
-                response: str = resp.json()["response"]
-            yield format_chat_message("assistant", response)
-
-        with self._request_api(api_endpoint, payload, stream=True) as resp:
-            if resp.status_code != 200:
-                raise Exception(
-                    f"Failed to get completion with error code {resp.status_code}: {resp.text}",
-                )
-            for chunk_obj in self._stream_process(resp):
-                if "error" in chunk_obj:
-                    raise Exception(
-                        f"Failed to get completion with error: {chunk_obj['error']}",
+                if not payload["stream"]:
+                    chunk_objs: Any = [resp.json()]
+                else:
+                    chunk_objs = self._stream_process(resp)
+                for chunk_obj in chunk_objs:
+                    self._check_chunk(chunk_obj)
+                    if chunk_obj.get("done"):
+                        self._record_usage(chunk_obj)
+                    content = content_of(chunk_obj)
+                    if content is not None:
+                        yield format_chat_message("assistant", content)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            raise RetryableError(f"Ollama request failed: {e}") from e
+
+    async def _arequest_api(
+        self,
+        api_path: str,
+        payload: Dict[str, Any],
+        content_of: Callable[[Any], Optional[str]],
+    ) -> AsyncGenerator[ChatMessageType, None]:
+        client = self.async_clients.get()
+        try:
+            async with client.stream("POST", api_path, json=payload) as resp:
+                if resp.status_code != 200:
+                    await resp.aread()
+                    raise self._status_error(
+                        resp.status_code, resp.text, resp.headers
                     )
-                if "response" in chunk_obj:
-                    response = chunk_obj["response"]
-                    yield format_chat_message("assistant", response)
+                async for chunk_obj in self._astream_process(resp, payload["stream"]):
+                    self._check_chunk(chunk_obj)
+                    if chunk_obj.get("done"):
+                        self._record_usage(chunk_obj)
+                    content = content_of(chunk_obj)
+                    if content is not None:
+                        yield format_chat_message("assistant", content)
+        except httpx.TransportError as e:
+            raise RetryableError(f"Ollama request failed: {e}") from e
 
     def _stream_process(self, resp: requests.Response) -> Generator[Any, None, None]:
         for line in resp.iter_lines():
@@ -151,9 +207,19 @@ class OllamaService(CompletionService):
             if line_str and line_str.strip() != "":
                 yield json.loads(line_str)
 
-    @contextmanager
-    def _request_api(self, api_path: str, payload: Any, stream: bool = False):
-        url = f"{self.config.api_base}{api_path}"
-        with requests.Session() as session:
-            with session.post(url, json=payload, stream=stream) as resp:
-                yield resp
+    async def _astream_process(
+        self, resp: httpx.Response, stream: bool
+    ) -> AsyncGenerator[Any, None]:
+        if not stream:
+            await resp.aread()
+            yield resp.json()
+            return
+        async for line in resp.aiter_lines():
+            if line.strip() != "":
+                yield json.loads(line)
+
+    def close(self) -> None:
+        self.session.close()
+
+    async def aclose(self) -> None:
+        await self.async_clients.aclose()
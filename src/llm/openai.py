@@ -1,11 +1,15 @@
-from typing import Any, Generator, List, Optional
+import json
+from typing import Any, AsyncGenerator, Dict, Generator, List, Optional, Type
 
+import httpx
 import openai
-from openai import AzureOpenAI, OpenAI
+from openai import AsyncOpenAI, AzureOpenAI, OpenAI
 from pydantic import BaseModel
 
+from ..resilience import RetryableError, is_retryable_status, parse_retry_after
 from .base import CompletionService
-from .util import ChatMessageType, format_chat_message
+from .pool import AsyncClientPool
+from .util import ChatMessageType, format_chat_message, record_usage
 
 DEFAULT_STOP_TOKEN: List[str] = ["<EOS>"]
 
@@ -26,17 +30,146 @@ class OpenAIConfig(BaseModel):
     frequency_penalty: float = 0
     presence_penalty: float = 0
     seed: int = 123456
+    # connection pool of the HTTP clients, shared by every request
+    max_connections: int = 100
+    max_keepalive_connections: int = 20
+    timeout: float = 600
+    connect_timeout: float = 5
+    # ask for token usage at the end of streamed responses
+    stream_usage: bool = True
 
 
 class OpenAIService(CompletionService):
     config: OpenAIConfig
+    config_class: Type[OpenAIConfig] = OpenAIConfig
 
-    def __init__(self, api_key: str):
-        self.config = OpenAIConfig(api_key=api_key)
+    def __init__(self, api_key: str, **config: Any):
+        self.config = self.config_class(api_key=api_key, **config)
         self.client: OpenAI = OpenAI(
             base_url=self.config.api_base,
             api_key=self.config.api_key,
+            http_client=httpx.Client(
+                limits=httpx.Limits(
+                    max_connections=self.config.max_connections,
+                    max_keepalive_connections=self.config.max_keepalive_connections,
+                ),
+                timeout=self._timeout(),
+            ),
+            # failed requests are retried by the resilience layer, not the client
+            max_retries=0,
         )
+        self.async_clients: AsyncClientPool[AsyncOpenAI] = AsyncClientPool(
+            lambda limits: AsyncOpenAI(
+                base_url=self.config.api_base,
+                api_key=self.config.api_key,
+                http_client=httpx.AsyncClient(limits=limits, timeout=self._timeout()),
+                max_retries=0,
+            ),
+            lambda client: client.close(),
+            self.config.max_connections,
+            self.config.max_keepalive_connections,
+        )
+
+    def _timeout(self) -> httpx.Timeout:
+        return httpx.Timeout(self.config.timeout, connect=self.config.connect_timeout)
+
+    def _create_kwargs(
+        self,
+        messages: List[ChatMessageType],
+        stream: bool,
+        temperature: Optional[float],
+        max_tokens: Optional[int],
+        top_p: Optional[float],
+        stop: Optional[List[str]],
+        **kwargs: Any,
+    ) -> Dict[str, Any]:
+        tools_kwargs = {}
+        if "tools" in kwargs and "tool_choice" in kwargs:
+            tools_kwargs["tools"] = kwargs["tools"]
+            tools_kwargs["tool_choice"] = kwargs["tool_choice"]
+        if "response_format" in kwargs:
+            response_format = kwargs["response_format"]
+        elif self.config.response_format == "json_object":
+            response_format = {"type": "json_object"}
+        else:
+            response_format = None
+
+        stream_kwargs = {}
+        if stream and self.config.stream_usage:
+            stream_kwargs["stream_options"] = {"include_usage": True}
+
+        return dict(
+            model=self.config.model,
+            messages=messages,
+            temperature=(
+                temperature if temperature is not None else self.config.temperature
+            ),
+            max_tokens=max_tokens if max_tokens is not None else self.config.max_tokens,
+            top_p=top_p if top_p is not None else self.config.top_p,
+            frequency_penalty=self.config.frequency_penalty,
+            presence_penalty=self.config.presence_penalty,
+            stop=stop if stop is not None else self.config.stop_token,
+            stream=stream,
+            seed=self.config.seed,
+            response_format=response_format,
+            **stream_kwargs,
+            **tools_kwargs,
+        )
+
+    @staticmethod
+    def _api_error(e: openai.APIError) -> Exception:
+        """
+        The error to raise for an API error: a RetryableError, with the wait the API
+        asked for, if the request may succeed when sent again, or else the error itself.
+        """
+        if isinstance(e, openai.APIConnectionError):
+            return RetryableError(f"OpenAI API connection failed: {e}")
+        if isinstance(e, openai.APIStatusError) and is_retryable_status(e.status_code):
+            headers = e.response.headers
+            retry_after_ms = parse_retry_after(headers.get("retry-after-ms"))
+            return RetryableError(
+                f"OpenAI API returned an API Error: {e}",
+                retry_after=retry_after_ms / 1000
+                if retry_after_ms is not None
+                else parse_retry_after(headers.get("retry-after")),
+            )
+        return e
+
+    @staticmethod
+    def _record_usage(res: Any) -> None:
+        usage = getattr(res, "usage", None)
+        if usage is not None:
+            # openai 1.34 has no model of the details, so they are left as a dict
+            details = getattr(usage, "prompt_tokens_details", None)
+            if isinstance(details, dict):
+                cached_tokens = details.get("cached_tokens")
+            else:
+                cached_tokens = getattr(details, "cached_tokens", None)
+            record_usage(usage.prompt_tokens, usage.completion_tokens, cached_tokens)
+
+    def _response_message(self, res: Any) -> ChatMessageType:
+        self._record_usage(res)
+        oai_response = res.choices[0].message
+        if oai_response is None:
+            raise Exception("OpenAI API returned an empty response")
+        response: ChatMessageType = format_chat_message(
+            role=(
+                oai_response.role if oai_response.role is not None else "assistant"
+            ),
+            message=(oai_response.content if oai_response.content is not None else ""),
+        )
+        if oai_response.tool_calls is not None:
+            response["role"] = "function"
+            response["content"] = json.dumps(
+                [
+                    {
+                        "name": t.function.name,
+                        "arguments": json.loads(t.function.arguments),
+                    }
+                    for t in oai_response.tool_calls
+                ],
+            )
+        return response
 
     def chat_completion(
         self,
@@ -48,45 +181,16 @@ class OpenAIService(CompletionService):
         stop: Optional[List[str]] = None,
         **kwargs: Any,
     ) -> Generator[ChatMessageType, None, None]:
-        engine = self.config.model
-
-        temperature = (
-            temperature if temperature is not None else self.config.temperature
-        )
-        max_tokens = max_tokens if max_tokens is not None else self.config.max_tokens
-        top_p = top_p if top_p is not None else self.config.top_p
-        stop = stop if stop is not None else self.config.stop_token
-        seed = self.config.seed
-
         try:
-            tools_kwargs = {}
-            if "tools" in kwargs and "tool_choice" in kwargs:
-                tools_kwargs["tools"] = kwargs["tools"]
-                tools_kwargs["tool_choice"] = kwargs["tool_choice"]
-            if "response_format" in kwargs:
-                response_format = kwargs["response_format"]
-            elif self.config.response_format == "json_object":
-                response_format = {"type": "json_object"}
-            else:
-                response_format = None
-
             res: Any = self.client.chat.completions.create(
-                model=engine,
-                messages=messages,  # type: ignore
-                temperature=temperature,
-                max_tokens=max_tokens,
-                top_p=top_p,
-                frequency_penalty=self.config.frequency_penalty,
-                presence_penalty=self.config.presence_penalty,
-                stop=stop,
-                stream=stream,
-                seed=seed,
-                response_format=response_format,
-                **tools_kwargs,
+                **self._create_kwargs(
+                    messages, stream, temperature, max_tokens, top_p, stop, **kwargs
+                )
             )
             if stream:
                 role: Any = None
                 for stream_res in res:
+                    self._record_usage(stream_res)
                     if not stream_res.choices:
                         continue
                     delta = stream_res.choices[0].delta
@@ -95,37 +199,54 @@ class OpenAIService(CompletionService):
 
                     role = delta.role if delta.role is not None else role
                     content = delta.content if delta.content is not None else ""
-                    if content is None:
-                        continue
                     yield format_chat_message(role, content)
             else:
-                oai_response = res.choices[0].message
-                if oai_response is None:
-                    raise Exception("OpenAI API returned an empty response")
-                response: ChatMessageType = format_chat_message(
-                    role=(
-                        oai_response.role
-                        if oai_response.role is not None
-                        else "assistant"
-                    ),
-                    message=(
-                        oai_response.content if oai_response.content is not None else ""
-                    ),
+                yield self._response_message(res)
+        except openai.APIError as e:
+            error = self._api_error(e)
+            if error is e:
+                raise
+            raise error from e
+
+    async def achat_completion(
+        self,
+        messages: List[ChatMessageType],
+        stream: bool = True,
+        temperature: Optional[float] = None,
+        max_tokens: Optional[int] = None,
+        top_p: Optional[float] = None,
+        stop: Optional[List[str]] = None,
+        **kwargs: Any,
+    ) -> AsyncGenerator[ChatMessageType, None]:
+        try:
+            res: Any = await self.async_clients.get().chat.completions.create(
+                **self._create_kwargs(
+                    messages, stream, temperature, max_tokens, top_p, stop, **kwargs
                 )
-                if oai_response.tool_calls is not None:
-                    import json
-
-                    response["role"] = "function"
-                    response["content"] = json.dumps(
-                        [
-                            {
-                                "name": t.function.name,
-                                "arguments": json.loads(t.function.arguments),
-                            }
-                            for t in oai_response.tool_calls
-                        ],
-                    )
-                yield response
+            )
+            if stream:
+                role: Any = None
+                async for stream_res in res:
+                    self._record_usage(stream_res)
+                    if not stream_res.choices:
+                        continue
+                    delta = stream_res.choices[0].delta
+                    if delta is None:
+                        continue
+
+                    role = delta.role if delta.role is not None else role
+                    content = delta.content if delta.content is not None else ""
+                    yield format_chat_message(role, content)
+            else:
+                yield self._response_message(res)
         except openai.APIError as e:
-            # Handle API error, e.g. retry or log
-            raise Exception(f"OpenAI API returned an API Error: {e}")
+            error = self._api_error(e)
+            if error is e:
+                raise
+            raise error from e
+
+    def close(self) -> None:
+        self.client.close()
+
+    async def aclose(self) -> None:
+        await self.async_clients.aclose()
@@ -0,0 +1,486 @@
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Any, Dict, Generator, List, NamedTuple, Optional, Tuple
+
+from loguru import logger
+
+from ..resilience import is_retryable_status
+from .base import CompletionService
+from .cache import ResponseCache
+from .openai import OpenAIConfig, OpenAIService
+from .util import ChatMessageType, format_chat_message, record_usage
+
+DEFAULT_BATCH_STORE_PATH = ".cache/llm_batches.sqlite3"
+BATCH_ENDPOINT = "/v1/chat/completions"
+# statuses of a batch after which its output files no longer change
+FINISHED_BATCH_STATUSES = {"completed", "failed", "expired", "cancelled"}
+# how often the submitter checks for queued requests and renews its lease, and how
+# long a lease lasts without renewal before another process may take over
+SUBMITTER_TICK_SECONDS = 1.0
+LEASE_SECONDS = 120.0
+
+
+class OpenAIBatchConfig(OpenAIConfig):
+    api_type: str = "openai_batch"
+    # SQLite file of queued, submitted and answered requests, shared by every thread
+    # and process with the same path, and kept across runs
+    store_path: str = DEFAULT_BATCH_STORE_PATH
+    # queued requests are submitted as a batch once there are this many, or once the
+    # oldest has waited `flush_seconds`
+    max_batch_requests: int = 10_000
+    flush_seconds: float = 60
+    # how often submitted batches are checked for results
+    poll_seconds: float = 30
+    # how often a waiting call checks the store for its response
+    wait_seconds: float = 2
+    completion_window: str = "24h"
+    # attempts at a request that its batch failed with a retryable status
+    max_attempts: int = 3
+
+
+class BatchResult(NamedTuple):
+    # body of the chat completion, as JSON, if the request succeeded
+    response: Optional[str]
+    error: Optional[str]
+    # whether a failed request may succeed in another batch
+    retryable: bool
+
+
+class BatchStore:
+    """
+    SQLite-backed state of requests sent through a batch API: queued, submitted in a
+    batch, done with their response, or failed. The store can be shared by threads, and
+    by processes through the same file.
+
+    Requests are keyed by their content, so a run resumed after a crash finds the
+    requests it already submitted or got responses to, instead of sending them again.
+    """
+
+    def __init__(self, path: str | Path = DEFAULT_BATCH_STORE_PATH) -> None:
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS requests (
+                custom_id TEXT PRIMARY KEY,
+                body TEXT NOT NULL,
+                status TEXT NOT NULL,
+                batch_tag TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                response TEXT,
+                error TEXT,
+                queued REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS requests_status ON requests (status, queued);
+            CREATE INDEX IF NOT EXISTS requests_batch_tag ON requests (batch_tag);
+            CREATE TABLE IF NOT EXISTS batches (
+                tag TEXT PRIMARY KEY,
+                batch_id TEXT,
+                status TEXT NOT NULL,
+                created REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS lease (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                owner TEXT NOT NULL,
+                expires REAL NOT NULL
+            );
+            INSERT OR IGNORE INTO lease (id, owner, expires) VALUES (1, '', 0);
+            """
+        )
+        self._conn.commit()
+
+    def enqueue(self, custom_id: str, body: str) -> None:
+        """Queue a request, unless it is already queued, submitted or done."""
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO requests (custom_id, body, status, queued) VALUES (?, ?, 'queued', ?)",
+                (custom_id, body, time.time()),
+            )
+            # a request that failed before is tried again when it is asked for again
+            self._conn.execute(
+                "UPDATE requests SET status = 'queued', attempts = 0, error = NULL, queued = ? WHERE custom_id = ? AND status = 'failed'",
+                (time.time(), custom_id),
+            )
+            self._conn.commit()
+
+    def get(self, custom_id: str) -> Tuple[str, Optional[str], Optional[str]]:
+        """Return the status, response and error of a request."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT status, response, error FROM requests WHERE custom_id = ?",
+                (custom_id,),
+            ).fetchone()
+        if row is None:
+            raise KeyError(custom_id)
+        return row
+
+    def queued(self) -> Tuple[int, Optional[float]]:
+        """Return how many requests are queued, and when the oldest was queued."""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*), MIN(queued) FROM requests WHERE status = 'queued'"
+            ).fetchone()
+
+    def claim_queued(self, tag: str, limit: int) -> List[Tuple[str, str]]:
+        """
+        Mark the oldest queued requests, up to `limit`, as submitted in the batch of
+        `tag`, before the batch is created, and return their (custom_id, body).
+        """
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO batches (tag, status, created) VALUES (?, 'submitting', ?)",
+                (tag, time.time()),
+            )
+            # in one statement, so no other process can claim the same requests
+            self._conn.execute(
+                "UPDATE requests SET status = 'submitted', batch_tag = ? WHERE custom_id IN (SELECT custom_id FROM requests WHERE status = 'queued' ORDER BY queued LIMIT ?)",
+                (tag, limit),
+            )
+            self._conn.commit()
+            return self._conn.execute(
+                "SELECT custom_id, body FROM requests WHERE batch_tag = ? AND status = 'submitted'",
+                (tag,),
+            ).fetchall()
+
+    def set_batch(self, tag: str, batch_id: str, status: str) -> None:
+        with self._lock:
+            self._conn.execute(
+                "UPDATE batches SET batch_id = ?, status = ? WHERE tag = ?",
+                (batch_id, status, tag),
+            )
+            self._conn.commit()
+
+    def batches(self, status: str) -> List[Tuple[str, Optional[str], float]]:
+        """Return the (tag, batch_id, created) of the batches with a status."""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT tag, batch_id, created FROM batches WHERE status = ? ORDER BY created",
+                (status,),
+            ).fetchall()
+
+    def open_batches(self) -> List[Tuple[str, str]]:
+        """Return the (tag, batch_id) of the batches that have not finished."""
+        with self._lock:
+            return self._conn.execute(
+                f"SELECT tag, batch_id FROM batches WHERE batch_id IS NOT NULL AND status NOT IN ({','.join('?' * len(FINISHED_BATCH_STATUSES))}) ORDER BY created",
+                tuple(FINISHED_BATCH_STATUSES),
+            ).fetchall()
+
+    def finish_batch(
+        self,
+        tag: str,
+        status: str,
+        results: Dict[str, BatchResult],
+        max_attempts: int,
+    ) -> int:
+        """
+        Store the results of a finished batch. Requests that failed with a retryable
+        error, up to `max_attempts`, and requests the batch has no result for, e.g.
+        because it expired, are queued again. Returns how many were queued again.
+        """
+        with self._lock:
+            for custom_id, result in results.items():
+                if result.response is not None:
+                    self._conn.execute(
+                        "UPDATE requests SET status = 'done', response = ?, error = NULL WHERE custom_id = ? AND batch_tag = ?",
+                        (result.response, custom_id, tag),
+                    )
+                else:
+                    self._conn.execute(
+                        "UPDATE requests SET attempts = attempts + 1, error = ?, status = CASE WHEN ? AND attempts + 1 < ? THEN 'queued' ELSE 'failed' END WHERE custom_id = ? AND batch_tag = ?",
+                        (result.error, result.retryable, max_attempts, custom_id, tag),
+                    )
+            self._conn.execute(
+                "UPDATE requests SET status = 'queued' WHERE batch_tag = ? AND status = 'submitted'",
+                (tag,),
+            )
+            self._conn.execute(
+                "UPDATE batches SET status = ? WHERE tag = ?", (status, tag)
+            )
+            self._conn.commit()
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM requests WHERE batch_tag = ? AND status = 'queued'",
+                (tag,),
+            ).fetchone()[0]
+
+    def requeue_batch(self, tag: str) -> None:
+        """Queue again the requests of a batch that was never created."""
+        with self._lock:
+            self._conn.execute(
+                "UPDATE requests SET status = 'queued' WHERE batch_tag = ? AND status = 'submitted'",
+                (tag,),
+            )
+            self._conn.execute(
+                "UPDATE batches SET status = 'abandoned' WHERE tag = ?", (tag,)
+            )
+            self._conn.commit()
+
+    def acquire_lease(
+        self,
+        owner: str,
+        seconds: float = LEASE_SECONDS,
+        stale_owner: Optional[str] = None,
+    ) -> bool:
+        """
+        Take or renew the lease of the submitter, which only one service holds at a
+        time, taking it from `stale_owner` even if it has not expired. Returns whether
+        `owner` holds it.
+        """
+        now = time.time()
+        with self._lock:
+            acquired = self._conn.execute(
+                "UPDATE lease SET owner = ?, expires = ? WHERE id = 1 AND (owner = ? OR owner = ? OR expires < ?)",
+                (owner, now + seconds, owner, stale_owner, now),
+            ).rowcount
+            self._conn.commit()
+        return acquired > 0
+
+    def lease_owner(self) -> str:
+        with self._lock:
+            return self._conn.execute(
+                "SELECT owner FROM lease WHERE id = 1"
+            ).fetchone()[0]
+
+    def release_lease(self, owner: str) -> None:
+        with self._lock:
+            self._conn.execute(
+                "UPDATE lease SET expires = 0 WHERE id = 1 AND owner = ?", (owner,)
+            )
+            self._conn.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+def parse_batch_line(line: str) -> Tuple[str, BatchResult]:
+    """Parse a line of a batch's output or error file into its custom_id and result."""
+    data = json.loads(line)
+    response = data.get("response") or {}
+    status_code = response.get("status_code")
+    if status_code == 200:
+        return data["custom_id"], BatchResult(json.dumps(response["body"]), None, False)
+    error = data.get("error") or (response.get("body") or {}).get("error")
+    return data["custom_id"], BatchResult(
+        None,
+        json.dumps(error) if error is not None else f"status {status_code}",
+        status_code is None or is_retryable_status(status_code),
+    )
+
+
+class OpenAIBatchService(OpenAIService):
+    """
+    Completion service that sends requests through OpenAI's Batch API, for records that
+    can wait hours for their responses in exchange for a lower price and rate limits of
+    their own.
+
+    A call queues its request in a BatchStore and blocks until the response is stored.
+    One service at a time, holding the store's lease, submits queued requests as JSONL
+    batch files and polls the batches, so every process of a run with the same
+    `store_path` shares its batches.
+    """
+
+    deferred = True
+    config: OpenAIBatchConfig
+    config_class = OpenAIBatchConfig
+
+    def __init__(self, api_key: str, **config: Any):
+        super().__init__(api_key, **config)
+        self.store = BatchStore(self.config.store_path)
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._submitter: Optional[threading.Thread] = None
+        self._submitter_lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def chat_completion(
+        self,
+        messages: List[ChatMessageType],
+        stream: bool = True,
+        temperature: Optional[float] = None,
+        max_tokens: Optional[int] = None,
+        top_p: Optional[float] = None,
+        stop: Optional[List[str]] = None,
+        **kwargs: Any,
+    ) -> Generator[ChatMessageType, None, None]:
+        # a batch answers with whole responses, so `stream` is ignored
+        body = self._create_kwargs(
+            messages, False, temperature, max_tokens, top_p, stop, **kwargs
+        )
+        custom_id = ResponseCache.key(**body)
+        self.store.enqueue(custom_id, json.dumps(body))
+        self._start_submitter()
+        while True:
+            status, response, error = self.store.get(custom_id)
+            if status == "done":
+                break
+            if status == "failed":
+                raise Exception(f"OpenAI batch request failed: {error}")
+            time.sleep(self.config.wait_seconds)
+
+        res = json.loads(response)
+        usage = res.get("usage") or {}
+        record_usage(
+            usage.get("prompt_tokens"),
+            usage.get("completion_tokens"),
+            (usage.get("prompt_tokens_details") or {}).get("cached_tokens"),
+        )
+        message = res["choices"][0]["message"]
+        yield format_chat_message(
+            message.get("role") or "assistant", message.get("content") or ""
+        )
+
+    # answered from a thread by the base class, since calls block on the store
+    achat_completion = CompletionService.achat_completion
+
+    def _start_submitter(self) -> None:
+        with self._submitter_lock:
+            if self._submitter is None:
+                self._submitter = threading.Thread(
+                    target=self._run_submitter, name="llm-batch-submitter", daemon=True
+                )
+                self._submitter.start()
+
+    def _run_submitter(self) -> None:
+        leader = False
+        last_poll = 0.0
+        while not self._stop.wait(SUBMITTER_TICK_SECONDS):
+            try:
+                if not self.store.acquire_lease(
+                    self.owner, stale_owner=self._dead_owner()
+                ):
+                    leader = False
+                    continue
+                if not leader:
+                    logger.info(f"submitting llm batches [owner={self.owner}]")
+                    leader = True
+                    # batches left by a submitter that stopped part way through
+                    self._recover()
+                self._flush()
+                if time.monotonic() - last_poll >= self.config.poll_seconds:
+                    last_poll = time.monotonic()
+                    self._poll()
+            except Exception as e:
+                logger.warning(f"llm batch submitter failed, retrying: {e}")
+
+    def _dead_owner(self) -> Optional[str]:
+        """
+        The lease's owner if it is a process of this host that has exited, e.g. a run
+        that crashed, so the lease can be taken without waiting for it to expire.
+        """
+        owner = self.store.lease_owner()
+        host, _, rest = owner.partition(":")
+        pid = rest.partition(":")[0]
+        if owner == self.owner or host != socket.gethostname() or not pid.isdigit():
+            return None
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return owner
+        except PermissionError:
+            pass
+        return None
+
+    def _flush(self) -> None:
+        num_queued, oldest = self.store.queued()
+        if num_queued == 0:
+            return
+        if (
+            num_queued < self.config.max_batch_requests
+            and time.time() - oldest < self.config.flush_seconds
+        ):
+            return
+        tag = uuid.uuid4().hex
+        requests = self.store.claim_queued(tag, self.config.max_batch_requests)
+        if not requests:
+            self.store.requeue_batch(tag)
+            return
+        data = "".join(
+            json.dumps(
+                {
+                    "custom_id": custom_id,
+                    "method": "POST",
+                    "url": BATCH_ENDPOINT,
+                    "body": json.loads(body),
+                }
+            )
+            + "\n"
+            for custom_id, body in requests
+        )
+        try:
+            file = self.client.files.create(
+                file=(f"{tag}.jsonl", data.encode("utf-8")), purpose="batch"
+            )
+            batch = self.client.batches.create(
+                input_file_id=file.id,
+                endpoint=BATCH_ENDPOINT,
+                completion_window=self.config.completion_window,
+                metadata={"tag": tag},
+            )
+        except Exception:
+            self.store.requeue_batch(tag)
+            raise
+        self.store.set_batch(tag, batch.id, batch.status)
+        logger.info(
+            f"submitted llm batch {batch.id} [num_requests={len(requests)}]"
+        )
+
+    def _recover(self) -> None:
+        """
+        Find the batches of requests marked as submitting, which a crashed submitter
+        may or may not have created, by their tag, and queue again the requests of
+        those it did not.
+        """
+        submitting = self.store.batches("submitting")
+        if not submitting:
+            return
+        tags = {tag for tag, _, _ in submitting}
+        oldest = min(created for _, _, created in submitting)
+        for batch in self.client.batches.list(limit=100):
+            tag = (batch.metadata or {}).get("tag")
+            if tag in tags:
+                self.store.set_batch(tag, batch.id, batch.status)
+                tags.remove(tag)
+                logger.info(f"recovered llm batch {batch.id}")
+            # batches are listed newest first
+            if not tags or batch.created_at < oldest - LEASE_SECONDS:
+                break
+        for tag in tags:
+            self.store.requeue_batch(tag)
+
+    def _poll(self) -> None:
+        for tag, batch_id in self.store.open_batches():
+            batch = self.client.batches.retrieve(batch_id)
+            if batch.status not in FINISHED_BATCH_STATUSES:
+                self.store.set_batch(tag, batch_id, batch.status)
+                continue
+            results: Dict[str, BatchResult] = {}
+            for file_id in (batch.output_file_id, batch.error_file_id):
+                if file_id is None:
+                    continue
+                for line in self.client.files.content(file_id).text.splitlines():
+                    if line.strip():
+                        custom_id, result = parse_batch_line(line)
+                        results[custom_id] = result
+            requeued = self.store.finish_batch(
+                tag, batch.status, results, self.config.max_attempts
+            )
+            logger.info(
+                f"finished llm batch {batch_id} [status={batch.status}][num_results={len(results)}][num_requeued={requeued}]"
+            )
+
+    def close(self) -> None:
+        self._stop.set()
+        if self._submitter is not None:
+            self._submitter.join()
+        self.store.release_lease(self.owner)
+        self.store.close()
+        super().close()
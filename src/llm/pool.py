@@ -0,0 +1,62 @@
+import asyncio
+import itertools
+import math
+from typing import Awaitable, Callable, Generic, Iterator, List, Optional, TypeVar
+
+import httpx
+
+# connections in each pool of AsyncClientPool
+MAX_CONNECTIONS_PER_CLIENT = 32
+
+ClientType = TypeVar("ClientType")
+
+
+class AsyncClientPool(Generic[ClientType]):
+    """
+    Long-lived async HTTP clients, handed out in turn, that together keep up to
+    `max_connections` connections open.
+
+    httpcore assigns queued requests to connections in time that grows with the product
+    of the two, which costs more CPU than the requests themselves with hundreds of
+    connections in one pool. So the connections are split over clients of at most
+    `MAX_CONNECTIONS_PER_CLIENT` each.
+
+    Connections belong to the event loop that opened them, so the clients are created on
+    first use, and again if used from another event loop.
+    """
+
+    def __init__(
+        self,
+        create_client: Callable[[httpx.Limits], ClientType],
+        close_client: Callable[[ClientType], Awaitable[None]],
+        max_connections: int,
+        max_keepalive_connections: int,
+    ) -> None:
+        self.create_client = create_client
+        self.close_client = close_client
+        self.num_clients = math.ceil(max_connections / MAX_CONNECTIONS_PER_CLIENT)
+        self.limits = httpx.Limits(
+            max_connections=math.ceil(max_connections / self.num_clients),
+            max_keepalive_connections=math.ceil(
+                max_keepalive_connections / self.num_clients
+            ),
+        )
+        self._clients: List[ClientType] = []
+        self._turns: Optional[Iterator[ClientType]] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def get(self) -> ClientType:
+        loop = asyncio.get_running_loop()
+        if self._turns is None or self._loop is not loop:
+            self._clients = [
+                self.create_client(self.limits) for _ in range(self.num_clients)
+            ]
+            self._turns = itertools.cycle(self._clients)
+            self._loop = loop
+        return next(self._turns)
+
+    async def aclose(self) -> None:
+        for client in self._clients:
+            await self.close_client(client)
+        self._clients = []
+        self._turns = None
@@ -0,0 +1,150 @@
+import asyncio
+import multiprocessing
+import threading
+import time
+from typing import Optional
+
+
+class RateLimiter:
+    """
+    Token-bucket limiter for requests per minute and tokens per minute, shared by every
+    thread or task sending requests to the same API.
+
+    Both buckets start full and refill continuously. Tokens are estimated and charged
+    for the prompt before a request is sent, and for the completion once it is received.
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: Optional[int] = None,
+        tokens_per_minute: Optional[int] = None,
+    ):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._requests = float(requests_per_minute or 0)
+        self._tokens = float(tokens_per_minute or 0)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        elapsed = now - self._updated
+        self._updated = now
+        if self.requests_per_minute:
+            self._requests = min(
+                self.requests_per_minute,
+                self._requests + elapsed * self.requests_per_minute / 60,
+            )
+        if self.tokens_per_minute:
+            self._tokens = min(
+                self.tokens_per_minute,
+                self._tokens + elapsed * self.tokens_per_minute / 60,
+            )
+
+    def _try_acquire(self, tokens: int) -> float:
+        """
+        Charge one request of `tokens` tokens if it fits within both budgets and return
+        0, or else return the number of seconds until it will fit.
+        """
+        with self._lock:
+            self._refill()
+            wait = 0.0
+            if self.requests_per_minute and self._requests < 1:
+                wait = (1 - self._requests) * 60 / self.requests_per_minute
+            if self.tokens_per_minute and self._tokens < tokens:
+                wait = max(wait, (tokens - self._tokens) * 60 / self.tokens_per_minute)
+            if wait == 0:
+                if self.requests_per_minute:
+                    self._requests -= 1
+                if self.tokens_per_minute:
+                    self._tokens -= tokens
+            return wait
+
+    def _request_tokens(self, tokens: int) -> int:
+        if self.tokens_per_minute:
+            # a request larger than the whole budget waits for a full bucket
+            return min(tokens, self.tokens_per_minute)
+        return tokens
+
+    def acquire(self, tokens: int = 0) -> float:
+        """
+        Block until one request of `tokens` tokens fits within both budgets, then charge
+        it. Returns the number of seconds spent waiting.
+        """
+        tokens = self._request_tokens(tokens)
+        waited = 0.0
+        while (wait := self._try_acquire(tokens)) > 0:
+            time.sleep(wait)
+            waited += wait
+        return waited
+
+    async def aacquire(self, tokens: int = 0) -> float:
+        """
+        Like `acquire`, but waits without blocking the event loop.
+        """
+        tokens = self._request_tokens(tokens)
+        waited = 0.0
+        while (wait := self._try_acquire(tokens)) > 0:
+            await asyncio.sleep(wait)
+            waited += wait
+        return waited
+
+    def consume(self, tokens: int) -> None:
+        """
+        Charge tokens that were used after a request was let through, e.g. by its completion.
+        """
+        with self._lock:
+            self._refill()
+            if self.tokens_per_minute:
+                self._tokens -= tokens
+
+
+class SharedRateLimiter(RateLimiter):
+    """
+    A RateLimiter whose budgets are shared by processes, e.g. the workers of a process
+    pool, as well as by threads. The buckets live in shared memory, so the limiter must
+    be passed to the processes when they are started, e.g. as an initializer argument.
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: Optional[int] = None,
+        tokens_per_minute: Optional[int] = None,
+    ):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        # requests and tokens left, and when they were last refilled on the monotonic
+        # clock, which is the same for every process of the machine
+        self._state = multiprocessing.RawArray(
+            "d",
+            [
+                float(requests_per_minute or 0),
+                float(tokens_per_minute or 0),
+                time.monotonic(),
+            ],
+        )
+        self._lock = multiprocessing.Lock()
+
+    @property
+    def _requests(self) -> float:
+        return self._state[0]
+
+    @_requests.setter
+    def _requests(self, value: float) -> None:
+        self._state[0] = value
+
+    @property
+    def _tokens(self) -> float:
+        return self._state[1]
+
+    @_tokens.setter
+    def _tokens(self, value: float) -> None:
+        self._state[1] = value
+
+    @property
+    def _updated(self) -> float:
+        return self._state[2]
+
+    @_updated.setter
+    def _updated(self, value: float) -> None:
+        self._state[2] = value
@@ -0,0 +1,106 @@
+from typing import Any, AsyncGenerator, Generator, Iterator, List, Optional, Tuple
+
+from ..resilience import ResiliencePolicy, Resilient
+from .base import CompletionService
+from .util import ChatMessageType
+
+
+class ResilientCompletionService(CompletionService):
+    """
+    Completion service that sends each request of `completion_service` with a deadline,
+    retries, optional hedging and a circuit breaker, as set by `policy`.
+
+    A response is only yielded once it is complete, since a request that fails part way
+    through a stream is sent again from the start. `chat_completion_stream` instead
+    yields chunks as they arrive, guarding the request only up to its first chunk.
+    """
+
+    def __init__(
+        self,
+        completion_service: CompletionService,
+        policy: Optional[ResiliencePolicy] = None,
+    ) -> None:
+        self.completion_service = completion_service
+        self.config = completion_service.config
+        self.resilient = Resilient("llm", policy)
+        self.stream_resilient = Resilient(
+            "llm", policy, breaker=self.resilient.breaker
+        )
+
+    def chat_completion(
+        self,
+        messages: List[ChatMessageType],
+        stream: bool = True,
+        temperature: Optional[float] = None,
+        max_tokens: Optional[int] = None,
+        top_p: Optional[float] = None,
+        stop: Optional[List[str]] = None,
+        **kwargs: Any,
+    ) -> Generator[ChatMessageType, None, None]:
+        yield from self.resilient.call(
+            lambda: list(
+                self.completion_service.chat_completion(
+                    messages, stream, temperature, max_tokens, top_p, stop, **kwargs
+                )
+            )
+        )
+
+    def chat_completion_stream(
+        self,
+        messages: List[ChatMessageType],
+        stream: bool = True,
+        temperature: Optional[float] = None,
+        max_tokens: Optional[int] = None,
+        top_p: Optional[float] = None,
+        stop: Optional[List[str]] = None,
+        **kwargs: Any,
+    ) -> Generator[ChatMessageType, None, None]:
+        """
+        Like `chat_completion`, but yields each chunk as it arrives. Only the wait for
+        the first chunk has the deadline, retries and hedging; an error after it is
+        raised to the caller, who has already seen part of the response.
+        """
+
+        def first_chunk() -> (
+            Tuple[Optional[ChatMessageType], Iterator[ChatMessageType]]
+        ):
+            chunks = iter(
+                self.completion_service.chat_completion(
+                    messages, stream, temperature, max_tokens, top_p, stop, **kwargs
+                )
+            )
+            return next(chunks, None), chunks
+
+        chunk, chunks = self.stream_resilient.call(first_chunk)
+        if chunk is not None:
+            yield chunk
+        yield from chunks
+
+    async def achat_completion(
+        self,
+        messages: List[ChatMessageType],
+        stream: bool = True,
+        temperature: Optional[float] = None,
+        max_tokens: Optional[int] = None,
+        top_p: Optional[float] = None,
+        stop: Optional[List[str]] = None,
+        **kwargs: Any,
+    ) -> AsyncGenerator[ChatMessageType, None]:
+        async def collect() -> List[ChatMessageType]:
+            return [
+                chunk
+                async for chunk in self.completion_service.achat_completion(
+                    messages, stream, temperature, max_tokens, top_p, stop, **kwargs
+                )
+            ]
+
+        for chunk in await self.resilient.acall(collect):
+            yield chunk
+
+    def close(self) -> None:
+        self.resilient.close()
+        self.stream_resilient.close()
+        self.completion_service.close()
+
+    async def aclose(self) -> None:
+        await self.completion_service.aclose()
@@ -0,0 +1,99 @@
+import argparse
+import threading
+from typing import Dict, Literal, Optional
+
+from pydantic import BaseModel
+
+# "fast" prompts go to the fast tier first, and "strong" prompts straight to the
+# strong tier, i.e. the LLMApi's own completion service
+Tier = Literal["fast", "strong"]
+
+# telemetry span of each call to the fast tier, so its token usage is told apart
+FAST_TIER_SPAN = "llm.fast_tier"
+
+
+class RoutingConfig(BaseModel):
+    """
+    A cheaper, faster model that prompts are sent to first, falling back to the strong
+    model when its response fails the caller's validation.
+    """
+
+    fast_api_type: str = "ollama"
+    # model of the fast tier, or the default model of its api type if None
+    fast_model: Optional[str] = None
+    # tier of each prompt, by prompt name. Prompts not listed use `default_tier`.
+    routes: Dict[str, Tier] = {}
+    default_tier: Tier = "fast"
+
+    def tier(self, prompt_name: Optional[str]) -> Tier:
+        if prompt_name is None:
+            return self.default_tier
+        return self.routes.get(prompt_name, self.default_tier)
+
+
+class TierStats(BaseModel):
+    # responses of the fast tier that passed validation
+    fast: int = 0
+    # responses of the fast tier that failed validation, sent again to the strong tier
+    escalated: int = 0
+    # prompts routed straight to the strong tier
+    strong: int = 0
+
+
+class RoutingStats:
+    """How often each tier answered, by prompt name."""
+
+    def __init__(self) -> None:
+        self._stats: Dict[str, TierStats] = {}
+        self._lock = threading.Lock()
+
+    def add(self, prompt_name: Optional[str], outcome: str) -> None:
+        with self._lock:
+            stats = self._stats.setdefault(prompt_name or "unnamed", TierStats())
+            setattr(stats, outcome, getattr(stats, outcome) + 1)
+
+    def snapshot(self) -> Dict[str, TierStats]:
+        with self._lock:
+            return {name: stats.model_copy() for name, stats in self._stats.items()}
+
+
+def add_routing_args(parser: argparse.ArgumentParser) -> None:
+    """Add the command line arguments of a RoutingConfig to a parser."""
+    from . import llm_completion_config_map
+
+    parser.add_argument(
+        "--fast-api-type",
+        type=str,
+        default=None,
+        choices=sorted(llm_completion_config_map),
+        help="Send prompts to a fast, cheap model of this backend first, escalating to the --api-type model when its response fails validation",
+    )
+    parser.add_argument(
+        "--fast-model",
+        type=str,
+        default=None,
+        help="Model of the fast backend (default: the backend's default model)",
+    )
+    parser.add_argument(
+        "--strong-prompt",
+        metavar="name",
+        type=str,
+        action="append",
+        default=[],
+        help="Send this prompt straight to the --api-type model, e.g. detect_encounter_boundary",
+    )
+
+
+def routing_from_args(
+    parser: argparse.ArgumentParser, args: argparse.Namespace
+) -> Optional[RoutingConfig]:
+    """The RoutingConfig of the arguments added by `add_routing_args`, if any."""
+    if (args.fast_model or args.strong_prompt) and not args.fast_api_type:
+        parser.error("--fast-model and --strong-prompt require --fast-api-type")
+    if not args.fast_api_type:
+        return None
+    return RoutingConfig(
+        fast_api_type=args.fast_api_type,
+        fast_model=args.fast_model,
+        routes={name: "strong" for name in args.strong_prompt},
+    )
@@ -1,8 +1,27 @@
-from typing import Dict, Literal, Optional
+from typing import Dict, List, Literal, Optional
+
+from ..telemetry import telemetry
 
 ChatMessageRoleType = Literal["system", "user", "assistant", "function"]
 ChatMessageType = Dict[Literal["role", "name", "content"], str]
 
+# completion service config fields that do not change responses, left out of cache keys
+CONNECTION_CONFIG_FIELDS = {
+    "max_connections",
+    "max_keepalive_connections",
+    "timeout",
+    "connect_timeout",
+    "stream_usage",
+    "keep_alive",
+    "store_path",
+    "max_batch_requests",
+    "flush_seconds",
+    "poll_seconds",
+    "wait_seconds",
+    "completion_window",
+    "max_attempts",
+}
+
 
 def format_chat_message(
     role: ChatMessageRoleType,
@@ -16,3 +35,31 @@ def format_chat_message(
     if name is not None:
         msg["name"] = name
     return msg
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Rough token count of a text, at about four characters per token for English.
+    """
+    return len(text) // 4 + 1
+
+
+def estimate_messages_tokens(messages: List[ChatMessageType]) -> int:
+    return sum(estimate_tokens(message["content"]) for message in messages)
+
+
+def record_usage(
+    prompt_tokens: Optional[int],
+    completion_tokens: Optional[int],
+    cached_prompt_tokens: Optional[int] = None,
+) -> None:
+    """
+    Add the token usage reported by an API to the current telemetry span, including the
+    prompt tokens the API read from its prompt cache, if it reports them.
+    """
+    if prompt_tokens is not None:
+        telemetry.add("prompt_tokens", prompt_tokens)
+    if completion_tokens is not None:
+        telemetry.add("completion_tokens", completion_tokens)
+    if cached_prompt_tokens is not None:
+        telemetry.add("cached_prompt_tokens", cached_prompt_tokens)
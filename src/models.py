@@ -1,6 +1,7 @@
-from typing import List, Optional
+from typing import Dict, List, Optional, TextIO, Tuple
 from datetime import datetime
 from uuid import uuid4
+import json
 
 from pydantic import BaseModel, Field, UUID4
 
@@ -10,10 +11,13 @@ class MedicalEncounter(BaseModel):
     Event represents a single medical encounter in a patient's record.
     """
 
+    id: UUID4 = Field(default_factory=uuid4)
     content: str
     findings: List[str]
     prescriptions: List[str]
     timestamp: Optional[datetime] = None
+    # index of the earlier encounter in the record that this one duplicates
+    duplicate_of: Optional[int] = None
 
 
 class MedicalRecord(BaseModel):
@@ -24,3 +28,81 @@ class MedicalRecord(BaseModel):
     id: UUID4 = Field(default_factory=uuid4)
     content: str
     encounters: List[MedicalEncounter] = []
+    # index of each duplicate page to the index of the first page it duplicates
+    duplicate_pages: Dict[int, int] = {}
+
+
+# a span of text, as (start, end) character offsets with `end` exclusive
+TextSpan = Tuple[int, int]
+
+
+class CompactMedicalEncounter(BaseModel):
+    """
+    A medical encounter that refers to its text in the content of its record by
+    character offsets, instead of holding a copy of it.
+    """
+
+    id: UUID4 = Field(default_factory=uuid4)
+    # spans of the record content that make up the encounter's text, more than one
+    # if duplicate pages within the encounter were left out
+    spans: List[TextSpan]
+    # indexes of the pages the encounter's text comes from
+    pages: List[int]
+    findings: List[str]
+    prescriptions: List[str]
+    timestamp: Optional[datetime] = None
+    duplicate_of: Optional[int] = None
+
+
+class CompactMedicalRecord(BaseModel):
+    """
+    A patient's medical record whose encounters share the record content as their text.
+    """
+
+    id: UUID4 = Field(default_factory=uuid4)
+    content: str
+    # character offset of the start of each page in the content
+    page_offsets: List[int] = []
+    encounters: List[CompactMedicalEncounter] = []
+    duplicate_pages: Dict[int, int] = {}
+
+    def encounter_text(self, encounter: CompactMedicalEncounter) -> str:
+        """
+        Return the text of an encounter, as it is in `MedicalEncounter.content`.
+        """
+        text = "".join(self.content[start:end] for start, end in encounter.spans)
+        return "\n".join(text.splitlines())
+
+    def expand_encounter(self, encounter: CompactMedicalEncounter) -> MedicalEncounter:
+        return MedicalEncounter(
+            content=self.encounter_text(encounter),
+            **encounter.model_dump(exclude={"spans", "pages"}),
+        )
+
+    def expand(self) -> MedicalRecord:
+        return MedicalRecord(
+            id=self.id,
+            content=self.content,
+            encounters=[self.expand_encounter(e) for e in self.encounters],
+            duplicate_pages=self.duplicate_pages,
+        )
+
+    def write_json(self, fp: TextIO, expanded: bool = False) -> None:
+        """
+        Write the record as JSON, either compact or in the expanded form of a
+        MedicalRecord. Expanded encounters are written one at a time, so their text is
+        never all in memory at once.
+        """
+        if not expanded:
+            fp.write(self.model_dump_json())
+            return
+        fp.write(f'{{"id":"{self.id}","content":')
+        fp.write(json.dumps(self.content, ensure_ascii=False))
+        fp.write(',"encounters":[')
+        for i, encounter in enumerate(self.encounters):
+            if i > 0:
+                fp.write(",")
+            fp.write(self.expand_encounter(encounter).model_dump_json())
+        fp.write('],"duplicate_pages":')
+        fp.write(json.dumps(self.duplicate_pages, separators=(",", ":")))
+        fp.write("}")
@@ -0,0 +1,139 @@
+import argparse
+import os
+import threading
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+from loguru import logger
+from pydantic import BaseModel
+
+DEFAULT_OCR_CACHE_DIR = ".cache/ocr"
+DEFAULT_OCR_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+
+class OCRCacheInfo(BaseModel):
+    path: str
+    num_entries: int
+    total_bytes: int
+    max_bytes: int
+
+
+class OCRCache:
+    """
+    Content-addressed on-disk cache of OCR text, one file per PDF page.
+
+    Entries are keyed by a hash of the page's bytes. Reads refresh an entry's mtime, and
+    the least recently used entries are evicted once the cache grows past `max_bytes`.
+    The size of the cache is counted once when it is opened and kept up to date by
+    writes, so the directory is only scanned again when it has to be evicted from.
+    """
+
+    def __init__(
+        self,
+        path: str | Path = DEFAULT_OCR_CACHE_DIR,
+        max_bytes: int = DEFAULT_OCR_CACHE_MAX_BYTES,
+    ) -> None:
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self.path.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._total_bytes = sum(size for _, size, _ in self._entries())
+
+    def _entry_path(self, key: str) -> Path:
+        return self.path / f"{key}.txt"
+
+    def get(self, key: str) -> Optional[str]:
+        entry_path = self._entry_path(key)
+        try:
+            text = entry_path.read_text(encoding="utf-8")
+            os.utime(entry_path)
+        except FileNotFoundError:
+            return None
+        return text
+
+    def put(self, key: str, text: str) -> None:
+        entry_path = self._entry_path(key)
+        # unique to the process and thread, since batch workers share the cache
+        tmp_path = entry_path.with_suffix(
+            f".{os.getpid()}.{threading.get_ident()}.tmp"
+        )
+        tmp_path.write_bytes(text.encode("utf-8"))
+        size = tmp_path.stat().st_size
+        try:
+            old_size = entry_path.stat().st_size
+        except FileNotFoundError:
+            old_size = 0
+        os.replace(tmp_path, entry_path)
+        with self._lock:
+            self._total_bytes += size - old_size
+            over = self._total_bytes > self.max_bytes
+        if over:
+            self.evict()
+
+    def __contains__(self, key: str) -> bool:
+        return self._entry_path(key).exists()
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self.path.glob("*.txt"))
+
+    def _entries(self) -> List[Tuple[float, int, Path]]:
+        """Return the (mtime, size, path) of every entry."""
+        entries = []
+        for entry_path in self.path.glob("*.txt"):
+            try:
+                stat = entry_path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry_path))
+        return entries
+
+    def evict(self) -> int:
+        """
+        Remove least recently used entries until the cache fits in `max_bytes`.
+        Returns the number of entries removed.
+        """
+        with self._lock:
+            entries = self._entries()
+            # recounted, since other processes may have written or evicted entries
+            total_bytes = sum(size for _, size, _ in entries)
+            self._total_bytes = total_bytes
+            if total_bytes <= self.max_bytes:
+                return 0
+
+            num_evicted = 0
+            for _, size, entry_path in sorted(entries):
+                if total_bytes <= self.max_bytes:
+                    break
+                entry_path.unlink(missing_ok=True)
+                total_bytes -= size
+                num_evicted += 1
+            self._total_bytes = total_bytes
+            logger.info(f"evicted ocr cache entries [num_evicted={num_evicted}]")
+            return num_evicted
+
+    def clear(self) -> None:
+        with self._lock:
+            for entry_path in self.path.glob("*.txt"):
+                entry_path.unlink(missing_ok=True)
+            self._total_bytes = 0
+
+    def info(self) -> OCRCacheInfo:
+        sizes = [p.stat().st_size for p in self.path.glob("*.txt")]
+        return OCRCacheInfo(
+            path=str(self.path),
+            num_entries=len(sizes),
+            total_bytes=sum(sizes),
+            max_bytes=self.max_bytes,
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect or clear the OCR cache")
+    parser.add_argument("--path", type=str, default=DEFAULT_OCR_CACHE_DIR)
+    parser.add_argument("--clear", action="store_true", help="Remove every entry")
+    args = parser.parse_args()
+
+    cache = OCRCache(args.path)
+    if args.clear:
+        cache.clear()
+    print(cache.info().model_dump_json())
@@ -1,25 +1,71 @@
-import math
-import mimetypes
+import hashlib
 import os
+import re
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from io import BytesIO
 from pathlib import Path
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Deque,
+    Generator,
+    Iterable,
+    List,
+    Tuple,
+)
 
-from google.api_core.client_options import ClientOptions
-from google.cloud import documentai
-from google.cloud.documentai_v1 import Document
 from loguru import logger
-from pypdf import PdfReader, PdfWriter
+from pydantic import BaseModel
+from pypdf import PageObject, PdfReader, PdfWriter
+from pypdf.generic import ArrayObject, DictionaryObject, IndirectObject, StreamObject
+
+from .ocr_cache import OCRCache
+from .resilience import ResiliencePolicy, Resilient, RetryableError
+from .telemetry import span
+
+# the DocumentAI client and its grpc stack take a long time to import, so they are only
+# imported when a PDF is first sent for OCR
+if TYPE_CHECKING:
+    from google.cloud.documentai_v1 import Document
+
+# any callable taking (content, mime_type) and returning a Document, e.g. DocumentAI or a local fake
+OCRClient = Callable[..., "Document"]
+
+# online processing request size limit of DocumentAI
+DOCUMENT_AI_MAX_BYTES = 20 * 1024 * 1024
+
+WORD_RE = re.compile(r"^[(\[\"']?[A-Za-z0-9][\w'/.,:;%&#+-]*[)\]\"'.,:;?!]*$")
 
 
 class DocumentAI:
     """Wrapper class around GCP's DocumentAI API."""
 
-    def __init__(self) -> None:
+    def __init__(self, timeout: float = 300) -> None:
+        from google.api_core import exceptions
+        from google.api_core.client_options import ClientOptions
+        from google.cloud import documentai
+
+        self.documentai = documentai
+        self.timeout = timeout
+        # errors on which a request may succeed if sent again
+        self.retryable_errors = (
+            exceptions.TooManyRequests,
+            exceptions.ResourceExhausted,
+            exceptions.ServiceUnavailable,
+            exceptions.InternalServerError,
+            exceptions.BadGateway,
+            exceptions.GatewayTimeout,
+            exceptions.DeadlineExceeded,
+            exceptions.Aborted,
+        )
         self.client_options = ClientOptions(  # type: ignore
             api_endpoint=f"{os.getenv('GCP_REGION')}-documentai.googleapis.com",
             credentials_file=os.getenv("GOOGLE_APPLICATION_CREDENTIALS"),
         )
-        self.client = documentai.DocumentProcessorServiceClient(
+        self.client = self.documentai.DocumentProcessorServiceClient(
             client_options=self.client_options
         )
         self.processor_name = self.client.processor_path(
@@ -30,55 +76,331 @@ class DocumentAI:
 
     def __call__(
         self, content: bytes, mime_type: str | None = "application/pdf"
-    ) -> Document:
+    ) -> "Document":
         """Convert bytes into a GCP document. Performs full OCR extraction and layout parsing."""
         #
-        raw_document = documentai.RawDocument(content=content, mime_type=mime_type)
+        raw_document = self.documentai.RawDocument(
+            content=content, mime_type=mime_type
+        )
 
         # Configure the process request
-        request = documentai.ProcessRequest(
+        request = self.documentai.ProcessRequest(
             name=self.processor_name, raw_document=raw_document
         )
 
-        result = self.client.process_document(request=request)
+        try:
+            # failed requests are retried by the resilience layer, not the client
+            result = self.client.process_document(
+                request=request, timeout=self.timeout, retry=None
+            )
+        except self.retryable_errors as e:
+            raise RetryableError(f"DocumentAI request failed: {e}") from e
         document = result.document
 
         return document
 
 
-def pdf_text(file_path: Path) -> str:
-    mime_type = mimetypes.guess_type(file_path)[0]
+def page_fingerprint(page: PageObject) -> Tuple[str, int]:
+    """
+    Return a content hash of a PDF page (its content streams, resources and images) and
+    the number of stream bytes the page references, as an estimate of its size.
+    Identical pages hash the same regardless of which PDF, or where in it, they appear.
+    """
+    digest = hashlib.sha256()
+    seen = set()
+    num_bytes = 0
+
+    def update(obj: Any) -> None:
+        nonlocal num_bytes
+        if isinstance(obj, IndirectObject):
+            ref = (obj.idnum, obj.generation)
+            if ref in seen:
+                digest.update(b"<ref>")
+                return
+            seen.add(ref)
+            obj = obj.get_object()
+        if isinstance(obj, StreamObject):
+            data = obj._data or b""
+            digest.update(data.encode("utf-8") if isinstance(data, str) else data)
+            num_bytes += len(data)
+        if isinstance(obj, DictionaryObject):
+            for key in sorted(obj.keys()):
+                # the parent page tree differs between PDFs that share a page
+                if key == "/Parent":
+                    continue
+                digest.update(key.encode("utf-8"))
+                update(obj.raw_get(key))
+        elif isinstance(obj, ArrayObject):
+            digest.update(b"[")
+            for item in obj:
+                update(item)
+            digest.update(b"]")
+        else:
+            digest.update(repr(obj).encode("utf-8"))
+
+    update(page)
+    return digest.hexdigest(), num_bytes
+
+
+def document_page_texts(document: "Document") -> List[str] | None:
+    """
+    Split the text of a Document into the text of each of its pages, using the text
+    anchors of the page layouts. Returns None if the Document has no page layout.
+    """
+    starts = []
+    for page in document.pages:
+        segments = page.layout.text_anchor.text_segments
+        if not segments:
+            return None
+        starts.append(int(segments[0].start_index))
+    if not starts:
+        return None
+    starts[0] = 0
+    ends = starts[1:] + [len(document.text)]
+    return [document.text[start:end] for start, end in zip(starts, ends)]
+
+
+def release_page_data(reader: PdfReader) -> None:
+    """
+    Drop pypdf's cache of parsed objects, so the page data read from the PDF so far can
+    be freed. Objects are parsed again from the file when next needed.
+    """
+    reader.resolved_objects.clear()
+
+
+def write_pages(reader: PdfReader, page_indexes: List[int]) -> bytes:
+    """
+    Write the given pages of a PDF into a new in-memory PDF.
+    """
+    writer = PdfWriter()
+    for i in page_indexes:
+        writer.add_page(reader.pages[i])
+    with BytesIO() as new_bytes_stream:
+        writer.write(new_bytes_stream)
+        return new_bytes_stream.getvalue()
+
+
+def budget_chunks(
+    page_indexes: List[int], page_sizes: List[int], max_pages: int, max_bytes: int
+) -> List[List[int]]:
+    """
+    Group pages, in order, into chunks of at most `max_pages` pages whose estimated
+    size stays within `max_bytes`. A page larger than `max_bytes` gets a chunk of its own.
+    """
+    chunks: List[List[int]] = []
+    chunk: List[int] = []
+    chunk_bytes = 0
+    for i in page_indexes:
+        if chunk and (
+            len(chunk) >= max_pages or chunk_bytes + page_sizes[i] > max_bytes
+        ):
+            chunks.append(chunk)
+            chunk, chunk_bytes = [], 0
+        chunk.append(i)
+        chunk_bytes += page_sizes[i]
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+class ResilientOCRClient:
+    """
+    OCR client that sends each request of `document_ai` with a deadline, retries,
+    optional hedging and a circuit breaker, as set by `policy`.
+    """
+
+    def __init__(
+        self, document_ai: OCRClient, policy: ResiliencePolicy | None = None
+    ) -> None:
+        self.document_ai = document_ai
+        self.resilient = Resilient("ocr", policy)
+
+    def __call__(
+        self, content: bytes, mime_type: str | None = "application/pdf"
+    ) -> "Document":
+        return self.resilient.call(
+            lambda: self.document_ai(content, mime_type=mime_type)
+        )
+
+
+def ocr_chunks(
+    document_ai: OCRClient,
+    chunks: Iterable[bytes],
+    max_workers: int = 4,
+) -> Generator["Document", None, None]:
+    """
+    OCR each PDF chunk with at most `max_workers` requests in flight.
+
+    Yields the Document of each chunk in the same order as `chunks`. Chunks are pulled
+    from `chunks` lazily, so only a bounded number are held in memory at once.
+    """
+
+    def ocr_chunk(i: int, chunk: bytes) -> "Document":
+        started = time.perf_counter()
+        with span("pdf.ocr_chunk", chunk=i, num_bytes=len(chunk)):
+            doc = document_ai(chunk, mime_type="application/pdf")
+        logger.info(
+            f"scanned pdf chunk {i} [seconds={time.perf_counter() - started:.2f}][num_bytes={len(chunk)}]"
+        )
+        return doc
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending: Deque[Future] = deque()
+        for i, chunk in enumerate(chunks):
+            pending.append(executor.submit(ocr_chunk, i, chunk))
+            # keep one queued chunk per worker, so the next request is ready to go
+            if len(pending) >= 2 * max_workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def native_text_quality(text: str, min_chars: int = 100) -> float:
+    """
+    Score from 0 to 1 how usable the embedded text layer of a page is. Scanned pages
+    have little or no text, and broken font encodings produce unprintable characters
+    or runs of symbols that do not look like words.
+    """
+    stripped = text.strip()
+    if len(stripped) < min_chars:
+        return 0.0
+    printable = sum(1 for c in stripped if c.isprintable() or c.isspace())
+    tokens = stripped.split()
+    words = sum(1 for token in tokens if WORD_RE.match(token))
+    return (printable / len(stripped)) * (words / len(tokens))
+
+
+class PdfPages(BaseModel):
+    """
+    Text of each page of a PDF, with counts of how the page texts were obtained.
+    """
+
+    texts: List[str]
+    hashes: List[str]
+    native_pages: int = 0
+    cached_pages: int = 0
+    ocr_pages: int = 0
+
+
+def pdf_pages(
+    file_path: Path,
+    document_ai: OCRClient | None = None,
+    chunk_size: int = 10,
+    chunk_max_bytes: int = DOCUMENT_AI_MAX_BYTES,
+    max_workers: int = 4,
+    max_retries: int = 2,
+    ocr_cache: OCRCache | None = None,
+    hybrid: bool = False,
+    min_native_quality: float = 0.8,
+) -> PdfPages:
+    """
+    Return the text of each page of a PDF.
 
+    With `hybrid`, pages whose embedded text layer scores at least `min_native_quality`
+    use that text directly. Pages found in `ocr_cache` are not OCR'd again. The
+    remaining pages are split into chunks of at most `chunk_size` pages and
+    `chunk_max_bytes` bytes, which are sent to DocumentAI concurrently. A chunk that
+    fails with a retryable error is sent again up to `max_retries` times, unless
+    `document_ai` is a ResilientOCRClient, whose own policy then applies.
+
+    The PDF is read from disk as pages are needed, and chunks are written only as
+    workers become free, so peak memory depends on the chunk budget and not on the
+    length of the PDF.
+    """
+    # read through the file handle and not a memory map: pypdf seeks to every object
+    # header when opening a PDF, which would fault most of a mapped file into memory
     with open(file_path, "rb") as fh:
-        bytes_stream = BytesIO(fh.read())
-    reader = PdfReader(bytes_stream)
-    num_pages = len(reader.pages)
-
-    document_ai = DocumentAI()
-
-    if num_pages <= 10:
-        return document_ai(bytes_stream.read(), mime_type=mime_type)
-
-    num_full_chunks = math.floor(num_pages / 10)
-    remainder_chunk_size = num_pages % 10
-    all_text = ""
-
-    def chunk_pages(pages):
-        writer = PdfWriter()
-        for page in pages:
-            writer.add_page(page)
-        with BytesIO() as new_bytes_stream:
-            writer.write(new_bytes_stream)
-            new_bytes_stream.seek(0)
-            doc = document_ai(new_bytes_stream.read())
-            return doc.text
-
-    for i in range(num_full_chunks):
-        end_page = (i + 1) * 10
-        start_page = end_page - 10
-        logger.info(f"scanning pdf chunk {start_page}:{end_page}")
-        all_text += chunk_pages(reader.pages[start_page:end_page])
-    if remainder_chunk_size > 0:
-        all_text += chunk_pages(reader.pages[:-remainder_chunk_size])
-
-    return all_text
+        reader = PdfReader(fh)
+        num_pages = len(reader.pages)
+
+        page_hashes: List[str] = []
+        page_sizes: List[int] = []
+        page_texts: List[str | None] = [None] * num_pages
+        native_pages = 0
+        for i, page in enumerate(reader.pages):
+            page_hash, page_size = page_fingerprint(page)
+            page_hashes.append(page_hash)
+            page_sizes.append(page_size)
+            if hybrid:
+                text = page.extract_text()
+                if native_text_quality(text) >= min_native_quality:
+                    page_texts[i] = text if text.endswith("\n") else text + "\n"
+                    native_pages += 1
+            release_page_data(reader)
+
+        cached_pages = 0
+        if ocr_cache is not None:
+            for i, text in enumerate(page_texts):
+                if text is None:
+                    page_texts[i] = ocr_cache.get(page_hashes[i])
+                    cached_pages += page_texts[i] is not None
+
+        missing_pages = [i for i, text in enumerate(page_texts) if text is None]
+        chunk_pages = budget_chunks(
+            missing_pages, page_sizes, chunk_size, chunk_max_bytes
+        )
+        logger.info(
+            f"scanning pdf [num_pages={num_pages}][native_pages={native_pages}][cached_pages={cached_pages}][ocr_pages={len(missing_pages)}][num_chunks={len(chunk_pages)}][max_workers={max_workers}]"
+        )
+
+        # the pages of each chunk, in the order the chunks are sent
+        sent_pages: List[List[int]] = []
+
+        def write_chunks() -> Generator[bytes, None, None]:
+            to_write = deque(chunk_pages)
+            while to_write:
+                pages = to_write.popleft()
+                chunk = write_pages(reader, pages)
+                release_page_data(reader)
+                if len(chunk) > chunk_max_bytes and len(pages) > 1:
+                    # shared resources were under-counted, so split the chunk in two
+                    half = len(pages) // 2
+                    to_write.extendleft([pages[half:], pages[:half]])
+                    continue
+                if len(chunk) > chunk_max_bytes:
+                    logger.warning(
+                        f"pdf page {pages[0]} is larger than the chunk budget [num_bytes={len(chunk)}]"
+                    )
+                sent_pages.append(pages)
+                yield chunk
+
+        if chunk_pages:
+            if document_ai is None:
+                document_ai = DocumentAI()
+            if not isinstance(document_ai, ResilientOCRClient):
+                document_ai = ResilientOCRClient(
+                    document_ai, ResiliencePolicy(max_retries=max_retries)
+                )
+            started = time.perf_counter()
+            docs = ocr_chunks(document_ai, write_chunks(), max_workers)
+            for chunk_index, doc in enumerate(docs):
+                pages = sent_pages[chunk_index]
+                texts = document_page_texts(doc)
+                if texts is None or len(texts) != len(pages):
+                    # no page layout to split on, so keep the chunk text whole and uncached
+                    logger.warning(f"could not split ocr text by page [pages={pages}]")
+                    texts = [doc.text] + [""] * (len(pages) - 1)
+                elif ocr_cache is not None:
+                    for i, text in zip(pages, texts):
+                        ocr_cache.put(page_hashes[i], text)
+                for i, text in zip(pages, texts):
+                    page_texts[i] = text
+            logger.info(f"scanned pdf [seconds={time.perf_counter() - started:.2f}]")
+
+    return PdfPages(
+        texts=page_texts,
+        hashes=page_hashes,
+        native_pages=native_pages,
+        cached_pages=cached_pages,
+        ocr_pages=len(missing_pages),
+    )
+
+
+def pdf_text(
+    file_path: Path, document_ai: OCRClient | None = None, **kwargs: Any
+) -> str:
+    """
+    Return the text of a PDF, with pages joined back together in page order.
+    Takes the same keyword arguments as `pdf_pages`.
+    """
+    return "".join(pdf_pages(file_path, document_ai, **kwargs).texts)
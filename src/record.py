@@ -1,135 +1,766 @@
+from bisect import bisect_left
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
-from typing import List
+from typing import Any, Callable, Dict, Generator, Iterable, List, Optional, Tuple
+import json
 import re
+import threading
 from uuid import uuid4
 
 import dotenv
 from loguru import logger
-import dateparser
+from pydantic import BaseModel, ValidationError
 
-from .llm import LLMApi
-from .models import MedicalRecord, MedicalEncounter
-from .pdf import pdf_text
-from .utils import read_yaml
+from .chunking import Window, reconcile_boundaries, token_windows
+from .compact import compact_encounters, page_offsets
+from .dedup import DedupReport, find_duplicates
+from .llm import LLMApi, RateLimiter, ResponseCache, RoutingConfig
+from .models import CompactMedicalRecord, MedicalRecord, MedicalEncounter
+from .ocr_cache import OCRCache
+from .pdf import OCRClient, pdf_pages
+from .resilience import RETRYABLE_ERRORS, CircuitOpenError
+from .segment import pre_segment
+from .telemetry import add, span
+from .templates import get_prompt
+from .timestamps import parse_datetime, rule_timestamp
 
 dotenv.load_dotenv()
 
+BOUNDARY_WINDOW_TOKENS = 3000
+BOUNDARY_WINDOW_OVERLAP_TOKENS = 300
 
-def detect_encounter_boundary_indexes(llm: LLMApi, lines: List[str]) -> List[int]:
+
+def valid_line_numbers(content: str, num_lines: int) -> bool:
     """
-    Return indexes of lines in the list that indicate an encounter boundary.
+    Whether a boundary detection response is only line numbers of the window, one per
+    line, which is what a model that followed the prompt returns.
     """
+    for rsp_line in content.strip().splitlines():
+        if not rsp_line.strip() or rsp_line.strip().startswith("```"):
+            continue
+        m = re.fullmatch(r"\s*(\d+)\s*", rsp_line)
+        if m is None or int(m.group(1)) >= num_lines:
+            return False
+    return True
+
 
-    def detect_boundaries_in_chunk(lines: List[str]) -> List[int]:
-        lines_w_numbers = [f"{i:03} {lines[i]}" for i in range(len(lines))]
-        detect_encounters_template = read_yaml(
-            "./src/prompts/detect_encounter_boundary.yaml"
-        )["content"]
-        system_instructions = detect_encounters_template.format(
+def iter_stripped_lines(lines: Iterable[str]) -> Generator[str, None, None]:
+    """
+    Yield the lines of a text as `text.strip().splitlines()` returns them, each as soon
+    as it is known: blank lines are held until a later line shows they are not trailing,
+    and the last line until the end, to strip it.
+    """
+    held: List[str] = []
+    for line in lines:
+        if not held:
+            if not line.strip():
+                continue
+            line = line.lstrip()
+        if line.strip():
+            yield from held
+            held = []
+        held.append(line)
+    if held:
+        yield held[0].rstrip()
+
+
+def iter_boundary_indexes(llm: LLMApi, lines: List[str]) -> Generator[int, None, None]:
+    """
+    Yield the indexes of lines that the LLM marks as starting an encounter, each as soon
+    as its line of the response is complete.
+    """
+    lines_w_numbers = [f"{i:03} {lines[i]}" for i in range(len(lines))]
+    detect_encounters_prompt = get_prompt("detect_encounter_boundary")
+    for rsp_line in llm.stream_lines(
+        messages=detect_encounters_prompt.messages(
             DOC_TEXT="\n".join(lines_w_numbers)
+        ),
+        response_format=None,
+        prompt_version=detect_encounters_prompt.version,
+        prompt_name=detect_encounters_prompt.name,
+        validate=lambda rsp: valid_line_numbers(rsp["content"], len(lines)),
+    ):
+        m = re.match(r"\s*([-+])?\d+", rsp_line)
+        if m is not None:
+            yield int(m.group())
+
+
+# called with the boundaries found from line `since` up to line `settled_end`, before
+# which no more will be found: (boundaries, since, settled_end)
+BoundaryProgress = Callable[[List[int], int, int], None]
+
+# lines before the last settled end that a progress report covers again, as boundaries
+# this close to a settled end may still move when they are reconciled
+PROGRESS_MARGIN_LINES = 10
+
+
+def detect_encounter_boundary_indexes(
+    llm: LLMApi,
+    lines: List[str],
+    max_tokens: int = BOUNDARY_WINDOW_TOKENS,
+    overlap_tokens: int = BOUNDARY_WINDOW_OVERLAP_TOKENS,
+    max_workers: int = 8,
+    spans: Optional[List[Tuple[int, int]]] = None,
+    on_progress: Optional[BoundaryProgress] = None,
+) -> List[int]:
+    """
+    Return indexes of lines in the list that indicate an encounter boundary.
+
+    The lines, or only the (start, end) `spans` of lines if given, are split into
+    overlapping windows of up to `max_tokens` tokens, which are sent to the LLM
+    concurrently, and the boundaries found in each are reconciled.
+
+    Each window's boundaries are read as the LLM streams them. Since a window's
+    boundaries come in order, no boundary can still appear before the first line that an
+    unfinished window has not reached, and whenever that line moves on, `on_progress`,
+    if given, is called with the reconciled boundaries found since the previous call.
+    """
+    if spans is None:
+        spans = [(0, len(lines))]
+    windows = [
+        (span_start + start, span_start + end)
+        for span_start, span_end in spans
+        for start, end in token_windows(
+            lines[span_start:span_end], max_tokens, overlap_tokens
         )
-        rsp = llm.chat_completion(
-            messages=[{"role": "system", "content": system_instructions}],
+    ]
+    logger.info(
+        f"detecting encounter boundaries [num_lines={len(lines)}][num_windows={len(windows)}]"
+    )
+
+    window_indexes: List[List[int]] = [[] for _ in windows]
+    # the first line each window has not reached yet, or None once it is done
+    window_progress: List[Optional[int]] = [start for start, _ in windows]
+    reported_end = 0
+    progress_lock = threading.Lock()
+
+    def report(w: int, index: Optional[int]) -> None:
+        """Record a boundary found in window `w`, or with None that it is done."""
+        nonlocal reported_end
+        with progress_lock:
+            start, end = windows[w]
+            if index is None:
+                window_progress[w] = None
+            else:
+                window_indexes[w].append(index)
+                if start <= index < end:
+                    window_progress[w] = max(window_progress[w], index + 1)
+            if on_progress is None:
+                return
+            settled_end = min(
+                (progress for progress in window_progress if progress is not None),
+                default=len(lines),
+            )
+            if settled_end <= reported_end:
+                return
+            # only the windows around the newly settled lines, so each report is cheap
+            since = max(0, reported_end - PROGRESS_MARGIN_LINES)
+            recent = [
+                (window, indexes)
+                for window, indexes in zip(windows, window_indexes)
+                if window[1] > since and window[0] < settled_end
+            ]
+            on_progress(
+                [
+                    i
+                    for i in reconcile_boundaries(recent, len(lines))
+                    if since <= i < settled_end
+                ],
+                since,
+                settled_end,
+            )
+            reported_end = settled_end
+
+    def detect_boundaries_in_window(w: int) -> None:
+        start, end = windows[w]
+        with span("boundary.window", num_lines=end - start):
+            for i in iter_boundary_indexes(llm, lines[start:end]):
+                report(w, i + start)
+        report(w, None)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(detect_boundaries_in_window, range(len(windows))))
+    return reconcile_boundaries(list(zip(windows, window_indexes)), len(lines))
+
+
+def find_encounter_boundaries(
+    llm: LLMApi,
+    lines: List[str],
+    spans: Optional[List[Tuple[int, int]]] = None,
+    max_workers: int = 8,
+    presegment: bool = True,
+    on_progress: Optional[BoundaryProgress] = None,
+) -> List[int]:
+    """
+    Return the sorted indexes of lines that start an encounter, in the whole list or
+    only in the (start, end) `spans` of lines if given.
+
+    With `presegment`, boundaries found by rules are accepted directly and only the
+    spans the rules could not settle are sent to the LLM. `on_progress` is called as
+    boundaries are found, as by `detect_encounter_boundary_indexes`.
+    """
+    if spans is None:
+        spans = [(0, len(lines))]
+    if not presegment:
+        return detect_encounter_boundary_indexes(
+            llm, lines, max_workers=max_workers, spans=spans, on_progress=on_progress
+        )
+
+    rule_boundaries: List[int] = []
+    ambiguous_spans: List[Tuple[int, int]] = []
+    with span("boundary.presegment"):
+        for span_start, span_end in spans:
+            segmentation = pre_segment(lines[span_start:span_end])
+            rule_boundaries += [span_start + i for i in segmentation.boundaries]
+            ambiguous_spans += [
+                (span_start + start, span_start + end)
+                for start, end in segmentation.ambiguous_spans
+            ]
+    num_lines = sum(end - start for start, end in spans)
+    llm_lines = sum(end - start for start, end in ambiguous_spans)
+    logger.info(
+        f"pre-segmented record [rule_boundaries={len(rule_boundaries)}][ambiguous_spans={len(ambiguous_spans)}][llm_fraction={llm_lines / num_lines if num_lines else 0.0:.2f}]"
+    )
+
+    def on_llm_progress(
+        llm_boundaries: List[int], since: int, settled_end: int
+    ) -> None:
+        if on_progress is not None:
+            first = bisect_left(rule_boundaries, since)
+            last = bisect_left(rule_boundaries, settled_end)
+            rules = rule_boundaries[first:last]
+            on_progress(sorted(set(rules) | set(llm_boundaries)), since, settled_end)
+
+    llm_boundaries = detect_encounter_boundary_indexes(
+        llm,
+        lines,
+        max_workers=max_workers,
+        spans=ambiguous_spans,
+        on_progress=on_llm_progress,
+    )
+    return sorted(set(rule_boundaries) | set(llm_boundaries))
+
+
+def split_lines(lines: List[str], boundaries: List[int]) -> List[List[str]]:
+    """
+    Split lines into the encounters starting at each of the sorted `boundaries`.
+    """
+    ends = boundaries[1:] + [len(lines)]
+    return [lines[start:end] for start, end in zip(boundaries, ends)]
+
+
+def parse_encounter_fused(llm: LLMApi, lines: List[str]) -> Optional[MedicalEncounter]:
+    """
+    Return a structured summary of a medical encounter using a single JSON prompt, with
+    the schema of its response in the prompt, or None if the response does not
+    validate as a MedicalEncounter or the API refuses the request.
+
+    The response is only constrained to JSON, not to the schema, as structured outputs
+    are not supported by every model and client this runs with.
+    """
+    text = "\n".join(lines)
+    parse_encounter_prompt = get_prompt("parse_encounter")
+    try:
+        with span("prompt.parse_encounter"):
+            rsp = llm.chat_completion(
+                messages=parse_encounter_prompt.messages(
+                    DOC_TEXT=text, SCHEMA=json.dumps(parse_encounter_prompt.schema)
+                ),
+                response_format={"type": "json_object"},
+                prompt_version=parse_encounter_prompt.version,
+                prompt_name=parse_encounter_prompt.name,
+                validate=lambda rsp: (
+                    fused_encounter(rsp["content"], text) is not None
+                ),
+            )
+    except (*RETRYABLE_ERRORS, CircuitOpenError):
+        # the per-field prompts would fail the same way
+        raise
+    except Exception as e:
+        # e.g. a 400 from a model that does not support JSON mode
+        logger.warning(f"fused encounter request was refused: {e}")
+        return None
+    encounter = fused_encounter(rsp["content"], text)
+    if encounter is None:
+        logger.warning("fused encounter response failed validation")
+    return encounter
+
+
+def fused_encounter(content: str, text: str) -> Optional[MedicalEncounter]:
+    """The encounter in a fused prompt's response, or None if it does not validate."""
+    try:
+        fields = json.loads(content)
+        return MedicalEncounter.model_validate({**fields, "content": text})
+    except (json.JSONDecodeError, TypeError, ValidationError):
+        return None
+
+
+def iter_findings(llm: LLMApi, text: str) -> Generator[str, None, None]:
+    """Yield the findings of an encounter's text, each as soon as it is listed."""
+    list_findings_prompt = get_prompt("list_findings")
+    yield from iter_stripped_lines(
+        llm.stream_lines(
+            messages=list_findings_prompt.messages(DOC_TEXT=text),
+            response_format=None,
+            prompt_version=list_findings_prompt.version,
+            prompt_name=list_findings_prompt.name,
+            # every encounter has findings, so an empty list means the model missed them
+            validate=lambda rsp: bool(rsp["content"].strip()),
+        )
+    )
+
+
+def iter_prescriptions(llm: LLMApi, text: str) -> Generator[str, None, None]:
+    """Yield the prescriptions of an encounter's text, each as soon as it is listed."""
+    list_prescriptions_prompt = get_prompt("list_prescriptions")
+    yield from iter_stripped_lines(
+        llm.stream_lines(
+            messages=list_prescriptions_prompt.messages(DOC_TEXT=text),
             response_format=None,
+            prompt_version=list_prescriptions_prompt.version,
+            prompt_name=list_prescriptions_prompt.name,
         )
-        indexes = []
-        for rsp_line in rsp["content"].strip().splitlines():
-            m = re.match(r"\s*([-+])?\d+", rsp_line)
-            if m is not None:
-                indexes.append(int(m.group()))
-        return indexes
-
-    encounter_boundary_indexes = []
-    chunk_size = 100
-    start = 0
-    while start < len(lines):
-        end = start + chunk_size - 1
-        if end > (len(lines) - 1):
-            end = len(lines) - 1
-        chunk_lines = lines[start:end]
-        indexes = detect_boundaries_in_chunk(chunk_lines)
-        for i in indexes:
-            encounter_boundary_indexes.append(i + start)
-        start = end + 1
-    return encounter_boundary_indexes
-
-
-def parse_encounter(llm: LLMApi, lines: List[str]) -> MedicalEncounter:
+    )
+
+
+def parse_encounter(
+    llm: LLMApi, lines: List[str], fused: bool = False
+) -> MedicalEncounter:
     """
     Return a structured summary of a medical encounter from the provided content.
+
+    With `fused`, the timestamp, findings and prescriptions are first requested in a
+    single call, falling back to one prompt per field if that response is invalid.
+    Otherwise the timestamp is only requested when the encounter's own dates do not
+    settle it.
     """
+    if fused:
+        encounter = parse_encounter_fused(llm, lines)
+        if encounter is not None:
+            return encounter
 
-    # timestamp for this encounter
-    get_timestamp_template = read_yaml("./src/prompts/encounter_timestamp.yaml")[
-        "content"
-    ]
-    system_instructions = get_timestamp_template.format(DOC_TEXT="\n".join(lines))
-    timestamp_rsp = llm.chat_completion(
-        messages=[{"role": "system", "content": system_instructions}],
-        response_format=None,
-    )
-    # timestamp
-    timestamp = dateparser.parse(timestamp_rsp["content"].strip())
+    text = "\n".join(lines)
+
+    # timestamp for this encounter, from its dates if they settle it, else by the LLM
+    with span("timestamp.rules") as rules_span:
+        timestamp = rule_timestamp(lines)
+        rules_span.add("rule_timestamps" if timestamp else "llm_timestamps")
+    if timestamp is None:
+        get_timestamp_prompt = get_prompt("encounter_timestamp")
+        with span("prompt.encounter_timestamp"):
+            timestamp_rsp = llm.chat_completion(
+                messages=get_timestamp_prompt.messages(DOC_TEXT=text),
+                response_format=None,
+                prompt_version=get_timestamp_prompt.version,
+                prompt_name=get_timestamp_prompt.name,
+                validate=lambda rsp: parse_datetime(rsp["content"]) is not None,
+            )
+        with span("parse.date"):
+            timestamp = parse_datetime(timestamp_rsp["content"])
 
     # medical findings in the encounter
-    list_findings_template = read_yaml("./src/prompts/list_findings.yaml")["content"]
-    system_instructions = list_findings_template.format(DOC_TEXT="\n".join(lines))
-    findings_rsp = llm.chat_completion(
-        messages=[{"role": "system", "content": system_instructions}],
-        response_format=None,
-    )
-    findings = findings_rsp["content"].strip().splitlines()
+    with span("prompt.list_findings"):
+        findings = list(iter_findings(llm, text))
 
     # prescriptions in the encounter
-    list_prescriptions_template = read_yaml("./src/prompts/list_prescriptions.yaml")[
-        "content"
-    ]
-    system_instructions = list_prescriptions_template.format(DOC_TEXT="\n".join(lines))
-    prescriptions_rsp = llm.chat_completion(
-        messages=[{"role": "system", "content": system_instructions}],
-        response_format=None,
-    )
-    prescriptions = prescriptions_rsp["content"].strip().splitlines()
+    with span("prompt.list_prescriptions"):
+        prescriptions = list(iter_prescriptions(llm, text))
 
     return MedicalEncounter(
         timestamp=timestamp,
-        content="\n".join(lines),
+        content=text,
         findings=findings,
         prescriptions=prescriptions,
     )
 
 
-def extract_from_pdf(filepath: str) -> MedicalRecord:
+def encounter_prompt_count(lines: List[str], fused: bool) -> int:
     """
-    Entry point. Takes the filepath of a PDF document and returns structured list of Medical Encounters.
+    The prompts `parse_encounter` sends for an encounter when every response validates:
+    one fused prompt, or findings and prescriptions, and the timestamp if its dates do
+    not settle it.
+    """
+    if fused:
+        return 1
+    return 2 if rule_timestamp(lines) is not None else 3
+
+
+class EncounterPrefetcher:
+    """
+    Parses encounters while boundary detection is still running, as soon as the
+    boundaries on both sides of each are settled, so the first encounters of a long
+    record are parsed while the LLM is still finding the last ones.
+
+    Parses are keyed by the encounter's text, and claimed by `iter_parsed_encounters`.
+    A parse whose encounter does not end up in the split, e.g. because it duplicates an
+    earlier one, is never claimed, and its LLM calls are wasted.
+    """
+
+    def __init__(
+        self,
+        llm: LLMApi,
+        max_workers: int = 8,
+        fused: bool = False,
+        tolerance: int = 2,
+    ) -> None:
+        """
+        An encounter is parsed once its end is more than `tolerance` lines before the
+        settled end, as boundaries that close to it may still be merged.
+        """
+        self.llm = llm
+        self.fused = fused
+        self.tolerance = tolerance
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="prefetch"
+        )
+        self._futures: Dict[str, "Future[MedicalEncounter]"] = {}
+        # start of the next encounter to parse, i.e. the end of the last one
+        self._next_start: Optional[int] = None
+        self._claimed = 0
+        self._closed = False
+        self._lock = threading.Lock()
+
+    def _parse(self, lines: List[str]) -> MedicalEncounter:
+        with span("encounter", num_lines=len(lines), prefetched=True):
+            encounter = parse_encounter(self.llm, lines, self.fused)
+        logger.debug(
+            f"prefetched medical encounter [num_findings={len(encounter.findings)}][num_prescriptions={len(encounter.prescriptions)}]"
+        )
+        return encounter
+
+    def update(
+        self, lines: List[str], boundaries: List[int], since: int, settled_end: int
+    ) -> None:
+        """
+        Start parsing the encounters of `lines` that the sorted `boundaries`, found from
+        line `since` up to `settled_end`, settle, as reported by
+        `find_encounter_boundaries`.
+        """
+        with self._lock:
+            if self._closed:
+                return
+            starts = [
+                b
+                for b in boundaries
+                if b < settled_end - self.tolerance
+                and (self._next_start is None or b > self._next_start)
+            ]
+            if self._next_start is not None:
+                starts.insert(0, self._next_start)
+            for start, end in zip(starts, starts[1:]):
+                text = "\n".join(lines[start:end])
+                if text not in self._futures:
+                    self._futures[text] = self.executor.submit(
+                        self._parse, lines[start:end]
+                    )
+            if starts:
+                self._next_start = starts[-1]
+
+    def claim(self, lines: List[str]) -> Optional["Future[MedicalEncounter]"]:
+        """The parse of an encounter with these lines, if one was started."""
+        with self._lock:
+            future = self._futures.pop("\n".join(lines), None)
+            if future is not None:
+                self._claimed += 1
+            return future
+
+    def close(self) -> None:
+        """
+        Stop starting parses, and cancel those not claimed yet, letting the claimed
+        ones finish. Closing again does nothing.
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            unclaimed = list(self._futures.values())
+            self._futures.clear()
+        for future in unclaimed:
+            future.cancel()
+        self.executor.shutdown(wait=False)
+        logger.info(
+            f"prefetched encounters [claimed={self._claimed}][unclaimed={len(unclaimed)}]"
+        )
+
+
+def iter_parsed_encounters(
+    llm: LLMApi,
+    encounters_lines: List[List[str]],
+    duplicates: List[Optional[int]],
+    max_workers: int = 8,
+    fused: bool = False,
+    parsed: Optional[Dict[int, MedicalEncounter]] = None,
+    prefetcher: Optional[EncounterPrefetcher] = None,
+) -> Generator[MedicalEncounter, None, None]:
+    """
+    Parse the encounters that are not duplicates, running up to `max_workers` at once,
+    and yield every encounter in order as soon as it and those before it are parsed.
+    Each duplicate is a copy of the encounter it duplicates, linked by `duplicate_of`.
+    Encounters in `parsed`, by index, are yielded as they are without calling the LLM,
+    and those that `prefetcher` already started parsing are taken from it, after which
+    it is closed.
+    """
+    parsed = parsed or {}
+    num_copies = llm_calls_saved = 0
+
+    def parse(i: int) -> MedicalEncounter:
+        with span("encounter", num_lines=len(encounters_lines[i])):
+            encounter = parse_encounter(llm, encounters_lines[i], fused)
+        logger.info(
+            f"parsed medical encounter {i} [num_findings={len(encounter.findings)}][num_prescriptions={len(encounter.prescriptions)}]"
+        )
+        return encounter
+
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    futures: Dict[int, "Future[MedicalEncounter]"] = {}
+    try:
+        for i, first in enumerate(duplicates):
+            if first is None and i not in parsed:
+                future = None
+                if prefetcher is not None:
+                    future = prefetcher.claim(encounters_lines[i])
+                futures[i] = future or executor.submit(parse, i)
+        if prefetcher is not None:
+            prefetcher.close()
+        # encounters that others may duplicate, by index
+        heads: Dict[int, MedicalEncounter] = {}
+        for i, first in enumerate(duplicates):
+            if i in parsed:
+                encounter = parsed[i]
+            elif first is None:
+                encounter = futures[i].result()
+            else:
+                encounter = heads[first].model_copy(
+                    update={
+                        "id": uuid4(),
+                        "content": "\n".join(encounters_lines[i]),
+                        "duplicate_of": first,
+                    }
+                )
+                num_copies += 1
+                llm_calls_saved += encounter_prompt_count(encounters_lines[i], fused)
+            if first is None:
+                heads[i] = encounter
+            yield encounter
+        if num_copies:
+            add("llm_calls_saved", llm_calls_saved)
+            logger.info(
+                f"copied duplicate encounters [num_copies={num_copies}][llm_calls_saved={llm_calls_saved}]"
+            )
+    finally:
+        for future in futures.values():
+            future.cancel()
+        executor.shutdown(cancel_futures=True)
+
+
+class RecordSplit(BaseModel):
+    """
+    A record's text split into encounters, ready for parsing.
+    """
+
+    content: str
+    # text length of each page of the content
+    page_lengths: List[int]
+    duplicate_pages: Dict[int, int] = {}
+    encounters_lines: List[List[str]]
+    # line span of each encounter in the text of the distinct pages
+    encounter_spans: List[Window]
+    # for each encounter, the index of the earlier encounter it duplicates
+    encounter_duplicates: List[Optional[int]]
+
+
+def split_record(
+    llm: LLMApi,
+    filepath: str,
+    ocr_cache: Optional[OCRCache] = None,
+    max_workers: int = 8,
+    dedup: bool = True,
+    presegment: bool = True,
+    document_ai: Optional[OCRClient] = None,
+    prefetcher: Optional[EncounterPrefetcher] = None,
+) -> RecordSplit:
+    """
+    Extract the text of a PDF and split it into encounters. Pages are OCR'd with
+    `document_ai`, or with DocumentAI if not given. With a `prefetcher`, encounters
+    start being parsed as soon as their boundaries are settled.
     """
     # get all text from the PDF using docAI
-    doc_text = pdf_text(Path(filepath))
+    with span("pdf.pages") as pages_span:
+        pages = pdf_pages(
+            Path(filepath), document_ai, ocr_cache=ocr_cache, hybrid=True
+        )
+        pages_span.set("num_pages", len(pages.texts))
+        pages_span.add("ocr_pages", pages.ocr_pages)
+        pages_span.add("cached_pages", pages.cached_pages)
+    doc_text = "".join(pages.texts)
     # doc_text = Path("./data/pdf-text.txt").read_text()
 
-    doc_lines = doc_text.splitlines()
-    logger.info(f"using record [num_lines={len(doc_lines)}]")
+    dedup_report = DedupReport()
+    page_texts = pages.texts
+    if dedup:
+        with span("dedup.pages"):
+            page_duplicates = find_duplicates(pages.texts)
+        dedup_report.duplicate_pages = {
+            i: first for i, first in enumerate(page_duplicates) if first is not None
+        }
+        page_texts = [
+            text for text, first in zip(pages.texts, page_duplicates) if first is None
+        ]
 
-    # init client
-    llm_api = LLMApi(api_type="openai")
+    doc_lines = "".join(page_texts).splitlines()
+    logger.info(f"using record [num_lines={len(doc_lines)}]")
 
     # detect medical encounters in the document
-    encounter_boundary_indexes = detect_encounter_boundary_indexes(llm_api, doc_lines)
+    encounter_boundary_indexes = find_encounter_boundaries(
+        llm,
+        doc_lines,
+        max_workers=max_workers,
+        presegment=presegment,
+        on_progress=(
+            partial(prefetcher.update, doc_lines) if prefetcher is not None else None
+        ),
+    )
     logger.info(
         f"found {len(encounter_boundary_indexes)} medical encounters in the record"
     )
-    encounters: List[MedicalEncounter] = []
-    for i in range(len(encounter_boundary_indexes)):
-        start = encounter_boundary_indexes[i]
-        end = (
-            encounter_boundary_indexes[-1]
-            if i == len(encounter_boundary_indexes) - 1
-            else encounter_boundary_indexes[i + 1]
-        )
-        encounter = parse_encounter(llm_api, doc_lines[start:end])
+    encounters_lines = split_lines(doc_lines, encounter_boundary_indexes)
+
+    encounter_duplicates: List[Optional[int]] = [None] * len(encounters_lines)
+    if dedup:
+        with span("dedup.encounters"):
+            encounter_duplicates = find_duplicates(
+                ["\n".join(lines) for lines in encounters_lines]
+            )
+        dedup_report.duplicate_encounters = {
+            i: first
+            for i, first in enumerate(encounter_duplicates)
+            if first is not None
+        }
         logger.info(
-            f"parsed medical encounter {i} [num_findings={len(encounter.findings)}][num_prescriptions={len(encounter.prescriptions)}]"
+            f"deduplicated record [duplicate_pages={len(dedup_report.duplicate_pages)}][duplicate_encounters={len(dedup_report.duplicate_encounters)}]"
         )
-        encounters.append(encounter)
 
-    return MedicalRecord(id=uuid4(), content=doc_text, encounters=encounters)
+    return RecordSplit(
+        content=doc_text,
+        page_lengths=[len(text) for text in pages.texts],
+        duplicate_pages=dedup_report.duplicate_pages,
+        encounters_lines=encounters_lines,
+        encounter_spans=[
+            (start, start + len(lines))
+            for start, lines in zip(encounter_boundary_indexes, encounters_lines)
+        ],
+        encounter_duplicates=encounter_duplicates,
+    )
+
+
+def extract_encounters(
+    filepath: str,
+    api_type: str = "openai",
+    max_workers: int = 8,
+    requests_per_minute: Optional[int] = None,
+    tokens_per_minute: Optional[int] = None,
+    fused: bool = False,
+    cache: bool = True,
+    dedup: bool = True,
+    presegment: bool = True,
+    routing: Optional[RoutingConfig] = None,
+    prefetch: bool = True,
+) -> Tuple[RecordSplit, Generator[MedicalEncounter, None, None]]:
+    """
+    Split a PDF into encounters, and return the split together with a generator that
+    parses the encounters and yields each one, in order, as soon as it is ready.
+
+    With `cache`, OCR text and LLM responses are reused from previous runs. With `dedup`,
+    duplicate pages are dropped before boundary detection and duplicate encounters are
+    parsed once. With `presegment`, boundaries found by rules are accepted directly and
+    only the ambiguous spans of the record are sent to the LLM. With `routing`, prompts
+    are sent to a fast model first and escalated to the `api_type` model as needed.
+    With `prefetch`, encounters start being parsed while boundary detection is still
+    running, at the cost of wasted calls for encounters later found to be duplicates.
+    """
+    # init client, with one rate limit budget shared by every request
+    llm_api = LLMApi(
+        api_type=api_type,
+        rate_limiter=RateLimiter(requests_per_minute, tokens_per_minute),
+        cache=ResponseCache() if cache else None,
+        routing=routing,
+    )
+    prefetcher = EncounterPrefetcher(llm_api, max_workers, fused) if prefetch else None
+    try:
+        split = split_record(
+            llm_api,
+            filepath,
+            ocr_cache=OCRCache() if cache else None,
+            max_workers=max_workers,
+            dedup=dedup,
+            presegment=presegment,
+            prefetcher=prefetcher,
+        )
+    except Exception:
+        if prefetcher is not None:
+            prefetcher.close()
+        raise
+
+    def encounters() -> Generator[MedicalEncounter, None, None]:
+        yield from iter_parsed_encounters(
+            llm_api,
+            split.encounters_lines,
+            split.encounter_duplicates,
+            max_workers,
+            fused,
+            prefetcher=prefetcher,
+        )
+        if llm_api.cache is not None:
+            stats = llm_api.cache.stats()
+            logger.info(f"llm cache [hits={stats.hits}][misses={stats.misses}]")
+        for prompt_name, tiers in llm_api.routing_stats.snapshot().items():
+            logger.info(
+                f"llm routing of {prompt_name} [fast={tiers.fast}][escalated={tiers.escalated}][strong={tiers.strong}]"
+            )
+
+    return split, encounters()
+
+
+def iter_encounters(filepath: str, **kwargs: Any) -> Generator[MedicalEncounter, None, None]:
+    """
+    Yield the encounters of a PDF, in order, as soon as each is parsed.
+    Takes the same keyword arguments as `extract_from_pdf`.
+    """
+    _, encounters = extract_encounters(filepath, **kwargs)
+    yield from encounters
+
+
+def extract_from_pdf(
+    filepath: str, compact: bool = False, **kwargs: Any
+) -> MedicalRecord | CompactMedicalRecord:
+    """
+    Entry point. Takes the filepath of a PDF document and returns structured list of Medical Encounters.
+    Takes the same keyword arguments as `extract_encounters`.
+
+    With `compact`, returns a CompactMedicalRecord, whose encounters refer to their text
+    in the record content instead of each holding a copy of it.
+    """
+    split, encounters = extract_encounters(filepath, **kwargs)
+    if compact:
+        return CompactMedicalRecord(
+            id=uuid4(),
+            content=split.content,
+            page_offsets=page_offsets(split.page_lengths),
+            encounters=list(
+                compact_encounters(
+                    split.content,
+                    split.page_lengths,
+                    split.duplicate_pages,
+                    split.encounter_spans,
+                    encounters,
+                )
+            ),
+            duplicate_pages=split.duplicate_pages,
+        )
+    return MedicalRecord(
+        id=uuid4(),
+        content=split.content,
+        encounters=list(encounters),
+        duplicate_pages=split.duplicate_pages,
+    )
@@ -0,0 +1,354 @@
+import asyncio
+import contextvars
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Awaitable, Callable, List, Literal, Optional, TypeVar
+
+from loguru import logger
+from pydantic import BaseModel
+
+from .telemetry import Histogram, telemetry
+
+T = TypeVar("T")
+
+
+class RetryableError(Exception):
+    """
+    A failed call that may succeed if sent again, e.g. on a rate limit, a server error
+    or a dropped connection, with how long the server asked to wait, if it did.
+    """
+
+    def __init__(self, message: str, retry_after: Optional[float] = None) -> None:
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class DeadlineExceeded(TimeoutError):
+    """A call, with its retries, ran past its deadline."""
+
+
+class CircuitOpenError(Exception):
+    """A call was refused because its backend has been failing."""
+
+
+# errors worth another attempt, and counted against the backend by its circuit breaker
+RETRYABLE_ERRORS = (RetryableError, ConnectionError, TimeoutError)
+
+
+def is_retryable_status(status_code: int) -> bool:
+    """Whether an HTTP error status is worth retrying, e.g. a rate limit or a server error."""
+    return status_code in (408, 409, 429) or status_code >= 500
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Seconds to wait from a Retry-After header, if it gives them as a number."""
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        return None
+
+
+class ResiliencePolicy(BaseModel):
+    # total time for a call and its retries, or None for no limit
+    deadline_seconds: Optional[float] = 300.0
+    max_retries: int = 3
+    # backoff before retry n is drawn uniformly from 0 to base * 2^n, up to the max,
+    # but is at least as long as the server asked for
+    backoff_base_seconds: float = 1.0
+    backoff_max_seconds: float = 30.0
+    # send a duplicate request once a call has taken longer than this percentile of
+    # past calls, or never if None. Only for idempotent calls.
+    hedge_percentile: Optional[float] = None
+    # past calls needed before hedging
+    hedge_min_calls: int = 20
+    # consecutive failures that open the circuit, and how long it stays open before
+    # letting a trial call through
+    breaker_failures: int = 5
+    breaker_reset_seconds: float = 30.0
+    # attempts, including hedges, in flight at once
+    max_concurrency: int = 64
+
+
+class CircuitBreaker:
+    """
+    Fails calls fast after `failures` consecutive failures, for `reset_seconds`, then
+    lets one trial call through: its success closes the circuit, its failure opens it
+    again.
+    """
+
+    def __init__(self, name: str, failures: int = 5, reset_seconds: float = 30.0):
+        self.name = name
+        self.failures = failures
+        self.reset_seconds = reset_seconds
+        self.state: Literal["closed", "open", "half_open"] = "closed"
+        self._consecutive_failures = 0
+        self._opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def before_call(self) -> None:
+        with self._lock:
+            if self.state == "closed":
+                return
+            if (
+                self.state == "open"
+                and time.monotonic() - self._opened_at >= self.reset_seconds
+            ):
+                self.state = "half_open"
+                return
+            raise CircuitOpenError(f"circuit of {self.name} is open")
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._consecutive_failures = 0
+            self.state = "closed"
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._consecutive_failures += 1
+            if (
+                self.state == "half_open"
+                or self._consecutive_failures >= self.failures
+            ):
+                if self.state != "open":
+                    logger.warning(
+                        f"opening circuit of {self.name} [failures={self._consecutive_failures}]"
+                    )
+                self.state = "open"
+                self._opened_at = time.monotonic()
+
+
+class Resilient:
+    """
+    Runs calls to one backend with a deadline, retries with jittered exponential
+    backoff, optional hedged duplicates, and a circuit breaker.
+
+    Retries, hedges and other events are added to the telemetry counters of the
+    calling span, prefixed by `name`.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        policy: Optional[ResiliencePolicy] = None,
+        breaker: Optional[CircuitBreaker] = None,
+    ) -> None:
+        """
+        Calls with different latencies to the same backend, e.g. whole responses and the
+        first chunk of streamed ones, can share a `breaker` while keeping their own
+        latency percentiles for hedging.
+        """
+        self.name = name
+        self.policy = policy or ResiliencePolicy()
+        self.breaker = breaker or CircuitBreaker(
+            name, self.policy.breaker_failures, self.policy.breaker_reset_seconds
+        )
+        self.latencies = Histogram()
+        self._latencies_lock = threading.Lock()
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._executor_lock = threading.Lock()
+
+    def _count(self, event: str) -> None:
+        telemetry.add(f"{self.name}.{event}")
+
+    def _backoff(self, retry: int, error: BaseException) -> float:
+        delay = random.uniform(
+            0,
+            min(
+                self.policy.backoff_max_seconds,
+                self.policy.backoff_base_seconds * 2**retry,
+            ),
+        )
+        retry_after = getattr(error, "retry_after", None)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+    def _hedge_after(self) -> Optional[float]:
+        if self.policy.hedge_percentile is None:
+            return None
+        with self._latencies_lock:
+            if self.latencies.count < self.policy.hedge_min_calls:
+                return None
+            return self.latencies.percentile(self.policy.hedge_percentile)
+
+    def _record_latency(self, seconds: float) -> None:
+        with self._latencies_lock:
+            self.latencies.add(seconds)
+
+    def _next_attempt(self, retry: int, error: BaseException, deadline: float) -> float:
+        """
+        Return how long to wait before retrying after `error`, or raise it if the call
+        should not be retried.
+        """
+        if not isinstance(error, RETRYABLE_ERRORS) or isinstance(
+            error, DeadlineExceeded
+        ):
+            raise error
+        if retry >= self.policy.max_retries:
+            logger.error(f"{self.name} call failed [attempts={retry + 1}]: {error}")
+            raise error
+        delay = self._backoff(retry, error)
+        if time.monotonic() + delay >= deadline:
+            self._count("deadline_exceeded")
+            raise DeadlineExceeded(
+                f"{self.name} call cannot be retried before its deadline"
+            ) from error
+        self._count("retries")
+        logger.warning(
+            f"retrying {self.name} call [attempt={retry + 2}][delay={delay:.2f}]: {error}"
+        )
+        return delay
+
+    def _record_outcome(self, error: BaseException) -> None:
+        if isinstance(error, RETRYABLE_ERRORS):
+            self.breaker.record_failure()
+        else:
+            # the backend answered, if only to refuse the request
+            self.breaker.record_success()
+
+    def _deadline(self) -> float:
+        if self.policy.deadline_seconds is None:
+            return float("inf")
+        return time.monotonic() + self.policy.deadline_seconds
+
+    def call(self, fn: Callable[[], T]) -> T:
+        """
+        Call `fn` until it succeeds, the error is not retryable, or retries or time run
+        out. Each attempt runs on a worker thread, so the caller is not held past the
+        deadline by an attempt that hangs.
+        """
+        deadline = self._deadline()
+        retry = 0
+        while True:
+            try:
+                self.breaker.before_call()
+                started = time.monotonic()
+                result = self._attempt(fn, deadline)
+            except CircuitOpenError:
+                self._count("circuit_open")
+                raise
+            except Exception as e:
+                self._record_outcome(e)
+                time.sleep(self._next_attempt(retry, e, deadline))
+                retry += 1
+                continue
+            self.breaker.record_success()
+            self._record_latency(time.monotonic() - started)
+            return result
+
+    def _submit(self, fn: Callable[[], T]) -> "Future[T]":
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.policy.max_concurrency,
+                    thread_name_prefix=f"{self.name}-call",
+                )
+        # in the caller's context, so telemetry goes to the caller's span
+        return self._executor.submit(contextvars.copy_context().run, fn)
+
+    def _attempt(self, fn: Callable[[], T], deadline: float) -> T:
+        first = self._submit(fn)
+        futures: List[Future] = [first]
+        hedge_after = self._hedge_after()
+        hedge_at = time.monotonic() + hedge_after if hedge_after is not None else None
+        error: Optional[BaseException] = None
+        try:
+            while futures:
+                wake_at = deadline if hedge_at is None else min(deadline, hedge_at)
+                done, _ = wait(
+                    futures,
+                    timeout=None
+                    if wake_at == float("inf")
+                    else max(0.0, wake_at - time.monotonic()),
+                    return_when=FIRST_COMPLETED,
+                )
+                for future in done:
+                    futures.remove(future)
+                    if future.exception() is None:
+                        if future is not first:
+                            self._count("hedge_wins")
+                        return future.result()
+                    error = future.exception()
+                if done:
+                    continue
+                if time.monotonic() >= deadline:
+                    self._count("deadline_exceeded")
+                    raise DeadlineExceeded(f"{self.name} call ran past its deadline")
+                # the attempt is slower than usual, so race a duplicate against it
+                self._count("hedges")
+                futures.append(self._submit(fn))
+                hedge_at = None
+        finally:
+            for future in futures:
+                future.cancel()
+        assert error is not None
+        raise error
+
+    async def acall(self, fn: Callable[[], Awaitable[T]]) -> T:
+        """Like `call`, for a coroutine function, without blocking the event loop."""
+        deadline = self._deadline()
+        retry = 0
+        while True:
+            try:
+                self.breaker.before_call()
+                started = time.monotonic()
+                result = await self._aattempt(fn, deadline)
+            except CircuitOpenError:
+                self._count("circuit_open")
+                raise
+            except Exception as e:
+                self._record_outcome(e)
+                await asyncio.sleep(self._next_attempt(retry, e, deadline))
+                retry += 1
+                continue
+            self.breaker.record_success()
+            self._record_latency(time.monotonic() - started)
+            return result
+
+    async def _aattempt(self, fn: Callable[[], Awaitable[T]], deadline: float) -> T:
+        first = asyncio.ensure_future(fn())
+        tasks: List[asyncio.Future] = [first]
+        hedge_after = self._hedge_after()
+        hedge_at = time.monotonic() + hedge_after if hedge_after is not None else None
+        error: Optional[BaseException] = None
+        try:
+            while tasks:
+                wake_at = deadline if hedge_at is None else min(deadline, hedge_at)
+                done, _ = await asyncio.wait(
+                    tasks,
+                    timeout=None
+                    if wake_at == float("inf")
+                    else max(0.0, wake_at - time.monotonic()),
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                for task in done:
+                    tasks.remove(task)
+                    if task.exception() is None:
+                        if task is not first:
+                            self._count("hedge_wins")
+                        return task.result()
+                    error = task.exception()
+                if done:
+                    continue
+                if time.monotonic() >= deadline:
+                    self._count("deadline_exceeded")
+                    raise DeadlineExceeded(f"{self.name} call ran past its deadline")
+                self._count("hedges")
+                tasks.append(asyncio.ensure_future(fn()))
+                hedge_at = None
+        finally:
+            for task in tasks:
+                task.cancel()
+        assert error is not None
+        raise error
+
+    def close(self) -> None:
+        """Stop the worker threads, without waiting for attempts still in flight."""
+        with self._executor_lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
@@ -0,0 +1,104 @@
+import re
+from typing import List, Tuple
+
+from pydantic import BaseModel
+
+from .dedup import FAX_HEADER_RE
+
+DATE = r"\d{1,2}/\d{1,2}/\d{2,4}"
+
+# (pattern, confidence that a line matching it starts a new encounter)
+BOUNDARY_RULES: List[Tuple[re.Pattern, float]] = [
+    (re.compile(rf"^\W*Office Visit {DATE}", re.IGNORECASE), 0.95),
+    (re.compile(rf"^\W*Annual Exam {DATE}", re.IGNORECASE), 0.9),
+    (re.compile(rf"^\W*DATE OF SERVICE:\s*{DATE}", re.IGNORECASE), 0.9),
+    (re.compile(rf"^\W*Scan on {DATE}", re.IGNORECASE), 0.9),
+    (re.compile(rf"^\W*Electronic signature on {DATE}", re.IGNORECASE), 0.85),
+    (re.compile(r"^\W*(NEW CONSULT|FOLLOW[- ]UP VISIT)\b"), 0.85),
+    (re.compile(rf"^\W*Date of encounter:\s*{DATE}", re.IGNORECASE), 0.7),
+    (re.compile(r"^\W*Progress Notes\b"), 0.6),
+    (re.compile(r"^\W*(Encounter|Order|Patient)-Level Documents\b"), 0.6),
+    (
+        re.compile(
+            r"^\W*(PATHOLOGY REPORT|Procedure Log Information|Exam Information|Study Result|Patient Information)\b"
+        ),
+        0.5,
+    ),
+]
+
+# the DOB and encounter date header repeated at the top of every page of a note
+PAGE_HEADER_RE = re.compile(rf"^\W*DOB:\s*{DATE}\s+Encounter Date:", re.IGNORECASE)
+
+# how much a section title is more likely a boundary when it starts a faxed page
+PAGE_START_BOOST = 0.2
+
+
+class Segmentation(BaseModel):
+    """
+    Encounter boundaries found by rules, and the spans of lines the rules could not
+    settle, as (start, end) line indexes with `end` exclusive.
+    """
+
+    boundaries: List[int]
+    ambiguous_spans: List[Tuple[int, int]]
+    llm_fraction: float
+
+
+def score_lines(lines: List[str]) -> List[float]:
+    """
+    Return, for each line, the confidence from 0 to 1 that it starts a new encounter.
+    """
+    scores = []
+    for line in lines:
+        score = 0.0
+        if line.strip() and not PAGE_HEADER_RE.match(line):
+            for pattern, confidence in BOUNDARY_RULES:
+                if pattern.match(line):
+                    score = max(score, confidence)
+        scores.append(score)
+
+    for i, line in enumerate(lines):
+        if line.strip() and FAX_HEADER_RE.match(line):
+            for j in range(i + 1, min(i + 4, len(lines))):
+                if scores[j] >= 0.5:
+                    scores[j] = min(0.95, scores[j] + PAGE_START_BOOST)
+    return scores
+
+
+def pre_segment(
+    lines: List[str],
+    accept_threshold: float = 0.85,
+    ambiguous_threshold: float = 0.5,
+    max_span_lines: int = 80,
+) -> Segmentation:
+    """
+    Split a document at lines scoring at least `accept_threshold`.
+
+    A segment between accepted boundaries is ambiguous, and left for the LLM, if it has
+    a line scoring at least `ambiguous_threshold` after its first line, or is longer than
+    `max_span_lines` and so may hide a boundary no rule matched.
+    """
+    scores = score_lines(lines)
+    boundaries = [i for i, score in enumerate(scores) if score >= accept_threshold]
+
+    starts = [0] + [b for b in boundaries if b > 0]
+    ends = starts[1:] + [len(lines)]
+    ambiguous_spans = []
+    for start, end in zip(starts, ends):
+        uncertain = any(
+            ambiguous_threshold <= score < accept_threshold
+            for score in scores[start + 1 : end]
+        )
+        if uncertain or end - start > max_span_lines:
+            # neighbouring ambiguous segments are sent together
+            if ambiguous_spans and ambiguous_spans[-1][1] == start:
+                ambiguous_spans[-1] = (ambiguous_spans[-1][0], end)
+            else:
+                ambiguous_spans.append((start, end))
+
+    llm_lines = sum(end - start for start, end in ambiguous_spans)
+    return Segmentation(
+        boundaries=boundaries,
+        ambiguous_spans=ambiguous_spans,
+        llm_fraction=llm_lines / len(lines) if lines else 0.0,
+    )
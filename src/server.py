@@ -0,0 +1,482 @@
+import json
+import os
+import queue
+import socketserver
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Dict, List, Literal, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+from uuid import UUID, uuid4
+
+from loguru import logger
+from pydantic import BaseModel, UUID4
+
+from .llm import LLMApi
+from .models import MedicalEncounter, MedicalRecord
+from .ocr_cache import OCRCache
+from .pdf import OCRClient, ResilientOCRClient
+from .record import EncounterPrefetcher, iter_parsed_encounters, split_record
+from .templates import PROMPTS_DIR, get_prompt
+
+JobStatus = Literal["queued", "running", "done", "failed"]
+
+# seconds a client whose job was refused is told to wait before submitting again
+RETRY_AFTER_SECONDS = 5
+
+
+class JobInfo(BaseModel):
+    id: UUID4
+    status: JobStatus
+    filename: Optional[str] = None
+    submitted_at: datetime
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+    num_pages: Optional[int] = None
+    num_encounters: int = 0
+    error: Optional[str] = None
+
+
+class ServiceStats(BaseModel):
+    num_workers: int
+    busy_workers: int
+    queued_jobs: int
+    queue_size: int
+    done_jobs: int
+    failed_jobs: int
+    refused_jobs: int
+
+
+class QueueFull(Exception):
+    pass
+
+
+class Job:
+    """
+    A submitted PDF, and the encounters parsed from it so far. Readers wait on the job
+    for new encounters while a worker adds them.
+    """
+
+    def __init__(self, path: Path, filename: Optional[str] = None) -> None:
+        self.path = path
+        self.info = JobInfo(
+            id=uuid4(),
+            status="queued",
+            filename=filename,
+            submitted_at=datetime.now(timezone.utc),
+        )
+        self.encounters: List[MedicalEncounter] = []
+        self.record: Optional[MedicalRecord] = None
+        self._changed = threading.Condition()
+
+    @property
+    def finished(self) -> bool:
+        return self.info.status in ("done", "failed")
+
+    def snapshot(self) -> JobInfo:
+        with self._changed:
+            return self.info.model_copy()
+
+    def update(self, **fields: Any) -> None:
+        with self._changed:
+            for key, value in fields.items():
+                setattr(self.info, key, value)
+
+    def add_encounter(self, encounter: MedicalEncounter) -> None:
+        with self._changed:
+            self.encounters.append(encounter)
+            self.info.num_encounters = len(self.encounters)
+            self._changed.notify_all()
+
+    def finish(self, record: Optional[MedicalRecord], error: Optional[str] = None) -> None:
+        with self._changed:
+            self.record = record
+            self.info.status = "failed" if error is not None else "done"
+            self.info.error = error
+            self.info.finished_at = datetime.now(timezone.utc)
+            self._changed.notify_all()
+
+    def wait_encounters(
+        self, start: int, timeout: Optional[float] = None
+    ) -> Tuple[List[MedicalEncounter], bool]:
+        """
+        Wait until there are encounters after the first `start`, or the job finishes, and
+        return those encounters and whether the job has finished.
+        """
+        with self._changed:
+            self._changed.wait_for(
+                lambda: len(self.encounters) > start or self.finished, timeout
+            )
+            return self.encounters[start:], self.finished
+
+
+def warm_up() -> None:
+    """
+    Load the prompts and the date parser's locale data, so the first job does not wait
+    for them.
+    """
+    for path in PROMPTS_DIR.glob("*.yaml"):
+        get_prompt(path.stem)
+    import dateparser
+
+    dateparser.parse("21 July 2013 10:15 pm")
+
+
+class ExtractionService:
+    """
+    A bounded queue of PDFs, parsed by `num_workers` long-lived workers.
+
+    The workers share one LLMApi, and so its connection pool, response cache and rate
+    limit budget, one OCR client and one OCR cache. A submission when `queue_size` jobs
+    are already waiting is refused with QueueFull, rather than queued without bound.
+    Finished jobs are kept for polling, up to `max_finished_jobs` of them.
+    """
+
+    def __init__(
+        self,
+        llm: LLMApi,
+        document_ai: Optional[OCRClient] = None,
+        ocr_cache: Optional[OCRCache] = None,
+        num_workers: int = 2,
+        queue_size: int = 8,
+        max_workers: int = 8,
+        fused: bool = False,
+        dedup: bool = True,
+        presegment: bool = True,
+        prefetch: bool = True,
+        max_finished_jobs: int = 1000,
+        upload_dir: Optional[str | Path] = None,
+    ) -> None:
+        if document_ai is None:
+            from .pdf import DocumentAI
+
+            document_ai = DocumentAI()
+        self.llm = llm
+        # one circuit breaker and latency history for every job
+        self.document_ai = ResilientOCRClient(document_ai)
+        self.ocr_cache = ocr_cache
+        self.num_workers = num_workers
+        self.queue_size = queue_size
+        self.max_workers = max_workers
+        self.fused = fused
+        self.dedup = dedup
+        self.presegment = presegment
+        self.prefetch = prefetch
+        self.max_finished_jobs = max_finished_jobs
+        self.upload_dir = Path(upload_dir or tempfile.mkdtemp(prefix="uploads-"))
+        self.upload_dir.mkdir(parents=True, exist_ok=True)
+
+        self._queue: queue.Queue[Optional[Job]] = queue.Queue(maxsize=queue_size)
+        self._jobs: OrderedDict[UUID, Job] = OrderedDict()
+        self._lock = threading.Lock()
+        self._workers: List[threading.Thread] = []
+        self._busy_workers = 0
+        self._refused_jobs = 0
+
+    def start(self) -> None:
+        warm_up()
+        for i in range(self.num_workers):
+            worker = threading.Thread(target=self._work, name=f"worker-{i}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+        logger.info(
+            f"started extraction service [num_workers={self.num_workers}][queue_size={self.queue_size}]"
+        )
+
+    def stop(self) -> None:
+        """
+        Let the workers finish the queued jobs, then stop them.
+        """
+        for _ in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+        self.llm.close()
+
+    def is_full(self) -> bool:
+        return self._queue.full()
+
+    def refuse(self) -> QueueFull:
+        """
+        Count a refused submission, and return the error to answer it with.
+        """
+        with self._lock:
+            self._refused_jobs += 1
+        return QueueFull(f"{self.queue_size} jobs are already queued")
+
+    def submit(self, content: bytes, filename: Optional[str] = None) -> Job:
+        path = self.upload_dir / f"{uuid4()}.pdf"
+        path.write_bytes(content)
+        job = Job(path, filename)
+        with self._lock:
+            self._jobs[job.info.id] = job
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            path.unlink()
+            with self._lock:
+                del self._jobs[job.info.id]
+            raise self.refuse()
+        logger.info(f"queued job {job.info.id} [num_bytes={len(content)}]")
+        return job
+
+    def get(self, job_id: UUID) -> Optional[Job]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def stats(self) -> ServiceStats:
+        with self._lock:
+            statuses = [job.snapshot().status for job in self._jobs.values()]
+            return ServiceStats(
+                num_workers=len(self._workers),
+                busy_workers=self._busy_workers,
+                queued_jobs=self._queue.qsize(),
+                queue_size=self.queue_size,
+                done_jobs=statuses.count("done"),
+                failed_jobs=statuses.count("failed"),
+                refused_jobs=self._refused_jobs,
+            )
+
+    def _work(self) -> None:
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            with self._lock:
+                self._busy_workers += 1
+            try:
+                self._run(job)
+            finally:
+                with self._lock:
+                    self._busy_workers -= 1
+                    self._forget_finished_jobs()
+
+    def _run(self, job: Job) -> None:
+        job.update(status="running", started_at=datetime.now(timezone.utc))
+        started = time.perf_counter()
+        prefetcher = (
+            EncounterPrefetcher(self.llm, self.max_workers, self.fused)
+            if self.prefetch
+            else None
+        )
+        try:
+            split = split_record(
+                self.llm,
+                str(job.path),
+                ocr_cache=self.ocr_cache,
+                max_workers=self.max_workers,
+                dedup=self.dedup,
+                presegment=self.presegment,
+                document_ai=self.document_ai,
+                prefetcher=prefetcher,
+            )
+            job.update(num_pages=len(split.page_lengths))
+            for encounter in iter_parsed_encounters(
+                self.llm,
+                split.encounters_lines,
+                split.encounter_duplicates,
+                self.max_workers,
+                self.fused,
+                prefetcher=prefetcher,
+            ):
+                job.add_encounter(encounter)
+            job.finish(
+                MedicalRecord(
+                    id=job.info.id,
+                    content=split.content,
+                    encounters=job.encounters,
+                    duplicate_pages=split.duplicate_pages,
+                )
+            )
+        except Exception as e:
+            logger.exception(f"job {job.info.id} failed")
+            job.finish(None, error=f"{type(e).__name__}: {e}")
+        finally:
+            if prefetcher is not None:
+                prefetcher.close()
+            job.path.unlink(missing_ok=True)
+        logger.info(
+            f"finished job {job.info.id} [status={job.info.status}][num_encounters={job.info.num_encounters}][seconds={time.perf_counter() - started:.2f}]"
+        )
+
+    def _forget_finished_jobs(self) -> None:
+        finished = [job_id for job_id, job in self._jobs.items() if job.finished]
+        for job_id in finished[: max(0, len(finished) - self.max_finished_jobs)]:
+            del self._jobs[job_id]
+
+
+class ExtractionHandler(BaseHTTPRequestHandler):
+    """
+    HTTP API of an ExtractionService:
+
+    - `POST /jobs` with a PDF as the body queues it, answering 202 with the job, or 429
+      with a Retry-After header, without reading the PDF, if the queue is full.
+    - `GET /jobs/<id>` returns the job's status.
+    - `GET /jobs/<id>/result` returns the MedicalRecord once the job is done, and 202
+      with the job's status until then.
+    - `GET /jobs/<id>/encounters` streams the encounters as lines of JSON, in order, as
+      they are parsed, and ends when the job does.
+    - `GET /health` returns the queue and worker counts.
+    """
+
+    protocol_version = "HTTP/1.1"
+    server: "ExtractionHTTPServer | ExtractionUnixServer"
+
+    def address_string(self) -> str:
+        # Unix socket clients have no address
+        return str(self.client_address[0]) if self.client_address else "unix"
+
+    def log_message(self, format: str, *args: Any) -> None:
+        logger.debug(f"{self.address_string()} {format % args}")
+
+    def send_json(
+        self, status: int, body: Any, headers: Optional[Dict[str, str]] = None
+    ) -> None:
+        if isinstance(body, BaseModel):
+            data = body.model_dump_json().encode("utf-8")
+        else:
+            data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_error_json(self, status: int, message: str) -> None:
+        self.send_json(status, {"error": message})
+
+    def send_queue_full(self, error: QueueFull) -> None:
+        # the unread body would be taken for the next request, so close the connection
+        self.send_json(
+            429,
+            {"error": str(error)},
+            {"Retry-After": str(RETRY_AFTER_SECONDS), "Connection": "close"},
+        )
+        self.close_connection = True
+
+    def do_POST(self) -> None:
+        url = urlparse(self.path)
+        if url.path != "/jobs":
+            self.send_error_json(404, f"no such endpoint {url.path}")
+            return
+        length = self.headers.get("Content-Length")
+        if length is None:
+            self.send_error_json(411, "Content-Length is required")
+            return
+        if not length.isdigit():
+            self.send_error_json(400, f"invalid Content-Length {length!r}")
+            self.close_connection = True
+            return
+        if int(length) > self.server.max_upload_bytes:
+            self.send_error_json(413, f"PDF is over {self.server.max_upload_bytes} bytes")
+            self.close_connection = True
+            return
+        service = self.server.service
+        # refuse before reading the upload, so a full queue costs no bandwidth
+        if service.is_full():
+            self.send_queue_full(service.refuse())
+            return
+        content = self.rfile.read(int(length))
+        filename = parse_qs(url.query).get("filename", [None])[0]
+        try:
+            job = service.submit(content, filename)
+        except QueueFull as e:
+            self.send_queue_full(e)
+            return
+        self.send_json(202, job.snapshot(), {"Location": f"/jobs/{job.info.id}"})
+
+    def do_GET(self) -> None:
+        parts = urlparse(self.path).path.strip("/").split("/")
+        if parts == ["health"]:
+            self.send_json(200, self.server.service.stats())
+            return
+        if len(parts) not in (2, 3) or parts[0] != "jobs":
+            self.send_error_json(404, f"no such endpoint {self.path}")
+            return
+        try:
+            job = self.server.service.get(UUID(parts[1]))
+        except ValueError:
+            job = None
+        if job is None:
+            self.send_error_json(404, f"no such job {parts[1]}")
+            return
+
+        info = job.snapshot()
+        if len(parts) == 2:
+            self.send_json(200, info)
+        elif parts[2] == "result":
+            if info.status == "done":
+                self.send_json(200, job.record)
+            elif info.status == "failed":
+                self.send_json(500, info)
+            else:
+                self.send_json(202, info)
+        elif parts[2] == "encounters":
+            self.stream_encounters(job)
+        else:
+            self.send_error_json(404, f"no such endpoint {self.path}")
+
+    def stream_encounters(self, job: Job) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        sent = 0
+        finished = False
+        try:
+            while not finished:
+                encounters, finished = job.wait_encounters(sent)
+                if encounters:
+                    data = "".join(f"{e.model_dump_json()}\n" for e in encounters)
+                    self.write_chunk(data.encode("utf-8"))
+                    sent += len(encounters)
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            logger.info(f"client stopped streaming job {job.info.id}")
+            self.close_connection = True
+
+    def write_chunk(self, data: bytes) -> None:
+        self.wfile.write(f"{len(data):X}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+
+class ExtractionHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(
+        self,
+        address: Tuple[str, int],
+        service: ExtractionService,
+        max_upload_bytes: int = 512 * 1024 * 1024,
+    ) -> None:
+        super().__init__(address, ExtractionHandler)
+        self.service = service
+        self.max_upload_bytes = max_upload_bytes
+
+
+class ExtractionUnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(
+        self,
+        path: str | Path,
+        service: ExtractionService,
+        max_upload_bytes: int = 512 * 1024 * 1024,
+    ) -> None:
+        if os.path.exists(path):
+            os.unlink(path)
+        super().__init__(str(path), ExtractionHandler)
+        self.service = service
+        self.max_upload_bytes = max_upload_bytes
+
+    def server_close(self) -> None:
+        super().server_close()
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
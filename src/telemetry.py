@@ -0,0 +1,264 @@
+import json
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional
+
+from pydantic import BaseModel
+
+# latency histogram buckets grow by this ratio from HISTOGRAM_BASE_SECONDS, so
+# percentiles are estimated to within about 9%
+HISTOGRAM_BASE_SECONDS = 1e-6
+HISTOGRAM_RATIO = 2 ** (1 / 8)
+LOG_HISTOGRAM_RATIO = math.log(HISTOGRAM_RATIO)
+
+
+class Histogram:
+    """
+    Log-scale histogram of durations, in constant memory.
+    """
+
+    def __init__(self) -> None:
+        self.buckets: Dict[int, int] = {}
+        self.count = 0
+        self.max = 0.0
+
+    def add(self, seconds: float) -> None:
+        bucket = 0
+        if seconds > HISTOGRAM_BASE_SECONDS:
+            bucket = int(
+                math.log(seconds / HISTOGRAM_BASE_SECONDS) / LOG_HISTOGRAM_RATIO
+            )
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.max = max(self.max, seconds)
+
+    def percentile(self, q: float) -> float:
+        """
+        Return the upper bound of the bucket holding the `q` quantile, from 0 to 1.
+        """
+        if self.count == 0:
+            return 0.0
+        rank = max(1, math.ceil(q * self.count))
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                upper = HISTOGRAM_BASE_SECONDS * HISTOGRAM_RATIO ** (bucket + 1)
+                return min(upper, self.max)
+        return self.max
+
+
+class Span:
+    """
+    One timed run of a pipeline stage, with its attributes and counters.
+    """
+
+    __slots__ = ("name", "start", "attributes", "counters")
+
+    def __init__(self, name: str, attributes: Dict[str, Any]) -> None:
+        self.name = name
+        self.start = time.perf_counter()
+        self.attributes = attributes
+        self.counters: Dict[str, float] = {}
+
+    def set(self, key: str, value: Any) -> None:
+        self.attributes[key] = value
+
+    def add(self, counter: str, value: float = 1) -> None:
+        self.counters[counter] = self.counters.get(counter, 0) + value
+
+
+class Stage:
+    """
+    Running totals of the spans of one stage.
+    """
+
+    __slots__ = ("count", "errors", "total_seconds", "histogram", "counters")
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.errors = 0
+        self.total_seconds = 0.0
+        self.histogram = Histogram()
+        self.counters: Dict[str, float] = {}
+
+
+class StageStats(BaseModel):
+    count: int = 0
+    errors: int = 0
+    total_seconds: float = 0.0
+    p50_seconds: float = 0.0
+    p95_seconds: float = 0.0
+    p99_seconds: float = 0.0
+    max_seconds: float = 0.0
+    counters: Dict[str, float] = {}
+
+
+class Telemetry:
+    """
+    Collects spans of pipeline stages into per-stage latency histograms and counters,
+    and keeps up to `max_trace_spans` spans for a trace file.
+
+    Recording a span costs a few microseconds, so telemetry can be left on. Counters,
+    e.g. of tokens, are added to the innermost open span of the current thread or task.
+    """
+
+    def __init__(self, enabled: bool = True, max_trace_spans: int = 100_000) -> None:
+        self.enabled = enabled
+        self.max_trace_spans = max_trace_spans
+        self._lock = threading.Lock()
+        self._current: ContextVar[Optional[Span]] = ContextVar(
+            "current_span", default=None
+        )
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self._started = time.perf_counter()
+            self._stages: Dict[str, Stage] = {}
+            self._trace: List[Dict[str, Any]] = []
+            self.dropped_spans = 0
+
+    @contextmanager
+    def span(self, name: str, **attributes: Any) -> Iterator[Span]:
+        span = Span(name, attributes)
+        if not self.enabled:
+            yield span
+            return
+        token = self._current.set(span)
+        error = False
+        try:
+            yield span
+        except BaseException as e:
+            error = True
+            span.set("error", type(e).__name__)
+            raise
+        finally:
+            self._current.reset(token)
+            self._record(span, time.perf_counter() - span.start, error)
+
+    def add(self, counter: str, value: float = 1) -> None:
+        """
+        Add to a counter of the current span, or of an "unattributed" stage if there
+        is none.
+        """
+        if not self.enabled:
+            return
+        span = self._current.get()
+        if span is not None:
+            span.add(counter, value)
+            return
+        with self._lock:
+            stage = self._stages.setdefault("unattributed", Stage())
+            stage.counters[counter] = stage.counters.get(counter, 0) + value
+
+    def _record(self, span: Span, seconds: float, error: bool) -> None:
+        with self._lock:
+            stage = self._stages.get(span.name)
+            if stage is None:
+                stage = self._stages[span.name] = Stage()
+            stage.count += 1
+            stage.errors += error
+            stage.total_seconds += seconds
+            stage.histogram.add(seconds)
+            for counter, value in span.counters.items():
+                stage.counters[counter] = stage.counters.get(counter, 0) + value
+
+            if len(self._trace) >= self.max_trace_spans:
+                self.dropped_spans += 1
+                return
+            self._trace.append(
+                {
+                    "name": span.name,
+                    "ph": "X",
+                    "ts": (span.start - self._started) * 1e6,
+                    "dur": seconds * 1e6,
+                    "pid": os.getpid(),
+                    "tid": threading.get_ident(),
+                    "args": {**span.attributes, **span.counters},
+                }
+            )
+
+    def stats(self) -> Dict[str, StageStats]:
+        with self._lock:
+            return {
+                name: StageStats(
+                    count=stage.count,
+                    errors=stage.errors,
+                    total_seconds=stage.total_seconds,
+                    p50_seconds=stage.histogram.percentile(0.5),
+                    p95_seconds=stage.histogram.percentile(0.95),
+                    p99_seconds=stage.histogram.percentile(0.99),
+                    max_seconds=stage.histogram.max,
+                    counters=dict(stage.counters),
+                )
+                for name, stage in self._stages.items()
+            }
+
+    def export_trace(self, path: str | Path) -> None:
+        """
+        Write the kept spans as a Chrome trace event file, viewable in Perfetto or
+        chrome://tracing, with the per-stage stats under "stats".
+        """
+        with self._lock:
+            events = list(self._trace)
+            dropped_spans = self.dropped_spans
+        trace = {
+            "traceEvents": events,
+            "displayTimeUnit": "ms",
+            "droppedSpans": dropped_spans,
+            "stats": {
+                name: stats.model_dump() for name, stats in self.stats().items()
+            },
+        }
+        Path(path).write_text(json.dumps(trace, default=str), encoding="utf-8")
+
+    def summary_table(self) -> str:
+        """
+        Return a table of the count, latency percentiles and counters of each stage.
+        """
+        stats = self.stats()
+        counter_names = sorted({c for s in stats.values() for c in s.counters})
+        header = ["stage", "count", "errors", "total_s", "p50_ms", "p95_ms", "p99_ms"]
+        rows = [header + counter_names]
+        for name in sorted(stats):
+            s = stats[name]
+            rows.append(
+                [
+                    name,
+                    str(s.count),
+                    str(s.errors),
+                    f"{s.total_seconds:.2f}",
+                    f"{s.p50_seconds * 1000:.1f}",
+                    f"{s.p95_seconds * 1000:.1f}",
+                    f"{s.p99_seconds * 1000:.1f}",
+                ]
+                + [f"{s.counters.get(c, 0):g}" for c in counter_names]
+            )
+        widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+        return "\n".join(
+            "  ".join(
+                cell.ljust(width) if i == 0 else cell.rjust(width)
+                for i, (cell, width) in enumerate(zip(row, widths))
+            )
+            for row in rows
+        )
+
+
+telemetry = Telemetry()
+
+
+def span(name: str, **attributes: Any):
+    """
+    Time a stage with the process-wide telemetry, e.g. `with span("pdf.ocr_chunk"):`.
+    """
+    return telemetry.span(name, **attributes)
+
+
+def add(counter: str, value: float = 1) -> None:
+    telemetry.add(counter, value)
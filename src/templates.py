@@ -0,0 +1,61 @@
+from functools import lru_cache
+from pathlib import Path
+from string import Formatter
+from typing import Any, Dict, List, Optional, Tuple
+
+from .llm.util import ChatMessageType, format_chat_message
+from .utils import read_yaml
+
+PROMPTS_DIR = Path(__file__).parent / "prompts"
+
+
+class PromptTemplate:
+    """
+    A prompt read from its YAML file, with its content split once into literal text and
+    fields, so it is not parsed again every time it is rendered.
+
+    A prompt may name a shared `context` prompt, e.g. the document that several prompts
+    ask about. Its messages then start with the context and end with the prompt's own
+    question, so prompts about the same document share a prefix that providers and
+    local servers can cache.
+    """
+
+    def __init__(self, name: str, prompt: Dict[str, Any]) -> None:
+        self.name = name
+        self.version: Any = prompt["version"]
+        self.content: str = prompt["content"]
+        self.schema: Optional[Dict[str, Any]] = prompt.get("schema")
+        # name of the prompt whose content comes first, as the system message
+        self.context: Optional[str] = prompt.get("context")
+        # (literal text, name of the field after it or None)
+        self.parts: List[Tuple[str, Optional[str]]] = []
+        for literal, field, spec, conversion in Formatter().parse(self.content):
+            if spec or conversion:
+                raise ValueError(f"unsupported prompt field [field={field}]")
+            self.parts.append((literal, field))
+
+    def render(self, **fields: str) -> str:
+        """Return the content with its fields filled in, like `content.format(**fields)`."""
+        return "".join(
+            literal if field is None else literal + str(fields[field])
+            for literal, field in self.parts
+        )
+
+    def messages(self, **fields: str) -> List[ChatMessageType]:
+        """
+        Return the chat messages of the prompt: the rendered context as the system
+        message followed by the question as the user message, or the whole prompt as
+        the system message if it has no context.
+        """
+        if self.context is None:
+            return [format_chat_message("system", self.render(**fields))]
+        return [
+            format_chat_message("system", get_prompt(self.context).render(**fields)),
+            format_chat_message("user", self.render(**fields)),
+        ]
+
+
+@lru_cache(maxsize=None)
+def get_prompt(name: str) -> PromptTemplate:
+    """Return the prompt in `src/prompts/<name>.yaml`, read only on first use."""
+    return PromptTemplate(name, read_yaml(str(PROMPTS_DIR / f"{name}.yaml")))
@@ -0,0 +1,156 @@
+import re
+from datetime import datetime
+from functools import lru_cache
+from typing import List, Optional
+
+from pydantic import BaseModel
+
+from .dedup import FAX_HEADER_RE
+from .segment import DATE
+
+# a date, with the time after it if any, e.g. "2/16/2024 7:44 AM"
+DATE_TIME_RE = re.compile(
+    r"(?<![\d/])(\d{1,2})/(\d{1,2})/(\d{2}|\d{4})(?![\d/])"
+    r"(?:,?\s+(\d{1,2}):(\d{2})(?::(\d{2}))?(?:\s*([AP]M))?)?",
+    re.IGNORECASE,
+)
+
+# lines whose dates are never the encounter's: print and fax stamps, and comparisons
+# with earlier studies
+NOISE_LINE_RES = [
+    FAX_HEADER_RE,
+    re.compile(r"^\W*Printed (at|on)\b", re.IGNORECASE),
+    re.compile(rf"^\s*{DATE},\s+\d{{1,2}}:\d{{2}}\s*[AP]M\s*$", re.IGNORECASE),
+    re.compile(r"^\W*COMPARISONS?\b", re.IGNORECASE),
+]
+
+# the patient's date of birth, which is cut from a line before looking for dates
+DOB_RE = re.compile(rf"\b(DOB|Date of Birth|Birth ?Date)\W*{DATE}", re.IGNORECASE)
+
+# (label just before a date, how likely the date is the encounter's), checked in order
+DATE_LABELS = [
+    (
+        re.compile(
+            r"\b(Office Visit|Annual Exam|DATE OF SERVICE|Date of encounter|Encounter Date|"
+            r"Date of Visit|Visit Date|Service Date)\W*$",
+            re.IGNORECASE,
+        ),
+        1.0,
+    ),
+    (
+        re.compile(
+            r"(^\W*Date|\bScan on|\bElectronic signature on|\bDocuments on)\W*$",
+            re.IGNORECASE,
+        ),
+        0.7,
+    ),
+]
+UNLABELED_SCORE = 0.3
+
+# unlabeled dates count only in the first lines of an encounter
+UNLABELED_MAX_LINE = 10
+
+
+class DateCandidate(BaseModel):
+    timestamp: datetime
+    # whether the date came with a time of day
+    has_time: bool
+    line_index: int
+    score: float
+
+
+@lru_cache(maxsize=4096)
+def parse_date(match_text: str) -> Optional[datetime]:
+    """
+    Parse a date, and time if any, as matched by DATE_TIME_RE. Returns None for dates
+    that do not exist, e.g. 2/30/2024.
+    """
+    m = DATE_TIME_RE.fullmatch(match_text)
+    if m is None:
+        return None
+    month, day, year, hour, minute, second, meridiem = m.groups()
+    year = int(year)
+    if year < 100:
+        # two-digit years are of this century, unless that would be in the future
+        year += 2000 if year <= datetime.now().year % 100 else 1900
+    hour = int(hour or 0)
+    if meridiem is not None:
+        if not 1 <= hour <= 12:
+            return None
+        hour = hour % 12 + (12 if meridiem.upper() == "PM" else 0)
+    try:
+        return datetime(
+            year, int(month), int(day), hour, int(minute or 0), int(second or 0)
+        )
+    except ValueError:
+        return None
+
+
+@lru_cache(maxsize=4096)
+def parse_datetime(text: str) -> Optional[datetime]:
+    """
+    Parse a free-form date and time, e.g. an LLM's answer, trying the common numeric
+    form before dateparser.
+    """
+    text = text.strip()
+    timestamp = parse_date(text)
+    if timestamp is not None:
+        return timestamp
+    # dateparser loads its locale data on import, which takes a while
+    import dateparser
+
+    return dateparser.parse(text)
+
+
+def date_candidates(lines: List[str]) -> List[DateCandidate]:
+    """
+    Return the dates of an encounter that may be when it happened, best first. A date
+    scores by the label just before it, and earlier dates rank above later ones.
+    """
+    candidates = []
+    for i, line in enumerate(lines):
+        if not line.strip() or any(r.match(line) for r in NOISE_LINE_RES):
+            continue
+        line = DOB_RE.sub(" ", line)
+        for m in DATE_TIME_RE.finditer(line):
+            timestamp = parse_date(m.group(0))
+            if timestamp is None or timestamp > datetime.now():
+                continue
+            prefix = line[: m.start()]
+            score = next(
+                (score for label, score in DATE_LABELS if label.search(prefix)), None
+            )
+            if score is None:
+                if i >= UNLABELED_MAX_LINE:
+                    continue
+                score = UNLABELED_SCORE
+            candidates.append(
+                DateCandidate(
+                    timestamp=timestamp,
+                    has_time=m.group(4) is not None,
+                    line_index=i,
+                    score=score,
+                )
+            )
+    return sorted(candidates, key=lambda c: (-c.score, c.line_index))
+
+
+def rule_timestamp(lines: List[str]) -> Optional[datetime]:
+    """
+    Return when an encounter happened, if its best scoring dates, and any labeled dates
+    before them, all agree on the day, or else None, leaving it to the LLM. The time of
+    day is taken from the first of the best dates that has one.
+    """
+    candidates = date_candidates(lines)
+    if not candidates:
+        return None
+    top = candidates[0]
+    best = [c for c in candidates if c.score == top.score]
+    rivals = [
+        c
+        for c in candidates
+        if c.score > UNLABELED_SCORE and c.line_index < top.line_index
+    ]
+    if len({c.timestamp.date() for c in best + rivals}) > 1:
+        return None
+    return next((c.timestamp for c in best if c.has_time), top.timestamp)
@@ -1,12 +1,51 @@
 import argparse
 import sys
 
-from src.record import extract_from_pdf
+from src.cli import add_pipeline_args
+from src.llm import llm_completion_config_map, routing_from_args
+from src.telemetry import telemetry
 
 
-def main(filepath: str):
+def main(
+    filepath: str,
+    stream: bool = False,
+    compact: bool = False,
+    state_path: str | None = None,
+    trace_path: str | None = None,
+    **kwargs,
+):
     """Write the entrypoint to your submission here"""
-    result = extract_from_pdf(filepath)
+    try:
+        run(filepath, stream, compact, state_path, **kwargs)
+    finally:
+        sys.stderr.write(f"{telemetry.summary_table()}\n")
+        if trace_path is not None:
+            telemetry.export_trace(trace_path)
+
+
+def run(
+    filepath: str,
+    stream: bool = False,
+    compact: bool = False,
+    state_path: str | None = None,
+    **kwargs,
+):
+    # the pipeline and its PDF and OCR dependencies are imported only once the
+    # arguments are valid, so that --help and usage errors return at once
+    from src.incremental import update_from_pdf
+    from src.record import extract_from_pdf, iter_encounters
+
+    if state_path is not None:
+        result = update_from_pdf(filepath, state_path, compact=compact, **kwargs)
+        sys.stdout.write(f"{result.model_dump_json()}\n")
+        return
+    if stream:
+        # one encounter per line, written as soon as it is parsed
+        for encounter in iter_encounters(filepath, **kwargs):
+            sys.stdout.write(f"{encounter.model_dump_json()}\n")
+            sys.stdout.flush()
+        return
+    result = extract_from_pdf(filepath, compact=compact, **kwargs)
     sys.stdout.write(f"{result.model_dump_json()}\n")
 
 
@@ -18,9 +57,63 @@ if __name__ == "__main__":
         type=str,
         help="Path to local test case with which to run your code",
     )
+    parser.add_argument(
+        "--api-type",
+        type=str,
+        default="openai",
+        choices=sorted(llm_completion_config_map),
+        help="LLM backend to use",
+    )
+    parser.add_argument(
+        "--max-workers",
+        type=int,
+        default=8,
+        help="Number of encounters to parse at once",
+    )
+    add_pipeline_args(parser)
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Write each encounter as a line of JSON as soon as it is parsed",
+    )
+    parser.add_argument(
+        "--compact",
+        action="store_true",
+        help="Write encounters as spans of the record content instead of copies of their text",
+    )
+    parser.add_argument(
+        "--state",
+        metavar="path",
+        type=str,
+        default=None,
+        help="Update the record saved at this path by a previous run, re-parsing only what changed",
+    )
+    parser.add_argument(
+        "--trace",
+        metavar="path",
+        type=str,
+        default=None,
+        help="Write a JSON trace of the run's pipeline stages to this path",
+    )
     args = parser.parse_args()
+    if args.stream and (args.state or args.compact):
+        parser.error("--stream cannot be used with --state or --compact")
+    routing = routing_from_args(parser, args)
     (
-        main(args.path_to_case_pdf)
+        main(
+            args.path_to_case_pdf,
+            api_type=args.api_type,
+            max_workers=args.max_workers,
+            requests_per_minute=args.requests_per_minute,
+            tokens_per_minute=args.tokens_per_minute,
+            fused=args.fused,
+            cache=not args.no_cache,
+            routing=routing,
+            stream=args.stream,
+            compact=args.compact,
+            state_path=args.state,
+            trace_path=args.trace,
+        )
         if args.path_to_case_pdf
         else print("Please provide a PDF path")
     )
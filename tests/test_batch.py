@@ -0,0 +1,51 @@
+import pytest
+
+from benchmarks.synthetic import SyntheticRecord, synthetic_record, write_record_pdf
+from src import batch
+from src.batch import BatchOptions, RecordResult, process_record, record_cost
+from src.fakes import FakeCompletionService, FakeDocumentAI
+from src.llm import LLMApi
+
+
+@pytest.fixture
+def pdf(tmp_path):
+    path = tmp_path / "record.pdf"
+    record = SyntheticRecord(texts=synthetic_record(8, resent_fraction=0).texts)
+    write_record_pdf(path, record, native_fraction=1)
+    return str(path)
+
+
+def test_each_tier_is_priced_at_its_own_model(pdf, tmp_path, monkeypatch):
+    strong = FakeCompletionService(model="gpt-4o")
+    fast = FakeCompletionService(model="gpt-4o-mini")
+    llm = LLMApi(completion_service=strong, fast_tier=LLMApi(completion_service=fast))
+    monkeypatch.setattr(batch, "_worker_llm", llm)
+    monkeypatch.setattr(batch, "_worker_document_ai", FakeDocumentAI({}))
+    monkeypatch.setattr(batch, "_worker_options", BatchOptions(cache=False))
+
+    result = process_record(pdf, str(tmp_path / "record.json"))
+    assert result.status == "done"
+    assert (result.model, result.fast_model) == ("gpt-4o", "gpt-4o-mini")
+    assert result.fast_prompt_tokens == fast.prompt_tokens > 0
+    assert result.prompt_tokens == strong.prompt_tokens + fast.prompt_tokens
+    assert result.completion_tokens == (
+        strong.completion_tokens + fast.completion_tokens
+    )
+
+
+def test_fast_tier_tokens_are_not_priced_as_strong_tokens():
+    result = RecordResult(
+        path="a.pdf",
+        output="a.json",
+        status="done",
+        seconds=1.0,
+        model="gpt-4o",
+        prompt_tokens=3_000_000,
+        completion_tokens=0,
+        fast_model="gpt-4o-mini",
+        fast_prompt_tokens=2_000_000,
+    )
+    assert record_cost(result) == pytest.approx(5.0 + 2 * 0.15)
+    assert record_cost(result.model_copy(update={"batch_api": True})) == (
+        pytest.approx(2.5 + 2 * 0.15)
+    )
@@ -0,0 +1,19 @@
+from src.chunking import reconcile_boundaries
+
+
+def test_boundaries_outside_their_window_are_dropped():
+    windows = [((0, 10), [2, 12]), ((8, 20), [3, 15, 25])]
+    assert reconcile_boundaries(windows, 20) == [2, 15]
+
+
+def test_boundary_seen_by_overlapping_windows_is_kept_once():
+    assert reconcile_boundaries([((0, 10), [8]), ((6, 16), [8])], 16) == [8]
+
+
+def test_boundary_furthest_from_a_window_edge_is_kept():
+    # 9 is at the edge of the first window, 10 in the middle of the second
+    assert reconcile_boundaries([((0, 10), [9]), ((5, 15), [10])], 15) == [10]
+
+
+def test_close_boundaries_of_one_window_are_distinct():
+    assert reconcile_boundaries([((0, 10), [4, 5])], 10) == [4, 5]
@@ -0,0 +1,22 @@
+from src.dedup import find_duplicates
+
+VISIT = """4/2/2024 1:22:35 PM EDT PAGE 3/060 Fax Server
+Progress Note 3/27/2023
+Patient seen for follow up of hypertension. BP 142/88.
+Continue lisinopril 10 mg daily.
+"""
+
+
+def test_resent_page_is_linked_to_first_copy():
+    resent = VISIT.replace("PAGE 3/060", "PAGE 41/060").upper()
+    assert find_duplicates([VISIT, "Other page", resent]) == [None, None, 0]
+
+
+def test_same_template_on_another_date_is_not_linked():
+    later = VISIT.replace("3/27/2023", "4/15/2023")
+    assert find_duplicates([VISIT, later]) == [None, None]
+
+
+def test_empty_texts_are_never_duplicates():
+    header_only = "4/2/2024 1:22:35 PM EDT PAGE 7/060 Fax Server\n"
+    assert find_duplicates(["", header_only, "", header_only]) == [None] * 4
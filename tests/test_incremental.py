@@ -0,0 +1,54 @@
+import pytest
+
+from benchmarks.synthetic import SyntheticRecord, synthetic_record, write_record_pdf
+from src.fakes import FakeCompletionService
+from src.incremental import update_record
+from src.llm import LLMApi
+
+
+@pytest.fixture
+def pdfs(tmp_path):
+    """
+    A record with a text layer on every page, so that no OCR is needed, and the same
+    record with pages appended.
+    """
+    texts = synthetic_record(16, resent_fraction=0).texts
+    paths = []
+    for name, num_pages in [("old.pdf", 12), ("new.pdf", 16)]:
+        path = tmp_path / name
+        record = SyntheticRecord(texts=texts[:num_pages])
+        write_record_pdf(path, record, native_fraction=1)
+        paths.append(str(path))
+    return paths
+
+
+def parse(path, state=None):
+    completion_service = FakeCompletionService()
+    llm = LLMApi(completion_service=completion_service)
+    return update_record(llm, path, state, max_workers=2), completion_service.calls
+
+
+def test_unchanged_record_is_not_parsed_again(pdfs):
+    state, calls = parse(pdfs[0])
+    assert calls > 0 and state.record.encounters
+
+    updated, calls = parse(pdfs[0], state)
+    assert calls == 0
+    assert updated.record.encounters == state.record.encounters
+    assert updated.encounter_spans == state.encounter_spans
+
+
+def test_appended_pages_are_parsed_like_a_new_record(pdfs):
+    state, _ = parse(pdfs[0])
+    updated, calls = parse(pdfs[1], state)
+    fresh, fresh_calls = parse(pdfs[1])
+
+    assert calls < fresh_calls
+    assert updated.page_hashes[: len(state.page_hashes)] == state.page_hashes
+    assert [e.content for e in updated.record.encounters] == [
+        e.content for e in fresh.record.encounters
+    ]
+    # encounters on unchanged pages keep their ids
+    old_ids = [e.id for e in state.record.encounters]
+    new_ids = [e.id for e in updated.record.encounters]
+    assert new_ids[: len(old_ids) - 1] == old_ids[:-1]
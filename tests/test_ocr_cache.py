@@ -0,0 +1,32 @@
+import os
+
+from src.ocr_cache import OCRCache
+
+
+def test_cached_text_is_returned(tmp_path):
+    cache = OCRCache(tmp_path)
+    assert cache.get("page") is None
+    cache.put("page", "Progress note\n")
+    assert cache.get("page") == "Progress note\n"
+    assert "page" in cache
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    cache = OCRCache(tmp_path, max_bytes=300)
+    for i, key in enumerate(["a", "b", "c"]):
+        cache.put(key, "x" * 100)
+        os.utime(tmp_path / f"{key}.txt", (i, i))
+    # reading "a" makes "b" the least recently used
+    cache.get("a")
+
+    cache.put("d", "x" * 100)
+    assert "b" not in cache
+    assert all(key in cache for key in "acd")
+    assert cache.info().total_bytes == 300
+
+
+def test_size_is_counted_when_opened(tmp_path):
+    OCRCache(tmp_path).put("a", "x" * 200)
+    cache = OCRCache(tmp_path, max_bytes=300)
+    cache.put("b", "x" * 200)
+    assert len(cache) == 1 and "b" in cache
@@ -0,0 +1,67 @@
+from openai.types import CompletionUsage
+from openai.types.chat import ChatCompletionChunk
+
+from src.fakes import FakeCompletionService
+from src.llm import LLMApi
+from src.llm.openai import OpenAIService
+from src.llm.util import format_chat_message
+from src.telemetry import telemetry
+
+USAGE = {
+    "prompt_tokens": 1200,
+    "completion_tokens": 30,
+    "total_tokens": 1230,
+    "prompt_tokens_details": {"cached_tokens": 1024},
+}
+
+
+def recorded_usage(res):
+    with telemetry.span("test.usage") as span:
+        OpenAIService._record_usage(res)
+    return span.counters
+
+
+def test_cached_prompt_tokens_are_recorded():
+    class Response:
+        usage = CompletionUsage.model_validate(USAGE)
+
+    assert recorded_usage(Response()) == {
+        "prompt_tokens": 1200,
+        "completion_tokens": 30,
+        "cached_prompt_tokens": 1024,
+    }
+
+
+def test_cached_prompt_tokens_of_a_stream_are_recorded():
+    chunk = ChatCompletionChunk.model_validate(
+        {
+            "id": "chatcmpl-1",
+            "object": "chat.completion.chunk",
+            "created": 0,
+            "model": "gpt-4o",
+            "choices": [],
+            "usage": USAGE,
+        }
+    )
+    assert recorded_usage(chunk)["cached_prompt_tokens"] == 1024
+
+
+def test_usage_without_details_has_no_cached_tokens():
+    class Response:
+        usage = CompletionUsage(prompt_tokens=10, completion_tokens=2, total_tokens=12)
+
+    assert "cached_prompt_tokens" not in recorded_usage(Response())
+
+
+def test_cached_prompt_tokens_reach_the_calling_span():
+    # through the resilience layer, which runs each attempt on a worker thread
+    llm = LLMApi(completion_service=FakeCompletionService(prefix_cache=True))
+    messages = [
+        format_chat_message("system", "You are a medical records assistant. " * 20),
+        format_chat_message("user", "List the findings."),
+    ]
+    llm.chat_completion(messages)
+    with telemetry.span("test.usage") as span:
+        llm.chat_completion(messages[:1] + [format_chat_message("user", "Again.")])
+    assert span.counters["cached_prompt_tokens"] > 0
+    assert span.counters["prompt_tokens"] > span.counters["cached_prompt_tokens"]
@@ -0,0 +1,80 @@
+import pytest
+
+from src.llm.openai_batch import BatchResult, BatchStore
+
+OK = BatchResult('{"choices": []}', None, False)
+RETRYABLE = BatchResult(None, "status 500", True)
+FATAL = BatchResult(None, "status 400", False)
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = BatchStore(tmp_path / "batches.sqlite")
+    yield store
+    store.close()
+
+
+def test_requests_are_queued_once(store):
+    store.enqueue("a", "{}")
+    store.enqueue("a", "{}")
+    store.enqueue("b", "{}")
+    assert store.queued()[0] == 2
+
+
+def test_claimed_requests_are_not_claimed_again(store):
+    for custom_id in "abc":
+        store.enqueue(custom_id, "{}")
+    first = store.claim_queued("tag-1", 2)
+    second = store.claim_queued("tag-2", 2)
+    assert [custom_id for custom_id, _ in first] == ["a", "b"]
+    assert [custom_id for custom_id, _ in second] == ["c"]
+    assert store.get("a")[0] == "submitted"
+    assert store.queued()[0] == 0
+
+
+def test_finished_batch_stores_results_and_requeues_the_rest(store):
+    for custom_id in "abcd":
+        store.enqueue(custom_id, "{}")
+    store.claim_queued("tag", 10)
+    store.set_batch("tag", "batch_1", "in_progress")
+    assert store.open_batches() == [("tag", "batch_1")]
+
+    # "d" has no result, e.g. because the batch expired
+    requeued = store.finish_batch(
+        "tag", "completed", {"a": OK, "b": RETRYABLE, "c": FATAL}, max_attempts=2
+    )
+    assert requeued == 2
+    assert store.get("a") == ("done", OK.response, None)
+    assert store.get("b") == ("queued", None, "status 500")
+    assert store.get("c") == ("failed", None, "status 400")
+    assert store.get("d")[0] == "queued"
+    assert store.open_batches() == []
+
+
+def test_retryable_failures_fail_after_max_attempts(store):
+    store.enqueue("a", "{}")
+    for attempt, status in enumerate(["queued", "failed"]):
+        store.claim_queued(f"tag-{attempt}", 10)
+        store.finish_batch(f"tag-{attempt}", "completed", {"a": RETRYABLE}, 2)
+        assert store.get("a")[0] == status
+
+    # asked for again, a failed request is queued again
+    store.enqueue("a", "{}")
+    assert store.get("a") == ("queued", None, None)
+
+
+def test_requests_of_a_batch_never_created_are_requeued(store):
+    store.enqueue("a", "{}")
+    store.claim_queued("tag", 10)
+    store.requeue_batch("tag")
+    assert store.get("a")[0] == "queued"
+    assert store.batches("abandoned")[0][:2] == ("tag", None)
+
+
+def test_lease_has_one_owner(store):
+    assert store.acquire_lease("one", seconds=60)
+    assert not store.acquire_lease("two", seconds=60)
+    assert store.acquire_lease("two", seconds=60, stale_owner="one")
+    store.release_lease("two")
+    assert store.acquire_lease("one", seconds=60)
+    assert store.lease_owner() == "one"
@@ -0,0 +1,128 @@
+import threading
+import time
+
+import pytest
+
+from src.fakes import FakeCompletionService
+from src.llm import LLMApi
+from src.llm.util import format_chat_message
+from src.resilience import (
+    CircuitBreaker,
+    CircuitOpenError,
+    DeadlineExceeded,
+    ResiliencePolicy,
+    Resilient,
+    RetryableError,
+    is_retryable_status,
+)
+from src.telemetry import telemetry
+
+FAST_RETRIES = ResiliencePolicy(backoff_base_seconds=0.0)
+
+
+class Flaky:
+    """A call that fails with `error` the first `failures` times."""
+
+    def __init__(self, failures: int, error: Exception) -> None:
+        self.failures = failures
+        self.error = error
+        self.calls = 0
+
+    def __call__(self) -> str:
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise self.error
+        return "ok"
+
+
+def test_rate_limits_and_server_errors_are_retryable():
+    assert all(is_retryable_status(s) for s in [408, 409, 429, 500, 503])
+    assert not any(is_retryable_status(s) for s in [400, 401, 404, 422])
+
+
+def test_retryable_errors_are_retried():
+    fn = Flaky(2, RetryableError("503"))
+    with telemetry.span("test.retry") as span:
+        assert Resilient("test", FAST_RETRIES).call(fn) == "ok"
+    assert fn.calls == 3
+    assert span.counters == {"test.retries": 2}
+
+
+def test_other_errors_are_raised_at_once():
+    fn = Flaky(1, ValueError("bad request"))
+    with pytest.raises(ValueError):
+        Resilient("test", FAST_RETRIES).call(fn)
+    assert fn.calls == 1
+
+
+def test_retries_stop_at_max_retries():
+    fn = Flaky(10, ConnectionError("reset"))
+    policy = FAST_RETRIES.model_copy(update={"max_retries": 2})
+    with pytest.raises(ConnectionError):
+        Resilient("test", policy).call(fn)
+    assert fn.calls == 3
+
+
+def test_retry_waits_at_least_as_long_as_the_server_asked():
+    fn = Flaky(1, RetryableError("429", retry_after=60))
+    policy = FAST_RETRIES.model_copy(update={"deadline_seconds": 1.0})
+    with pytest.raises(DeadlineExceeded):
+        Resilient("test", policy).call(fn)
+    assert fn.calls == 1
+
+
+def test_circuit_opens_after_consecutive_failures_and_closes_on_a_trial():
+    breaker = CircuitBreaker("test", failures=2, reset_seconds=0.05)
+    resilient = Resilient(
+        "test", FAST_RETRIES.model_copy(update={"max_retries": 0}), breaker
+    )
+    for _ in range(2):
+        with pytest.raises(RetryableError):
+            resilient.call(Flaky(1, RetryableError("503")))
+    assert breaker.state == "open"
+    with pytest.raises(CircuitOpenError):
+        resilient.call(lambda: "ok")
+
+    time.sleep(0.06)
+    assert resilient.call(lambda: "ok") == "ok"
+    assert breaker.state == "closed"
+
+
+def test_slow_attempt_is_hedged():
+    policy = FAST_RETRIES.model_copy(
+        update={"hedge_percentile": 0.5, "hedge_min_calls": 3}
+    )
+    resilient = Resilient("test", policy)
+    for _ in range(3):
+        resilient.call(lambda: "ok")
+
+    release = threading.Event()
+    attempts = []
+
+    def slow_then_fast() -> str:
+        attempts.append(None)
+        if len(attempts) == 1:
+            release.wait(5)
+            return "slow"
+        return "fast"
+
+    with telemetry.span("test.hedge") as span:
+        assert resilient.call(slow_then_fast) == "fast"
+    release.set()
+    resilient.close()
+    assert span.counters == {"test.hedges": 1, "test.hedge_wins": 1}
+
+
+def test_llm_requests_are_retried_through_the_completion_service():
+    class FlakyService(FakeCompletionService):
+        def chat_completion(self, *args, **kwargs):
+            if self.calls == 0:
+                self.calls += 1
+                raise RetryableError("503")
+            yield from super().chat_completion(*args, **kwargs)
+
+    completion_service = FlakyService()
+    llm = LLMApi(completion_service=completion_service, resilience=FAST_RETRIES)
+    messages = [format_chat_message("user", "List the findings.")]
+    assert llm.chat_completion(messages)["role"] == "assistant"
+    assert completion_service.calls == 2
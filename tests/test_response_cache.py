@@ -0,0 +1,65 @@
+import pytest
+
+from src.fakes import FakeCompletionService
+from src.llm import LLMApi, ResponseCache
+from src.llm import cache as cache_module
+from src.llm.util import format_chat_message
+
+
+class Clock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def time(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache_module, "time", clock)
+    return clock
+
+
+def message(content):
+    return format_chat_message("assistant", content)
+
+
+def test_entries_expire_after_their_ttl(tmp_path, clock):
+    cache = ResponseCache(tmp_path / "llm.sqlite3", ttl_seconds=60)
+    cache.put("key", message("hello"))
+    clock.now += 59
+    assert cache.get("key") == message("hello")
+    clock.now += 2
+    assert cache.get("key") is None
+    assert cache.stats().model_dump() == {"hits": 1, "misses": 1, "num_entries": 0}
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path, clock):
+    cache = ResponseCache(tmp_path / "llm.sqlite3", max_entries=2)
+    cache.put("a", message("a"))
+    clock.now += 1
+    cache.put("b", message("b"))
+    clock.now += 1
+    # reading "a" makes "b" the least recently used
+    assert cache.get("a") is not None
+    clock.now += 1
+    cache.put("c", message("c"))
+
+    assert cache.get("b") is None
+    assert cache.get("a") is not None and cache.get("c") is not None
+    assert cache.stats().num_entries == 2
+
+
+def test_cached_response_is_not_requested_again(tmp_path):
+    completion_service = FakeCompletionService()
+    llm = LLMApi(
+        completion_service=completion_service,
+        cache=ResponseCache(tmp_path / "llm.sqlite3"),
+    )
+    messages = [format_chat_message("user", "List the findings.")]
+    first = llm.chat_completion(messages, prompt_version="1")
+    assert llm.chat_completion(messages, prompt_version="1") == first
+    assert completion_service.calls == 1
+    llm.chat_completion(messages, prompt_version="2")
+    assert completion_service.calls == 2
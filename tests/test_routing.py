@@ -0,0 +1,90 @@
+import argparse
+from datetime import datetime
+
+import pytest
+
+from src.fakes import FakeCompletionService
+from src.llm import LLMApi, RoutingConfig, add_routing_args, routing_from_args
+from src.llm.util import format_chat_message
+from src.record import parse_encounter
+
+# dates that disagree, so the timestamp is asked of the LLM
+LINES = [
+    "Seen 3/27/2023 for follow up of hypertension.",
+    "Patient reports dizziness when standing up, worse in the morning.",
+    "Seen again 4/15/2023.",
+]
+
+
+class CannedService(FakeCompletionService):
+    """Answers every prompt with `answer`, or fails with it if it is an exception."""
+
+    def __init__(self, answer) -> None:
+        super().__init__()
+        self.answer = answer
+
+    def chat_completion(self, messages, *args, **kwargs):
+        self.calls += 1
+        if isinstance(self.answer, Exception):
+            raise self.answer
+        yield format_chat_message("assistant", self.answer)
+
+
+def tiers(fast_answer, routing=None):
+    strong = FakeCompletionService()
+    fast = CannedService(fast_answer)
+    llm = LLMApi(
+        completion_service=strong,
+        fast_tier=LLMApi(completion_service=fast, resilient=False),
+        routing=routing,
+    )
+    return llm, strong, fast
+
+
+def test_responses_failing_validation_are_escalated():
+    # a finding, but not a date
+    llm, strong, fast = tiers("Dizziness when standing up")
+    encounter = parse_encounter(llm, LINES)
+
+    assert encounter.timestamp == datetime(2023, 3, 27)
+    assert encounter.findings == ["Dizziness when standing up"]
+    assert strong.calls == 1
+    stats = llm.routing_stats.snapshot()
+    assert stats["encounter_timestamp"].escalated == 1
+    assert stats["list_findings"].fast == 1
+
+
+def test_failed_fast_tier_calls_are_escalated():
+    llm, strong, fast = tiers(ConnectionError("refused"))
+    encounter = parse_encounter(llm, LINES)
+
+    assert encounter.timestamp == datetime(2023, 3, 27)
+    assert fast.calls == strong.calls == 3
+    stats = llm.routing_stats.snapshot()
+    assert all(s.escalated == 1 and s.fast == 0 for s in stats.values())
+
+
+def test_strong_prompts_skip_the_fast_tier():
+    routing = RoutingConfig(routes={"encounter_timestamp": "strong"})
+    llm, strong, fast = tiers("Dizziness when standing up", routing)
+    parse_encounter(llm, LINES)
+
+    assert strong.calls == 1 and fast.calls == 2
+    assert llm.routing_stats.snapshot()["encounter_timestamp"].strong == 1
+
+
+def test_routing_is_read_from_the_command_line():
+    parser = argparse.ArgumentParser()
+    add_routing_args(parser)
+    assert routing_from_args(parser, parser.parse_args([])) is None
+
+    args = parser.parse_args(
+        ["--fast-api-type", "ollama", "--strong-prompt", "detect_encounter_boundary"]
+    )
+    routing = routing_from_args(parser, args)
+    assert routing.fast_api_type == "ollama"
+    assert routing.tier("detect_encounter_boundary") == "strong"
+    assert routing.tier("list_findings") == "fast"
+
+    with pytest.raises(SystemExit):
+        routing_from_args(parser, parser.parse_args(["--fast-model", "llama3"]))
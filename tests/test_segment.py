@@ -0,0 +1,36 @@
+from src.segment import pre_segment, score_lines
+
+LINES = [
+    "Office Visit 3/27/2023",
+    "BP 142/88, continue lisinopril.",
+    "Progress Notes",
+    "Seen for follow up.",
+    "Annual Exam 4/15/2023",
+    "No new complaints.",
+]
+
+
+def test_lines_are_scored_by_the_rule_they_match():
+    assert score_lines(LINES) == [0.95, 0.0, 0.6, 0.0, 0.9, 0.0]
+
+
+def test_page_headers_are_not_boundaries():
+    assert score_lines(["DOB: 1/2/1950 Encounter Date: 3/27/2023"]) == [0.0]
+
+
+def test_titles_at_the_start_of_a_faxed_page_are_boosted():
+    lines = ["4/2/2024 1:22:35 PM EDT PAGE 2/060 Fax Server", "Progress Notes"]
+    assert score_lines(lines)[1] == 0.8
+
+
+def test_confident_boundaries_are_accepted_and_the_rest_left_to_the_llm():
+    segmentation = pre_segment(LINES)
+    assert segmentation.boundaries == [0, 4]
+    # "Progress Notes" may or may not start an encounter
+    assert segmentation.ambiguous_spans == [(0, 4)]
+    assert segmentation.llm_fraction == 4 / 6
+
+
+def test_long_segments_are_left_to_the_llm():
+    lines = ["Office Visit 3/27/2023"] + ["Seen for follow up."] * 100
+    assert pre_segment(lines, max_span_lines=80).ambiguous_spans == [(0, 101)]
@@ -0,0 +1,62 @@
+import http.client
+import socket
+import threading
+
+import pytest
+
+from src.fakes import FakeCompletionService, FakeDocumentAI
+from src.llm import LLMApi
+from src.server import ExtractionHTTPServer, ExtractionService
+
+
+@pytest.fixture
+def server(tmp_path):
+    # no workers are started, so queued jobs stay queued
+    service = ExtractionService(
+        LLMApi(completion_service=FakeCompletionService()),
+        document_ai=FakeDocumentAI({}),
+        queue_size=1,
+        upload_dir=tmp_path,
+    )
+    server = ExtractionHTTPServer(("127.0.0.1", 0), service, max_upload_bytes=1024)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def post(server, body, headers=None):
+    conn = http.client.HTTPConnection(*server.server_address, timeout=5)
+    conn.request("POST", "/jobs", body, headers or {})
+    response = conn.getresponse()
+    response.read()
+    conn.close()
+    return response
+
+
+def test_full_queue_is_refused_without_reading_the_upload(server):
+    assert post(server, b"%PDF-").status == 202
+
+    # only the headers are sent: the answer must not wait for the body
+    with socket.create_connection(server.server_address, timeout=5) as sock:
+        sock.sendall(
+            b"POST /jobs HTTP/1.1\r\nHost: test\r\nContent-Length: 1000\r\n\r\n"
+        )
+        response = http.client.HTTPResponse(sock)
+        response.begin()
+        assert response.status == 429
+        assert response.getheader("Retry-After") is not None
+        assert response.getheader("Connection") == "close"
+
+    assert server.service.stats().refused_jobs == 1
+    assert len(list(server.service.upload_dir.iterdir())) == 1
+
+
+def test_invalid_content_length_is_rejected(server):
+    response = post(server, b"%PDF-", {"Content-Length": "five"})
+    assert response.status == 400
+
+
+def test_upload_over_the_limit_is_rejected(server):
+    assert post(server, b"0" * 2048).status == 413
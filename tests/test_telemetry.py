@@ -0,0 +1,71 @@
+import json
+
+import pytest
+
+from src.telemetry import HISTOGRAM_RATIO, Histogram, Telemetry
+
+
+def test_histogram_percentiles_are_within_a_bucket():
+    histogram = Histogram()
+    for ms in range(1, 101):
+        histogram.add(ms / 1000)
+    for q, expected in [(0.5, 0.050), (0.95, 0.095), (0.99, 0.099)]:
+        assert expected <= histogram.percentile(q) <= expected * HISTOGRAM_RATIO
+    assert histogram.percentile(1.0) == histogram.max == 0.1
+
+
+def test_empty_histogram_has_zero_percentiles():
+    assert Histogram().percentile(0.5) == 0.0
+
+
+def test_counters_go_to_the_innermost_span():
+    telemetry = Telemetry()
+    with telemetry.span("encounter"):
+        telemetry.add("llm_calls")
+        with telemetry.span("prompt.list_findings"):
+            telemetry.add("llm_calls")
+            telemetry.add("prompt_tokens", 100)
+    telemetry.add("cache_hits")
+
+    stats = telemetry.stats()
+    assert stats["encounter"].counters == {"llm_calls": 1}
+    assert stats["prompt.list_findings"].counters == {
+        "llm_calls": 1,
+        "prompt_tokens": 100,
+    }
+    assert stats["unattributed"].counters == {"cache_hits": 1}
+
+
+def test_failed_spans_are_counted_as_errors():
+    telemetry = Telemetry()
+    with pytest.raises(ValueError):
+        with telemetry.span("parse.date"):
+            raise ValueError("bad date")
+    assert telemetry.stats()["parse.date"].errors == 1
+
+
+def test_trace_is_written_as_chrome_trace_events(tmp_path):
+    telemetry = Telemetry(max_trace_spans=2)
+    for i in range(3):
+        with telemetry.span("pdf.ocr_chunk", chunk=i):
+            telemetry.add("ocr_pages", 10)
+    path = tmp_path / "trace.json"
+    telemetry.export_trace(path)
+
+    trace = json.loads(path.read_text())
+    events = trace["traceEvents"]
+    assert [event["args"] for event in events] == [
+        {"chunk": 0, "ocr_pages": 10},
+        {"chunk": 1, "ocr_pages": 10},
+    ]
+    assert all(event["ph"] == "X" and event["dur"] >= 0 for event in events)
+    assert trace["droppedSpans"] == 1
+    assert trace["stats"]["pdf.ocr_chunk"]["count"] == 3
+    assert trace["stats"]["pdf.ocr_chunk"]["counters"] == {"ocr_pages": 30}
+
+
+def test_disabled_telemetry_records_nothing():
+    telemetry = Telemetry(enabled=False)
+    with telemetry.span("encounter"):
+        telemetry.add("llm_calls")
+    assert telemetry.stats() == {}
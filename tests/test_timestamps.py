@@ -0,0 +1,34 @@
+from datetime import datetime
+
+from src.timestamps import parse_date, rule_timestamp
+
+
+def test_dates_and_times_are_parsed():
+    assert parse_date("2/16/2024 7:44 PM") == datetime(2024, 2, 16, 19, 44)
+    assert parse_date("2/16/24") == datetime(2024, 2, 16)
+    assert parse_date("2/30/2024") is None
+
+
+def test_labeled_date_is_the_encounter_date():
+    lines = [
+        "4/2/2024 1:22:35 PM EDT PAGE 2/060 Fax Server",
+        "DOB: 1/2/1950",
+        "Office Visit 3/27/2023",
+        "Seen 3/27/2023 10:15 AM for follow up of a fall on 3/20/2023.",
+    ]
+    assert rule_timestamp(lines) == datetime(2023, 3, 27)
+
+
+def test_time_of_day_is_taken_from_a_best_date_that_has_one():
+    lines = ["Date of Visit: 3/27/2023 10:15 AM", "Follow up on 4/15/2023."]
+    assert rule_timestamp(lines) == datetime(2023, 3, 27, 10, 15)
+
+
+def test_disagreeing_dates_are_left_to_the_llm():
+    assert rule_timestamp(["Seen 3/27/2023.", "Seen again 4/15/2023."]) is None
+    assert rule_timestamp(["No dates here."]) is None
+
+
+def test_print_stamps_and_future_dates_are_ignored():
+    lines = ["Printed on 5/1/2023", "Seen 3/27/2023.", "Return 1/1/2999."]
+    assert rule_timestamp(lines) == datetime(2023, 3, 27)